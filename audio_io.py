@@ -0,0 +1,173 @@
+"""
+Audio loading and writing for the inference scripts.
+
+load_audio is a faster drop-in for librosa.load(path, sr=44100, mono=False):
+  - files soundfile can read are decoded natively (WAV, FLAC, OGG, and MP3 with libsndfile >= 1.1),
+  - resampling, only if the file is not at the target rate, uses a polyphase filter (scipy.signal.resample_poly)
+    instead of librosa's default kaiser_best resampler,
+  - other files (m4a, ...) still go through librosa/audioread,
+  - with cache_dir set, the decoded PCM of compressed inputs is kept as .npy, re-running a file skips decoding.
+    Files unused for cache_age days or beyond cache_size MB (least recently used first) are removed.
+
+write_audio writes float stems without going through int16: WAV/FLAC/AIFF directly with soundfile at the
+requested bit depth, other formats (mp3, m4a, ...) by piping float32 PCM to ffmpeg.
+"""
+
+import os
+import math
+import time
+import hashlib
+import logging
+import subprocess
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+from cache_utils import file_signature
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUDIO_CACHE_SIZE_MB = 10240
+DEFAULT_AUDIO_CACHE_AGE_DAYS = 30
+
+# Formats that are cheaper to read again than to cache
+UNCOMPRESSED_FORMATS = ['WAV', 'WAVEX', 'RF64', 'W64', 'AIFF', 'CAF', 'RAW']
+
+# Output bit depths of write_audio and their soundfile subtypes
+BIT_DEPTHS = {'16': 'PCM_16', '24': 'PCM_24', '32f': 'FLOAT'}
+# Extensions written by soundfile, the others are encoded by ffmpeg
+SOUNDFILE_EXTENSIONS = ['wav', 'flac', 'aiff']
+# ffmpeg container names that differ from the extension
+FFMPEG_FORMATS = {'m4a': 'mp4', 'mka': 'matroska'}
+
+
+def resample(audio, orig_sr, target_sr):
+    """Polyphase resampling of audio (..., samples) from orig_sr to target_sr."""
+    if orig_sr == target_sr:
+        return audio
+    gcd = math.gcd(int(orig_sr), int(target_sr))
+    return resample_poly(audio, target_sr // gcd, orig_sr // gcd, axis=-1).astype(np.float32)
+
+
+def decode(path, sr=44100):
+    """Returns audio (channels, samples) as float32 at sample rate sr."""
+    try:
+        audio, file_sr = sf.read(path, dtype='float32', always_2d=True)
+        audio = audio.T
+    except Exception:
+        import librosa
+        audio, file_sr = librosa.load(path, sr=None, mono=False)
+        audio = np.atleast_2d(audio)
+    return np.ascontiguousarray(resample(audio, file_sr, sr), dtype=np.float32)
+
+
+def is_compressed(path):
+    try:
+        return sf.info(path).format not in UNCOMPRESSED_FORMATS
+    except Exception:
+        return True
+
+
+def evict_audio_cache(cache_dir, max_bytes, max_age):
+    """
+    Removes the files of the decoded audio cache unused for more than max_age seconds, then the least recently used
+    ones until the cache fits in max_bytes, like ResultCache.evict.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith('.npy'):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    now = time.time()
+    for last_used, size, cache_file in entries:
+        if now - last_used <= max_age and total <= max_bytes:
+            break
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+        total -= size
+        logger.debug('Evicted cached audio {}'.format(cache_file))
+
+
+def load_audio(path, sr=44100, cache_dir=None, cache_size=DEFAULT_AUDIO_CACHE_SIZE_MB, cache_age=DEFAULT_AUDIO_CACHE_AGE_DAYS):
+    """
+    Loads an audio file like librosa.load(path, sr=sr, mono=False): float32, shape (channels, samples),
+    or (samples,) for mono files.
+
+    Args:
+        path (str): Audio file.
+        sr (int): Target sample rate.
+        cache_dir (str, optional): Directory for decoded PCM of compressed inputs. No caching if not provided.
+        cache_size (float): Maximum size of cache_dir in MB.
+        cache_age (float): Cached files unused for more days than this are removed.
+
+    Returns:
+        tuple: (audio, sr)
+    """
+    cache_file = None
+    if cache_dir and is_compressed(path):
+        key = hashlib.sha1(repr((file_signature(path), sr)).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, key + '.npy')
+        if os.path.isfile(cache_file):
+            try:
+                audio = np.load(cache_file)
+                # The modification time is the last use, see evict_audio_cache
+                os.utime(cache_file)
+                return (audio[0] if audio.shape[0] == 1 else audio), sr
+            except Exception as e:
+                logger.warning('Cannot read cached audio {}: {}'.format(cache_file, e))
+
+    audio = decode(path, sr)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written to a temporary file first, so a concurrent reader never sees a partial file
+        tmp_file = cache_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, audio)
+        os.replace(tmp_file, cache_file)
+        evict_audio_cache(cache_dir, int(cache_size * 1024 * 1024), cache_age * 86400)
+
+    return (audio[0] if audio.shape[0] == 1 else audio), sr
+
+
+def write_audio(path, audio, sr, bit_depth='16', ffmpeg='ffmpeg'):
+    """
+    Writes float audio (samples, channels) to path, in the format of its extension.
+
+    WAV, FLAC and AIFF are written by soundfile at bit_depth ('16', '24' or '32f'; FLAC has no float samples and
+    is written at 24 bits for '32f'). Other formats are encoded by ffmpeg, which reads the float32 samples from
+    its stdin, so nothing is converted to int16 or written to a temporary file first. Raises RuntimeError if
+    ffmpeg fails.
+    """
+    if bit_depth not in BIT_DEPTHS:
+        raise ValueError('Unknown bit depth {}, one of {}'.format(bit_depth, ', '.join(BIT_DEPTHS)))
+    extension = os.path.splitext(path)[1][1:].lower()
+
+    if extension in SOUNDFILE_EXTENSIONS:
+        subtype = BIT_DEPTHS[bit_depth]
+        if extension == 'flac' and subtype == 'FLOAT':
+            subtype = 'PCM_24'
+        sf.write(path, audio, sr, subtype=subtype)
+        return
+
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    channels = audio.shape[1] if audio.ndim == 2 else 1
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'f32le', '-ar', str(sr), '-ac', str(channels), '-i', 'pipe:0']
+    if extension in FFMPEG_FORMATS:
+        command += ['-f', FFMPEG_FORMATS[extension]]
+    command.append(path)
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # The array's own buffer is written to the pipe, without a bytes copy
+    _, stderr = process.communicate(memoryview(audio).cast('B'))
+    if process.returncode != 0:
+        raise RuntimeError('ffmpeg failed to write {}: {}'.format(path, stderr.decode(errors='replace').strip()))
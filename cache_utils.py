@@ -0,0 +1,13 @@
+"""
+Helpers shared by the caches (model_cache, result_cache, the decoded audio cache of audio_io). Kept free of torch,
+so that audio loading does not import it.
+"""
+
+import os
+
+
+def file_signature(path):
+    """(absolute path, size, mtime) of a file, used in cache keys so that replaced checkpoints are reloaded."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
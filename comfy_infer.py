@@ -10,16 +10,14 @@ import soundfile as sf
 import torch
 import numpy as np
 import time
-import math
 import audioread
 from tqdm import tqdm
 import json
 from utils import demix, get_model_from_config
+import audio_io
 from models.vocal_remover.separator import Separator
 from models.vocal_remover.vr_separator import VRSeparator
 from models.vocal_remover.uvr_lib_v5 import spec_utils
-from models.vocal_remover.uvr_lib_v5.vr_network import nets
-from models.vocal_remover.uvr_lib_v5.vr_network import nets_new
 
 logger = logging.getLogger(__name__)
 log_handler = logging.StreamHandler()
@@ -32,7 +30,7 @@ logger.setLevel(log_level)
 
 def load_audio(audio_file: str):
     try:
-        audio, sr = librosa.load(audio_file, sr=44100, mono=False)
+        audio, sr = audio_io.load_audio(audio_file, sr=44100)
     except Exception as e:
         raise AssertionError(f'Cannot read track: {audio_file}, error message: {str(e)}')
     return audio, sr
@@ -143,30 +141,9 @@ class ComfyMSST:
             std = mono.std()
             mix = (mix - mean) / std
 
-        if self.use_tta:
-            track_proc_list = [mix.copy(), mix[::-1].copy(), -1. * mix.copy()]
-        else:
-            track_proc_list = [mix.copy()]
-
-        full_result = []
         logger.info("Start demixing...")
-        for mix in track_proc_list:
-            waveforms = demix(self.config, self.model, mix, self.device, pbar=True, model_type=self.model_type)
-            logger.info("Demixing completed.")
-            full_result.append(waveforms)
-
-        waveforms = full_result[0]
-        for i in range(1, len(full_result)):
-            d = full_result[i]
-            for el in d:
-                if i == 2:
-                    waveforms[el] += -1.0 * d[el]
-                elif i == 1:
-                    waveforms[el] += d[el][::-1].copy()
-                else:
-                    waveforms[el] += d[el]
-        for el in waveforms:
-            waveforms[el] = waveforms[el] / len(full_result)
+        waveforms = demix(self.config, self.model, mix, self.device, pbar=True, model_type=self.model_type, use_tta=self.use_tta)
+        logger.info("Demixing completed.")
 
         results = {}
         logger.info(f"instruments: {instruments}")
@@ -315,22 +292,7 @@ class ComfyVRSeparator(VRSeparator):
             self.audio_file_path = audio_file_path
             self.audio_file_base = "numpy_array"
 
-        nn_arch_sizes = [31191, 33966, 56817, 123821, 123812, 129605, 218409, 537238, 537227]
-        vr_5_1_models = [56817, 218409]
-        model_size = math.ceil(os.stat(self.model_path).st_size / 1024)
-        nn_arch_size = min(nn_arch_sizes, key=lambda x: abs(x - model_size))
-
-        if nn_arch_size in vr_5_1_models or self.is_vr_51_model:
-            self.logger.debug("Using CascadedNet for VR 5.1 model...")
-            self.model_run = nets_new.CascadedNet(self.model_params.param["bins"] * 2, nn_arch_size, nout=self.model_capacity[0], nout_lstm=self.model_capacity[1])
-            self.is_vr_51_model = True
-        else:
-            self.logger.debug("Determining model capacity...")
-            self.model_run = nets.determine_model_capacity(self.model_params.param["bins"] * 2, nn_arch_size)
-
-        self.model_run.load_state_dict(torch.load(self.model_path, map_location=self.torch_device_cpu))
-        self.model_run.to(self.torch_device)
-        self.logger.debug("Model loaded and moved to device.")
+        self.load_model_run()
 
         y_spec, v_spec = self.inference_vr(self.loading_mix(), self.torch_device, self.aggressiveness)
         self.logger.debug("Inference completed.")
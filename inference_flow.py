@@ -0,0 +1,342 @@
+"""
+Runs an inference flow (a preset of chained models, see the WebUI "inference flow" tab) in one process.
+
+Running every step as its own msst_inference.py / uvr_inference.py job meant writing all intermediate stems
+to disk and decoding them again in the next step. Here each input file goes through all the steps in memory:
+the stems of a step are handed to the next ones as float32 arrays, only the final outputs and the secondary
+outputs are written. Models come from model_cache, so each one is loaded once per flow, and once per server
+lifetime when the flow runs in inference_server.py.
+
+The flow is described by a JSON file, which the WebUI builds from a preset:
+
+    {
+        "input_folder": "input",
+        "store_dir": "results",
+        "output_format": "wav",
+        "force_cpu": false,
+        "steps": [
+            {"name": "Step_1", "type": "msst", "model_type": "bs_roformer", "config_path": "...", "start_check_point": "...",
+             "device_ids": [0], "use_tta": false, "secondary_output": false},
+            {"name": "Step_2", "inputs": ["Step_1:vocals"], "type": "vr", "model_filename": "...",
+             "model_file_dir": "pretrain/VR_Models", "stem": "Vocals", "device_ids": [1], "secondary_output": true,
+             "normalization": 0.9, "invert_spect": false, "debug": false,
+             "vr_params": {"batch_size": 2, "window_size": 512, "aggression": 5, "enable_tta": false,
+                           "enable_post_process": false, "post_process_threshold": 0.2, "high_end_process": false}},
+            {"name": "Step_3", "inputs": ["Step_1:vocals"], "type": "msst", ...},
+            {"name": "Step_4", "inputs": ["Step_2", "Step_3"], "type": "ensemble", "ensemble_mode": "avg_wave",
+             "weights": [1, 1], "stem": "vocals"}
+        ]
+    }
+
+The steps form a graph: "inputs" lists the steps a step takes its stems from, "Step_1" for all the stems passed
+on by Step_1, "Step_1:vocals" for one of them, "input" for the input file. A step without "inputs" takes the
+stems of the step before it (the input file for the first step), so a plain list of steps is a linear chain.
+MSST steps pass on all their instruments, VR steps the selected stem, ensemble steps one stem combining all
+their inputs (see ensemble.average_waveforms). A step runs as soon as the steps it depends on are done, so
+independent branches run at the same time when they are on different devices (device_ids): by default one step
+runs at a time on each device, so two models never share the memory of a GPU. "max_parallel_steps" replaces that
+with a single limit for all devices. A step used by several others runs once, its stems are shared.
+
+The stems of the steps no other step uses are written to store_dir, "save": true writes them for any step.
+The secondary outputs of every step (extracted instrumental, other VR stem) are written to store_dir/secondary_output.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import logging
+import torch
+import numpy as np
+import soundfile as sf
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+from utils import demix_tracks
+from audio_io import load_audio
+from ensemble import average_waveforms
+from msst_inference import load_model, get_device, prepare_track, get_extract_instrumental, get_stems, get_output_file
+from models.vocal_remover.separator import Separator
+from models.vocal_remover.uvr_lib_v5 import spec_utils
+
+logger = logging.getLogger(__name__)
+
+SECONDARY_OUTPUT = "secondary_output"
+INPUT = "input"
+
+
+def save_stem(store_dir, output_format, name, stem_name, stem, secondary=False):
+    store_dir = os.path.join(store_dir, SECONDARY_OUTPUT) if secondary else store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    output_file, kwargs = get_output_file(output_format, store_dir, name, stem_name)
+    sf.write(output_file, stem.T, 44100, **kwargs)
+
+
+class MSSTStep:
+    def __init__(self, step, store_dir, output_format, force_cpu):
+        self.model_type = step["model_type"]
+        self.config_path = step["config_path"]
+        self.start_check_point = step.get("start_check_point", "")
+        self.device = get_device(force_cpu, step.get("device_ids", 0))
+        self.use_tta = step.get("use_tta", False)
+        self.secondary_output = step.get("secondary_output", False)
+        self.store_dir = store_dir
+        self.output_format = output_format
+
+    def run(self, tracks):
+        """
+        Separates tracks, a list of (name, mix) with (channels, samples) mixes at 44100 Hz.
+        Returns the stems for the next step as (name, stem name, (channels, samples) stem), writes the secondary outputs.
+        """
+        model, config = load_model(self.model_type, self.config_path, self.start_check_point, self.device)
+        model.eval()
+        instruments = config.training.instruments.copy()
+        if config.training.target_instrument is not None:
+            instruments = [config.training.target_instrument]
+        extract_instrumental = get_extract_instrumental(self.secondary_output, config, instruments)
+
+        tracks = [prepare_track(name, mix, 44100, config) for name, mix in tracks]
+        outputs = []
+        for track, waveforms in demix_tracks(config, model, ((track, track['mix']) for track in tracks), self.device, model_type=self.model_type, use_tta=self.use_tta):
+            stems = get_stems(config, track, waveforms, instruments, extract_instrumental)
+            if extract_instrumental is not None:
+                self.save(track['path'], extract_instrumental, stems[extract_instrumental].T, secondary=True)
+            outputs += [(track['path'], instr, stems[instr].T) for instr in instruments]
+        return outputs
+
+    def save(self, name, stem_name, stem, secondary=False):
+        save_stem(self.store_dir, self.output_format, name, stem_name, stem, secondary)
+
+
+class VRStep:
+    def __init__(self, step, store_dir, output_format, force_cpu):
+        self.stem = step["stem"]
+        self.separator = Separator(
+            log_level=logging.DEBUG if step.get("debug", False) else logging.INFO,
+            model_file_dir=step.get("model_file_dir", "pretrain/VR_Models"),
+            output_dir=store_dir,
+            extra_output_dir=os.path.join(store_dir, SECONDARY_OUTPUT),
+            output_format=output_format,
+            normalization_threshold=step.get("normalization", 0.9),
+            output_single_stem=self.stem,
+            invert_using_spec=step.get("invert_spect", False),
+            use_cpu=force_cpu,
+            save_another_stem=step.get("secondary_output", False),
+            vr_params=step.get("vr_params", {"batch_size": 2, "window_size": 512, "aggression": 5, "enable_tta": False, "enable_post_process": False, "post_process_threshold": 0.2, "high_end_process": False}),
+        )
+        self.separator.load_model(model_filename=step["model_filename"])
+        self.model_instance = self.separator.model_instance
+        if self.model_instance.torch_device.type == "cuda" and "device_ids" in step:
+            device_ids = step["device_ids"] if type(step["device_ids"]) == list else [step["device_ids"]]
+            self.model_instance.torch_device = torch.device(f"cuda:{device_ids[0]}")
+        self.device = self.model_instance.torch_device
+
+    def run(self, tracks):
+        """Same as MSSTStep.run, only the selected stem is passed on."""
+        outputs = []
+        for name, mix in tracks:
+            sources = self.model_instance.separate_array(mix.T, name)
+            for stem_name, source in sources.items():
+                if stem_name.lower() != self.stem.lower():
+                    self.save(name, stem_name, source.T, secondary=True)
+                    continue
+                # Same normalization and silence check as write_audio, a near-silent stem would not have been written
+                source = spec_utils.normalize(wave=source, max_peak=self.model_instance.normalization_threshold)
+                if np.max(np.abs(source)) < 1e-6:
+                    logger.warning(f"{name}_{stem_name} is near-silent, it is not passed to the next step")
+                    continue
+                outputs.append((name, stem_name, source.T))
+        self.model_instance.clear_gpu_cache()
+        return outputs
+
+    def save(self, name, stem_name, stem, secondary=False):
+        self.model_instance.write_audio(f"{name}_{stem_name}.{self.model_instance.output_format.lower()}", stem.T, extra=secondary)
+
+
+class EnsembleStep:
+    def __init__(self, step, store_dir, output_format, force_cpu):
+        self.ensemble_mode = step.get("ensemble_mode", "avg_wave")
+        self.weights = step.get("weights")
+        self.stem = step.get("stem", "ensemble")
+        self.device = "cpu"
+        self.store_dir = store_dir
+        self.output_format = output_format
+
+    def run(self, tracks):
+        """Combines all the input stems into one, named after the common part of the input names."""
+        weights = self.weights if self.weights is not None else np.ones(len(tracks))
+        if len(weights) != len(tracks):
+            raise ValueError(f"Ensemble got {len(tracks)} stems but {len(weights)} weights")
+        length = min(mix.shape[-1] for _, mix in tracks)
+        result = average_waveforms(np.array([mix[..., :length] for _, mix in tracks]), weights, self.ensemble_mode)
+        name = os.path.commonprefix([name for name, _ in tracks]).rstrip("_") or tracks[0][0]
+        return [(name, self.stem, result.astype(np.float32))]
+
+    def save(self, name, stem_name, stem, secondary=False):
+        save_stem(self.store_dir, self.output_format, name, stem_name, stem, secondary)
+
+
+STEP_TYPES = {
+    "msst": MSSTStep,
+    "vr": VRStep,
+    "ensemble": EnsembleStep,
+}
+
+
+def build_graph(flow_steps):
+    """
+    Returns the step names in a topological order and the inputs of every step as (step name, stem or None) pairs.
+    Raises ValueError for unknown inputs and cycles.
+    """
+    inputs = {}
+    previous = INPUT
+    for i, step in enumerate(flow_steps):
+        name = step.get("name", f"Step_{i + 1}")
+        if name in inputs or name == INPUT:
+            raise ValueError(f"Duplicate step name: {name}")
+        refs = step.get("inputs", [previous])
+        if isinstance(refs, str):
+            refs = [refs]
+        inputs[name] = [tuple(ref.split(":", 1)) if ":" in ref else (ref, None) for ref in refs]
+        previous = name
+    for name, refs in inputs.items():
+        for source, _ in refs:
+            if source != INPUT and source not in inputs:
+                raise ValueError(f"Step {name} takes its input from unknown step {source}")
+
+    # Kahn's algorithm
+    order = []
+    waiting = {name: set(source for source, _ in refs if source != INPUT) for name, refs in inputs.items()}
+    while waiting:
+        ready = [name for name, deps in waiting.items() if not deps]
+        if not ready:
+            raise ValueError("The flow has a cycle between steps: {}".format(", ".join(waiting)))
+        for name in ready:
+            del waiting[name]
+            order.append(name)
+        for deps in waiting.values():
+            deps.difference_update(ready)
+    return order, inputs
+
+
+def get_executors(steps, max_parallel_steps=None):
+    """
+    Executor of every step: one worker per device, shared by the steps on that device, or with max_parallel_steps
+    a single executor with that many workers for all of them.
+    """
+    if max_parallel_steps is not None:
+        executor = ThreadPoolExecutor(max_workers=max_parallel_steps)
+        return {name: executor for name in steps}
+    devices = {}
+    for step in steps.values():
+        devices.setdefault(str(step.device), ThreadPoolExecutor(max_workers=1))
+    return {name: devices[str(step.device)] for name, step in steps.items()}
+
+
+def run_graph(steps, inputs, saved, executors, base_name, mix):
+    """
+    Runs all the steps on one input file. Steps are submitted to their executor as soon as the steps they depend
+    on are done, the stems of a step are dropped once all the steps using them have started.
+    """
+    def collect(refs):
+        tracks = []
+        for source, stem in refs:
+            if source == INPUT:
+                tracks.append((base_name, mix))
+                continue
+            for name, stem_name, output in results[source]:
+                if stem is None or stem_name.lower() == stem.lower():
+                    tracks.append((f"{name}_{stem_name}", output))
+        return tracks
+
+    def run_step(name, tracks):
+        if not tracks:
+            logger.warning(f"{name} has no input for {base_name}, skipping it")
+            return []
+        outputs = steps[name].run(tracks)
+        if name in saved:
+            for output in outputs:
+                steps[name].save(*output)
+        return outputs
+
+    results = {}
+    waiting = {name: set(source for source, _ in refs if source != INPUT) for name, refs in inputs.items()}
+    users = {name: sum(1 for refs in inputs.values() if any(source == name for source, _ in refs)) for name in inputs}
+    running = {}
+    while waiting or running:
+        for name in [name for name, deps in waiting.items() if not deps]:
+            del waiting[name]
+            running[executors[name].submit(run_step, name, collect(inputs[name]))] = name
+            for source in set(source for source, _ in inputs[name] if source != INPUT):
+                users[source] -= 1
+                if users[source] == 0:
+                    del results[source]
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            outputs = future.result()
+            if users[name] > 0:
+                results[name] = outputs
+            for deps in waiting.values():
+                deps.discard(name)
+
+
+def run_flow(flow):
+    start_time = time.time()
+    store_dir = flow["store_dir"]
+    os.makedirs(store_dir, exist_ok=True)
+    output_format = flow.get("output_format", "wav")
+    force_cpu = flow.get("force_cpu", False)
+    if not flow["steps"]:
+        raise ValueError("The flow has no steps")
+    order, inputs = build_graph(flow["steps"])
+    steps = {name: STEP_TYPES[step["type"]](step, store_dir, output_format, force_cpu) for name, step in zip(inputs, flow["steps"])}
+    # Final outputs: stems no other step uses, and the steps asking for it
+    saved = set(name for name, step in zip(inputs, flow["steps"]) if step.get("save", False))
+    saved.update(name for name in order if not any(source == name for refs in inputs.values() for source, _ in refs))
+    logger.info("Steps: {}".format(", ".join(order)))
+
+    all_mixtures_path = sorted(glob.glob(os.path.join(flow["input_folder"], "*.*")))
+    logger.info('Total files found: {}'.format(len(all_mixtures_path)))
+
+    progress_bar = tqdm(all_mixtures_path, desc="Total progress")
+    executors = get_executors(steps, flow.get("max_parallel_steps"))
+    try:
+        for path in progress_bar:
+            progress_bar.set_postfix({'track': os.path.basename(path)})
+            try:
+                mix, _ = load_audio(path, sr=44100)
+            except Exception as e:
+                logger.warning('Cannot read track: {}'.format(path))
+                logger.warning('Error message: {}'.format(str(e)))
+                continue
+            if len(mix.shape) == 1:
+                mix = np.stack([mix, mix], axis=0)
+            run_graph(steps, inputs, saved, executors, os.path.splitext(os.path.basename(path))[0], mix)
+    finally:
+        for executor in set(executors.values()):
+            executor.shutdown()
+
+    logger.info("Elapsed time: {:.2f} sec".format(time.time() - start_time))
+    logger.info('Results are saved to: {}'.format(store_dir))
+
+
+def proc_flow(args):
+    parser = argparse.ArgumentParser(description="Run an inference flow with intermediate stems kept in memory.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--flow", type=str, required=True, help="path to the JSON flow description, see the top of inference_flow.py")
+
+    if args is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(args)
+
+    with open(args.flow, 'r', encoding='utf-8') as f:
+        flow = json.load(f)
+    run_flow(flow)
+
+
+if __name__ == "__main__":
+    proc_flow(None)
@@ -0,0 +1,252 @@
+"""
+Long-lived separation worker.
+
+Every WebUI action used to spawn a fresh msst_inference.py / uvr_inference.py process, paying again for the
+torch import, CUDA context setup and model loading. This module keeps one worker process alive between jobs.
+Jobs are sent over a local authenticated socket (multiprocessing.connection) and the worker replies with
+events while the job runs:
+
+    {"event": "log", "level": "INFO", "message": "..."}   # only if the job asked for streamed logs
+    {"event": "done", "elapsed": 12.3}
+    {"event": "error", "message": "<traceback>"}
+
+Run standalone with `python inference_server.py --port 27100`, or let SeparationClient start it on demand.
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import logging
+import traceback
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+log_format = "%(asctime)s.%(msecs)03d [%(levelname)s] %(module)s - %(message)s"
+date_format = "%H:%M:%S"
+logger = logging.getLogger(__name__)
+
+AUTHKEY_ENV = "MSST_SERVER_AUTHKEY"
+
+
+def run_msst(args):
+    from msst_inference import proc_folder
+    proc_folder(args)
+
+
+def run_vr(args):
+    import uvr_inference
+    parser = uvr_inference.get_parser()
+    uvr_inference.inference(parser, parser.parse_args(args))
+
+
+def run_flow(args):
+    from inference_flow import proc_flow
+    proc_flow(args)
+
+
+def run_ensemble(args):
+    from ensemble import ensemble_files
+    ensemble_files(args)
+
+
+# Task name -> callable taking the same argv list as the corresponding command line script
+TASKS = {
+    "msst": run_msst,
+    "vr": run_vr,
+    "flow": run_flow,
+    "ensemble": run_ensemble,
+}
+
+
+class ConnectionLogHandler(logging.Handler):
+    """Forwards log records of the running job to the client."""
+
+    def __init__(self, conn, level=logging.INFO):
+        super().__init__(level=level)
+        self.conn = conn
+
+    def emit(self, record):
+        try:
+            self.conn.send({"event": "log", "level": record.levelname, "message": self.format(record)})
+        except Exception:
+            self.handleError(record)
+
+
+def handle_job(conn, job):
+    task = TASKS.get(job.get("task"))
+    if task is None:
+        conn.send({"event": "error", "message": "Unknown task: {}".format(job.get("task"))})
+        return
+
+    root_logger = logging.getLogger()
+    handler = None
+    if job.get("stream_logs", False):
+        handler = ConnectionLogHandler(conn)
+        handler.setFormatter(logging.Formatter(fmt=log_format, datefmt=date_format))
+        root_logger.addHandler(handler)
+
+    start_time = time.time()
+    try:
+        task(job.get("args", []))
+        conn.send({"event": "done", "elapsed": time.time() - start_time})
+    except SystemExit as e:
+        # argparse and some scripts call exit() on bad input, this must not kill the worker
+        conn.send({"event": "error", "message": "Task exited with code {}".format(e.code)})
+    except Exception:
+        conn.send({"event": "error", "message": traceback.format_exc()})
+    finally:
+        if handler is not None:
+            root_logger.removeHandler(handler)
+
+
+def serve(host, port, authkey):
+    with Listener((host, port), authkey=authkey) as listener:
+        logger.info("Separation server listening on {}:{}".format(host, port))
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        job = conn.recv()
+                    except (EOFError, OSError):
+                        break
+                    if job.get("task") == "shutdown":
+                        conn.send({"event": "done", "elapsed": 0.0})
+                        logger.info("Separation server shutting down")
+                        return
+                    handle_job(conn, job)
+
+
+def find_free_port(host="127.0.0.1"):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+class SeparationClient:
+    """
+    Starts the separation server on demand and runs jobs on it.
+
+    The server is a child process of the client. If it dies (crash, or terminate() to cancel a job)
+    the next call to run() starts a new one.
+    """
+
+    def __init__(self, python=sys.executable, host="127.0.0.1", port=None, model_cache_size=None, startup_timeout=120):
+        self.python = python
+        self.host = host
+        self.port = port
+        self.model_cache_size = model_cache_size
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.conn = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None and self.conn is not None
+
+    def start(self):
+        if self.is_alive():
+            return
+        self.terminate()
+
+        port = self.port if self.port else find_free_port(self.host)
+        authkey = os.urandom(16)
+        env = os.environ.copy()
+        env[AUTHKEY_ENV] = authkey.hex()
+        command = [self.python, os.path.join(current_dir, "inference_server.py"), "--host", self.host, "--port", str(port)]
+        if self.model_cache_size is not None:
+            command += ["--model_cache_size", str(self.model_cache_size)]
+        self.process = subprocess.Popen(command, env=env)
+
+        deadline = time.time() + self.startup_timeout
+        while True:
+            try:
+                self.conn = Client((self.host, port), authkey=authkey)
+                return
+            except ConnectionRefusedError:
+                if self.process.poll() is not None:
+                    self.process = None
+                    raise RuntimeError("Separation server exited during startup")
+                if time.time() > deadline:
+                    self.terminate()
+                    raise RuntimeError("Separation server did not start within {} seconds".format(self.startup_timeout))
+                time.sleep(0.2)
+
+    def run(self, task, args, on_event=None, should_stop=None):
+        """
+        Runs a job and blocks until it finishes.
+
+        Args:
+            task (str): One of TASKS.
+            args (list): Command line arguments for the task, as passed to the corresponding script.
+            on_event (callable, optional): Called with every event dict, enables streamed logs.
+            should_stop (callable, optional): Polled while waiting. If it returns True the server is terminated.
+
+        Returns:
+            bool: True if the job finished, False if it was stopped.
+        """
+        self.start()
+        self.conn.send({"task": task, "args": [str(arg) for arg in args], "stream_logs": on_event is not None})
+        while True:
+            if should_stop is not None and should_stop():
+                self.terminate()
+                return False
+            if not self.conn.poll(0.1):
+                if self.process.poll() is not None:
+                    self.terminate()
+                    raise RuntimeError("Separation server exited unexpectedly")
+                continue
+            event = self.conn.recv()
+            if on_event is not None:
+                on_event(event)
+            if event["event"] == "done":
+                return True
+            if event["event"] == "error":
+                raise RuntimeError(event["message"])
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.conn.send({"task": "shutdown"})
+                self.conn.recv()
+                self.process.wait(timeout=10)
+            except Exception:
+                pass
+        self.terminate()
+
+    def terminate(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+            self.conn = None
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+            self.process = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-lived separation worker.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=27100, help="port to listen on")
+    parser.add_argument("--model_cache_size", type=float, default=None, help="memory budget in MB for models kept loaded between jobs. If not provided, MSST_MODEL_CACHE_MB or 4096 is used")
+    parser.add_argument("--authkey", type=str, default=None, help="hex encoded authentication key. If not provided, the {} environment variable is used".format(AUTHKEY_ENV))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=log_format, datefmt=date_format)
+    authkey = args.authkey if args.authkey else os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        parser.error("an authentication key is required, pass --authkey or set {}".format(AUTHKEY_ENV))
+    if args.model_cache_size is not None:
+        from model_cache import model_cache
+        model_cache.set_budget(int(args.model_cache_size * 1024 * 1024))
+    serve(args.host, args.port, bytes.fromhex(authkey))
@@ -0,0 +1,128 @@
+"""
+Process wide LRU cache of instantiated, device placed models.
+
+msst_inference.proc_folder and VRSeparator used to build the network and torch.load the checkpoint on every run
+(VRSeparator even once per file). In a long-lived process (see inference_server.py) this cache keeps the most
+recently used models ready, as long as their parameters and buffers fit in the memory budget.
+
+The budget is read from the MSST_MODEL_CACHE_MB environment variable (default 4096 MB) and can be changed at
+runtime with model_cache.set_budget(). A budget of 0 disables caching.
+"""
+
+import gc
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+from cache_utils import file_signature
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET_MB = 4096
+
+
+def _state_tensors(value):
+    """Tensors of a state_dict value. The packed weights of quantized layers are tuples or script objects."""
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _state_tensors(item)
+    elif isinstance(value, torch._C.ScriptObject):
+        try:
+            state = value.__getstate__()
+        except Exception:
+            return
+        yield from _state_tensors(state)
+
+
+def module_nbytes(module):
+    """
+    Memory held by the parameters and buffers of a module, in bytes. Counted from its state_dict, so that the int8
+    weights of dynamically quantized layers (utils.quantize_model), which are neither, are included.
+    """
+    nbytes = 0
+    seen = set()
+    tensors = list(module.parameters()) + list(module.buffers())
+    for value in module.state_dict(keep_vars=True).values():
+        tensors.extend(_state_tensors(value))
+    for tensor in tensors:
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if key in seen:
+            continue
+        seen.add(key)
+        nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+class ModelCache:
+    """
+    Least recently used cache of models.
+
+    Values are stored as given (e.g. a model, or a (model, config) tuple), the size of an entry is
+    passed to put() by the caller. Entries are evicted, least recently used first, until the total size
+    fits in the budget. The entry just inserted is never evicted, so a single model larger than the
+    budget is still kept until the next one replaces it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            logger.debug("Model cache hit: {}".format(key))
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if self.max_bytes <= 0:
+                return
+            self._entries[key] = (value, nbytes)
+            self._entries.move_to_end(key)
+            self._evict(keep=key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._release_memory()
+
+    def _evict(self, keep=None):
+        evicted = False
+        while self._entries and self.total_bytes > self.max_bytes:
+            key = next(iter(self._entries))
+            if key == keep:
+                break
+            del self._entries[key]
+            evicted = True
+            logger.debug("Model cache evicted: {}".format(key))
+        if self.max_bytes <= 0 and self._entries:
+            self._entries.clear()
+            evicted = True
+        if evicted:
+            self._release_memory()
+
+    @staticmethod
+    def _release_memory():
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+model_cache = ModelCache(int(float(os.environ.get("MSST_MODEL_CACHE_MB", DEFAULT_BUDGET_MB)) * 1024 * 1024))
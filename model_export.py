@@ -0,0 +1,315 @@
+"""
+Exports separation models to ONNX or TorchScript, and runs the exported files in place of the PyTorch model.
+
+Only the network is exported. STFT and iSTFT are left out of the graph, ONNX has no complete equivalent of
+torch.stft / torch.istft. They are done around it by ExportedModel, from the parameters saved next to the
+exported file (<output>.json). The network sees spectrogram chunks of the config's audio.chunk_size, the batch
+size stays free. Supported model types: bs_roformer, mel_band_roformer, mdx23c.
+
+ExportedModel is called like the model, so demix and msst_inference.py use it unchanged
+(msst_inference.py --exported_model). With ONNX Runtime on CPU neither the model source tree nor the eager
+model is needed. Example:
+
+    python model_export.py --model_type bs_roformer --config_path configs/vocal_models/model_bs_roformer_ep_317_sdr_12.9755.yaml --start_check_point pretrain/vocal_models/model_bs_roformer_ep_317_sdr_12.9755.ckpt --output pretrain/exported/bs_roformer_ep_317.onnx
+    python msst_inference.py --model_type bs_roformer --config_path configs/vocal_models/model_bs_roformer_ep_317_sdr_12.9755.yaml --exported_model pretrain/exported/bs_roformer_ep_317.onnx --input_folder input --store_dir results --force_cpu
+"""
+
+import os
+import sys
+import json
+import argparse
+import logging
+
+import torch
+import torch.nn as nn
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('onnx', 'torchscript')
+EXPORT_MODEL_TYPES = ('bs_roformer', 'mel_band_roformer', 'mdx23c')
+ONNX_OPSET = 17
+
+
+class RoformerCore(nn.Module):
+    """
+    BSRoformer / MelBandRoformer forward between torch.stft and the mask multiplication. Input: the real
+    spectrogram (b, f * s, t, 2), output: the real mask (b, n, f * s, t, 2). For MelBandRoformer the mask of
+    the frequencies shared by several bands is already averaged.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, stft_repr):
+        from einops import rearrange, pack, unpack
+
+        model = self.model
+        mel = hasattr(model, 'freq_indices')
+        x = stft_repr[:, model.freq_indices] if mel else stft_repr
+        x = rearrange(x, 'b f t c -> b t (f c)')
+        x = model.band_split(x)
+
+        for transformer_block in model.layers:
+            if len(transformer_block) == 3:
+                linear_transformer, time_transformer, freq_transformer = transformer_block
+                x, ft_ps = pack([x], 'b * d')
+                x = linear_transformer(x)
+                x, = unpack(x, ft_ps, 'b * d')
+            else:
+                time_transformer, freq_transformer = transformer_block
+
+            x = rearrange(x, 'b t f d -> b f t d')
+            x, ps = pack([x], '* t d')
+            x = time_transformer(x)
+            x, = unpack(x, ps, '* t d')
+            x = rearrange(x, 'b f t d -> b t f d')
+            x, ps = pack([x], '* f d')
+            x = freq_transformer(x)
+            x, = unpack(x, ps, '* f d')
+
+        if hasattr(model, 'final_norm'):
+            x = model.final_norm(x)
+
+        mask = torch.stack([fn(x) for fn in model.mask_estimators], dim=1)
+        mask = rearrange(mask, 'b n t (f c) -> b n f t c', c=2)
+        if not mel:
+            return mask
+
+        # Same averaging as MelBandRoformer.forward, on the real and imaginary parts
+        indices = model.freq_indices.view(1, 1, -1, 1, 1).expand_as(mask)
+        summed = mask.new_zeros(mask.shape[:2] + stft_repr.shape[1:]).scatter_add(2, indices, mask)
+        denom = model.num_bands_per_freq.repeat_interleave(model.audio_channels).view(-1, 1, 1)
+        return summed / denom.clamp(min=1e-8)
+
+
+class MDX23CCore(nn.Module):
+    """TFC_TDF_net forward between its STFT and its inverse: (b, c * 2, dim_f, t) -> (b, [n,] c * 2, dim_f, t)."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        model = self.model
+        mix = x = model.cac2cws(x)
+        first_conv_out = x = model.first_conv(x)
+        x = x.transpose(-1, -2)
+
+        encoder_outputs = []
+        for block in model.encoder_blocks:
+            x = block.tfc_tdf(x)
+            encoder_outputs.append(x)
+            x = block.downscale(x)
+
+        x = model.bottleneck_block(x)
+
+        for block in model.decoder_blocks:
+            x = block.upscale(x)
+            x = torch.cat([x, encoder_outputs.pop()], 1)
+            x = block.tfc_tdf(x)
+
+        x = x.transpose(-1, -2)
+        x = x * first_conv_out
+        x = model.final_conv(torch.cat([mix, x], 1))
+        x = model.cws2cac(x)
+
+        if model.num_target_instruments > 1:
+            b, c, f, t = x.shape
+            x = x.reshape(b, model.num_target_instruments, -1, f, t)
+        return x
+
+
+def spectral_params(model_type, model, config):
+    """STFT parameters ExportedModel needs to run the graph, saved as <output>.json."""
+    params = {'model_type': model_type, 'chunk_size': int(config.audio.chunk_size)}
+    if model_type == 'mdx23c':
+        params.update(
+            layout='mdx23c',
+            n_fft=model.stft.n_fft,
+            hop_length=model.stft.hop_length,
+            win_length=model.stft.n_fft,
+            normalized=False,
+            dim_f=model.stft.dim_f,
+            channels=int(config.audio.num_channels),
+        )
+    else:
+        params.update(
+            layout='roformer',
+            n_fft=model.stft_kwargs['n_fft'],
+            hop_length=model.stft_kwargs['hop_length'],
+            win_length=model.stft_kwargs['win_length'],
+            normalized=bool(model.stft_kwargs['normalized']),
+            channels=model.audio_channels,
+            num_stems=len(model.mask_estimators),
+            # MelBandRoformer only matches the input length with match_input_audio_length
+            match_length=bool(getattr(model, 'match_input_audio_length', True)),
+        )
+    return params
+
+
+def stft(audio, params):
+    """Spectrogram of a (b, channels, samples) batch in the layout the exported graph takes."""
+    batch, channels, length = audio.shape
+    window = torch.hann_window(params['win_length'], device=audio.device)
+    spec = torch.stft(audio.reshape(-1, length), n_fft=params['n_fft'], hop_length=params['hop_length'],
+                      win_length=params['win_length'], normalized=params['normalized'], window=window,
+                      center=True, return_complex=True)
+    spec = torch.view_as_real(spec)
+    frames = spec.shape[-2]
+    if params['layout'] == 'mdx23c':
+        spec = spec.permute(0, 3, 1, 2).reshape(batch, channels * 2, -1, frames)
+        return spec[..., :params['dim_f'], :].contiguous()
+    # 'b s f t c -> b (f s) t c'
+    spec = spec.reshape(batch, channels, -1, frames, 2).transpose(1, 2)
+    return spec.reshape(batch, -1, frames, 2).contiguous()
+
+
+def istft(spec, out, length, params):
+    """Waveforms from the graph output, shaped like the output of the PyTorch model."""
+    window = torch.hann_window(params['win_length'], device=out.device)
+    istft_kwargs = dict(n_fft=params['n_fft'], hop_length=params['hop_length'], win_length=params['win_length'],
+                        normalized=params['normalized'], window=window, center=True)
+    if params['layout'] == 'mdx23c':
+        batch_dims = out.shape[:-3]
+        c, f, t = out.shape[-3:]
+        n = params['n_fft'] // 2 + 1
+        out = torch.cat([out, out.new_zeros((*batch_dims, c, n - f, t))], -2)
+        out = out.reshape(-1, 2, n, t).permute(0, 2, 3, 1)
+        audio = torch.istft(torch.complex(out[..., 0].contiguous(), out[..., 1].contiguous()), **istft_kwargs)
+        return audio.reshape(*batch_dims, 2, -1)
+
+    batch, stems, channels = out.shape[0], out.shape[1], params['channels']
+    spec = torch.view_as_complex(spec.float().contiguous()).unsqueeze(1) * torch.view_as_complex(out.float().contiguous())
+    # 'b n (f s) t -> (b n s) f t'
+    spec = spec.reshape(batch, stems, -1, channels, spec.shape[-1]).transpose(2, 3)
+    spec = spec.reshape(batch * stems * channels, -1, spec.shape[-1])
+    audio = torch.istft(spec, **istft_kwargs, length=length if params['match_length'] else None)
+    audio = audio.reshape(batch, stems, channels, -1)
+    return audio[:, 0] if params['num_stems'] == 1 else audio
+
+
+def export_model(model_type, config_path, start_check_point, output, export_format='onnx', batch_size=None):
+    """
+    Exports the network of a model to output (.onnx or TorchScript .pt) and writes its STFT parameters to
+    output + '.json'. The graph is traced on CPU in fp32 with batches of batch_size (default:
+    inference.batch_size of the config) chunks, ONNX graphs accept any batch size.
+    """
+    from utils import get_model_from_config
+
+    if model_type not in EXPORT_MODEL_TYPES:
+        raise ValueError('Export of {} is not supported, supported model types: {}'.format(model_type, ', '.join(EXPORT_MODEL_TYPES)))
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('Unknown export format: {}'.format(export_format))
+
+    model, config = get_model_from_config(model_type, config_path)
+    if start_check_point != '':
+        logger.info('Start from checkpoint: {}'.format(start_check_point))
+        model.load_state_dict(torch.load(start_check_point, map_location='cpu', weights_only=True))
+    model = model.eval()
+    params = spectral_params(model_type, model, config)
+    core = (MDX23CCore(model) if model_type == 'mdx23c' else RoformerCore(model)).eval()
+
+    batch_size = batch_size or config.inference.batch_size
+    example = stft(torch.zeros(batch_size, params['channels'], params['chunk_size']), params)
+    output_dir = os.path.dirname(os.path.abspath(output))
+    os.makedirs(output_dir, exist_ok=True)
+
+    with torch.no_grad():
+        if export_format == 'onnx':
+            torch.onnx.export(core, (example,), output, input_names=['spec'], output_names=['out'],
+                              dynamic_axes={'spec': {0: 'batch'}, 'out': {0: 'batch'}}, opset_version=ONNX_OPSET)
+        else:
+            torch.jit.trace(core, (example,), check_trace=False).save(output)
+
+    params['format'] = export_format
+    with open(output + '.json', 'w') as f:
+        json.dump(params, f, indent=4)
+    logger.info('Exported {} to {}'.format(model_type, output))
+    return output
+
+
+def exported_format(path):
+    """Format of a model exported by export_model, 'onnx' or 'torchscript', read from its parameter file."""
+    with open(path + '.json') as f:
+        return json.load(f)['format']
+
+
+class ExportedModel:
+    """
+    A model exported by export_model, called like the PyTorch model: (b, channels, chunk_size) waveforms in,
+    separated waveforms out, as torch tensors on the input device. ONNX files run with ONNX Runtime (CUDA when
+    device is a CUDA device and onnxruntime-gpu is installed, CPU otherwise, with torch's intra-op thread
+    count), TorchScript files with torch.jit.
+    """
+
+    def __init__(self, path, device='cpu'):
+        with open(path + '.json') as f:
+            self.params = json.load(f)
+        self.path = path
+        self.device = str(device)
+        self.chunk_size = self.params['chunk_size']
+        if self.params['format'] == 'onnx':
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            providers = ['CPUExecutionProvider']
+            if self.device.startswith('cuda') and 'CUDAExecutionProvider' in ort.get_available_providers():
+                index = self.device.split(':')[1] if ':' in self.device else 0
+                providers.insert(0, ('CUDAExecutionProvider', {'device_id': int(index)}))
+            self.session = ort.InferenceSession(path, options, providers=providers)
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location=self.device).eval()
+
+    def eval(self):
+        return self
+
+    def __call__(self, audio):
+        if audio.shape[-1] != self.chunk_size:
+            raise ValueError('{} was exported for chunks of {} samples, got {}. Use the config it was exported with'.format(self.path, self.chunk_size, audio.shape[-1]))
+        spec = stft(audio.float(), self.params)
+        if self.session is not None:
+            out = self.session.run(None, {'spec': spec.cpu().numpy()})[0]
+            out = torch.from_numpy(out).to(audio.device)
+        else:
+            with torch.no_grad():
+                out = self.module(spec)
+        return istft(spec, out, audio.shape[-1], self.params)
+
+
+def load_exported_model(model_type, config_path, path, device):
+    """Same as msst_inference.load_model for an exported model. The config must be the one it was exported with."""
+    from utils import load_config
+    from model_cache import model_cache, file_signature
+
+    config = load_config(model_type, config_path)
+    # Exported graphs run in fp32 and have a fixed chunk size, padding the last batch is not needed
+    config.inference['precision'] = 'fp32'
+    config.inference['compile'] = False
+    key = ('exported', file_signature(path), str(device))
+    model = model_cache.get(key)
+    if model is None:
+        model = ExportedModel(path, device)
+        model_cache.put(key, model, os.path.getsize(path))
+    if model.params['model_type'] != model_type or model.chunk_size != config.audio.chunk_size:
+        raise ValueError('{} was exported from a {} model with chunk_size {}, not from this config'.format(path, model.params['model_type'], model.chunk_size))
+    return model, config
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a separation model to ONNX or TorchScript.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--model_type", type=str, required=True, help="One of {}".format(', '.join(EXPORT_MODEL_TYPES)))
+    parser.add_argument("--config_path", type=str, required=True, help="path to config file")
+    parser.add_argument("--start_check_point", type=str, default='', help="checkpoint of the model")
+    parser.add_argument("--output", type=str, required=True, help="exported file, its STFT parameters are written to <output>.json")
+    parser.add_argument("--format", type=str, default='onnx', choices=EXPORT_FORMATS, help="onnx (for ONNX Runtime) or torchscript")
+    parser.add_argument("--batch_size", type=int, default=None, help="batch size of the example input. If not provided, inference.batch_size of the config is used")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s.%(msecs)03d [%(levelname)s] %(module)s - %(message)s", datefmt="%H:%M:%S")
+    export_model(args.model_type, args.config_path, args.start_check_point, args.output, args.format, args.batch_size)
@@ -6,7 +6,7 @@ import gc
 import numpy as np
 import librosa
 import torch
-from pydub import AudioSegment
+from audio_io import write_audio
 from models.vocal_remover.uvr_lib_v5 import spec_utils
 
 class CommonSeparator:
@@ -66,6 +66,7 @@ class CommonSeparator:
         # Output directory and format
         self.output_dir = config.get("output_dir")
         self.output_format = config.get("output_format")
+        self.output_bit_depth = config.get("output_bit_depth", "16")
         self.extra_output_dir = config.get("extra_output_dir")
 
         # Functional options which are applicable to all architectures and the user may tweak to affect the output
@@ -75,6 +76,11 @@ class CommonSeparator:
         self.sample_rate = config.get("sample_rate")
         self.save_another_stem = config.get("save_another_stem")
 
+        # Disk cache of separation results (result_cache.ResultCache), None to disable
+        self.result_cache = config.get("result_cache")
+        # Disk cache of VR input spectrograms (result_cache.ResultCache), None to disable
+        self.spec_cache = config.get("spec_cache")
+
         # Model specific properties
         self.primary_stem_name = self.model_data.get("primary_stem", "primary_stem")
         self.secondary_stem_name = self.model_data.get("secondary_stem", "secondary_stem")
@@ -85,7 +91,7 @@ class CommonSeparator:
         self.bv_model_rebalance = self.model_data.get("is_bv_model_rebalanced", 0)
 
         self.logger.debug(f"Common params: model_name={self.model_name}, model_path={self.model_path}")
-        self.logger.debug(f"Common params: output_dir={self.output_dir}, output_format={self.output_format}")
+        self.logger.debug(f"Common params: output_dir={self.output_dir}, output_format={self.output_format}, output_bit_depth={self.output_bit_depth}")
         self.logger.debug(f"Common params: normalization_threshold={self.normalization_threshold}")
         self.logger.debug(f"Common params: invert_using_spec={self.invert_using_spec}, sample_rate={self.sample_rate}")
         self.logger.debug(f"Common params: primary_stem_name={self.primary_stem_name}, secondary_stem_name={self.secondary_stem_name}")
@@ -222,43 +228,13 @@ class CommonSeparator:
                 os.makedirs(self.output_dir, exist_ok=True)
                 stem_path = os.path.join(self.output_dir, stem_path)
 
-        self.logger.debug(f"Audio data shape before processing: {stem_source.shape}")
-        self.logger.debug(f"Data type before conversion: {stem_source.dtype}")
-
-        # Ensure the audio data is in the correct format (e.g., int16)
-        if stem_source.dtype != np.int16:
-            stem_source = (stem_source * 32767).astype(np.int16)
-            self.logger.debug("Converted stem_source to int16.")
-
-        # Correctly interleave stereo channels
-        stem_source_interleaved = np.empty((2 * stem_source.shape[0],), dtype=np.int16)
-        stem_source_interleaved[0::2] = stem_source[:, 0]  # Left channel
-        stem_source_interleaved[1::2] = stem_source[:, 1]  # Right channel
-
-        self.logger.debug(f"Interleaved audio data shape: {stem_source_interleaved.shape}")
-
-        # Create a pydub AudioSegment
-        try:
-            audio_segment = AudioSegment(stem_source_interleaved.tobytes(), frame_rate=self.sample_rate, sample_width=stem_source.dtype.itemsize, channels=2)
-            self.logger.debug("Created AudioSegment successfully.")
-        except (IOError, ValueError) as e:
-            self.logger.error(f"Specific error creating AudioSegment: {e}")
-            return
-
-        # Determine file format based on the file extension
-        file_format = stem_path.lower().split(".")[-1]
-
-        # For m4a files, specify mp4 as the container format as the extension doesn't match the format name
-        if file_format == "m4a":
-            file_format = "mp4"
-        elif file_format == "mka":
-            file_format = "matroska"
+        self.logger.debug(f"Audio data shape: {stem_source.shape}, dtype: {stem_source.dtype}")
 
-        # Export using the determined format
+        # WAV/FLAC go straight through soundfile, other formats are piped to ffmpeg as float32
         try:
-            audio_segment.export(stem_path, format=file_format)
+            write_audio(stem_path, stem_source, self.sample_rate, self.output_bit_depth)
             self.logger.debug(f"Exported audio file successfully to {stem_path}")
-        except (IOError, ValueError) as e:
+        except (IOError, ValueError, RuntimeError) as e:
             self.logger.error(f"Error exporting audio file: {e}")
 
     def clear_gpu_cache(self):
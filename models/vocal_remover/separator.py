@@ -10,10 +10,14 @@ import json
 import torch
 from tqdm import tqdm
 from models.vocal_remover.vr_separator import VRSeparator
+from result_cache import ResultCache, DEFAULT_SIZE_MB, DEFAULT_AGE_DAYS
+from audio_io import SOUNDFILE_EXTENSIONS
 
 VR_MODEL_MAP = "data/vr_model_map.json"
 UNOFFICIAL_MODEL_MAP = "config_unofficial/unofficial_vr_model.json"
 
+DEFAULT_SPEC_CACHE_SIZE_MB = 4096
+
 class Separator:
     def __init__(
         self,
@@ -23,6 +27,7 @@ class Separator:
         output_dir=None,
         extra_output_dir=None,
         output_format="wav",
+        output_bit_depth="16",
         normalization_threshold=0.9,
         output_single_stem=None,
         invert_using_spec=False,
@@ -30,6 +35,11 @@ class Separator:
         use_cpu=False,
         save_another_stem=False,
         vr_params={"batch_size": 16, "window_size": 512, "aggression": 5, "enable_tta": False, "enable_post_process": False, "post_process_threshold": 0.2, "high_end_process": False},
+        result_cache_dir=None,
+        result_cache_size=DEFAULT_SIZE_MB,
+        result_cache_age=DEFAULT_AGE_DAYS,
+        spec_cache_dir=None,
+        spec_cache_size=DEFAULT_SPEC_CACHE_SIZE_MB,
     ):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(log_level)
@@ -82,6 +92,9 @@ class Separator:
         if self.output_format is None:
             self.output_format = "wav"
 
+        # Sample format of WAV/FLAC outputs: "16", "24" or "32f" (float), see audio_io.write_audio
+        self.output_bit_depth = output_bit_depth
+
         self.normalization_threshold = normalization_threshold
         if normalization_threshold <= 0 or normalization_threshold > 1:
             raise ValueError("The normalization_threshold must be greater than 0 and less than or equal to 1.")
@@ -104,6 +117,18 @@ class Separator:
         self.torch_device_mps = None
         self.model_instance = None
 
+        # Separation results are reused for audio already processed with the same model and parameters
+        self.result_cache = None
+        if result_cache_dir is not None:
+            self.result_cache = ResultCache(result_cache_dir, int(result_cache_size * 1024 * 1024), result_cache_age * 86400)
+            self.logger.debug(f"Result cache directory: {result_cache_dir}")
+
+        # Input spectrograms of VR models, kept apart so that they do not evict separation results
+        self.spec_cache = None
+        if spec_cache_dir is not None:
+            self.spec_cache = ResultCache(spec_cache_dir, int(spec_cache_size * 1024 * 1024), result_cache_age * 86400)
+            self.logger.debug(f"Spectrogram cache directory: {spec_cache_dir}")
+
         self.setup_accelerated_inferencing_device()
 
     def setup_accelerated_inferencing_device(self):
@@ -138,15 +163,19 @@ class Separator:
 
     def check_ffmpeg_installed(self):
         """
-        This method checks if ffmpeg is installed and logs its version.
+        This method checks if ffmpeg is installed and logs its version. ffmpeg is only needed to write compressed
+        output formats (mp3, m4a, ...), WAV/FLAC/AIFF are written by soundfile (see audio_io.write_audio).
         """
         try:
             ffmpeg_version_output = subprocess.check_output(["ffmpeg", "-version"], text=True)
             first_line = ffmpeg_version_output.splitlines()[0]
             self.logger.debug(f"FFmpeg installed: {first_line}")
         except FileNotFoundError:
-            self.logger.error("FFmpeg is not installed. Please install FFmpeg to use this package.")
-            # Raise an exception if this is being run by a user, as ffmpeg is required for pydub to write audio
+            if self.output_format.lower() in SOUNDFILE_EXTENSIONS:
+                self.logger.warning("FFmpeg is not installed. It is only needed for compressed output formats such as mp3.")
+                return
+            self.logger.error("FFmpeg is not installed. Please install FFmpeg to write {} files.".format(self.output_format))
+            # Raise an exception if this is being run by a user, as ffmpeg encodes the compressed output formats
             # but if we're just running unit tests in CI, no reason to throw
             if "PYTEST_CURRENT_TEST" not in os.environ:
                 raise
@@ -208,6 +237,7 @@ class Separator:
             "model_path": model_path,
             "model_data": model_data,
             "output_format": self.output_format,
+            "output_bit_depth": self.output_bit_depth,
             "output_dir": self.output_dir,
             "extra_output_dir": self.extra_output_dir,
             "normalization_threshold": self.normalization_threshold,
@@ -215,6 +245,8 @@ class Separator:
             "invert_using_spec": self.invert_using_spec,
             "sample_rate": self.sample_rate,
             "save_another_stem": self.save_another_stem,
+            "result_cache": self.result_cache,
+            "spec_cache": self.spec_cache,
         }
 
         self.logger.debug(f"Instantiating vr_separator class")
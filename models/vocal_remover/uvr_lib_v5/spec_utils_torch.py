@@ -0,0 +1,264 @@
+"""
+Torch versions of the spectral functions of spec_utils used by VRSeparator, running on the separator's device
+(the "torch" spec backend, see VRSeparator). They take and return torch tensors and follow the NumPy versions
+step by step: the STFT matches librosa 0.9.2 (periodic Hann window, constant padding, centered frames) and the
+resampling between bands is still done by librosa on the CPU, so the outputs only differ by float precision.
+tools/benchmark/spec_utils_parity.py compares both backends.
+"""
+
+import math
+import traceback
+
+import librosa
+import numpy as np
+import torch
+
+from models.vocal_remover.uvr_lib_v5.spec_utils import wav_resolution
+
+
+def convert_channels(spec, mp, band):
+    cc = mp.param["band"][band].get("convert_channels")
+
+    if "mid_side_c" == cc:
+        return torch.stack([spec[0] + spec[1] * 0.25, spec[1] - spec[0] * 0.25])
+    elif "mid_side" == cc:
+        return torch.stack([(spec[0] + spec[1]) / 2, spec[0] - spec[1]])
+    elif "stereo_n" == cc:
+        return torch.stack([(spec[0] + spec[1] * 0.25) / 0.9375, (spec[1] + spec[0] * 0.25) / 0.9375])
+
+    return spec
+
+
+def wave_to_spectrogram(wave, hop_length, n_fft, mp, band, is_v51_model=False):
+    if wave.ndim == 1:
+        wave = torch.stack([wave, wave])
+
+    if not is_v51_model:
+        if mp.param["reverse"]:
+            wave = torch.flip(wave, [1])
+        elif mp.param["mid_side"]:
+            wave = torch.stack([(wave[0] + wave[1]) / 2, wave[0] - wave[1]])
+        elif mp.param["mid_side_b2"]:
+            wave = torch.stack([wave[1] + wave[0] * 0.5, wave[0] - wave[1] * 0.5])
+
+    window = torch.hann_window(n_fft, dtype=wave.dtype, device=wave.device)
+    spec = torch.stft(wave, n_fft, hop_length=hop_length, window=window, center=True, pad_mode="constant", return_complex=True)
+
+    if is_v51_model:
+        spec = convert_channels(spec, mp, band)
+
+    return spec
+
+
+def spectrogram_to_wave(spec, hop_length=1024, mp={}, band=0, is_v51_model=True):
+    n_fft = 2 * (spec.shape[1] - 1)
+    window = torch.hann_window(n_fft, dtype=spec.real.dtype, device=spec.device)
+    wave_left, wave_right = torch.istft(spec, n_fft, hop_length=hop_length, window=window, center=True)
+
+    if is_v51_model:
+        cc = mp.param["band"][band].get("convert_channels")
+        if "mid_side_c" == cc:
+            return torch.stack([wave_left / 1.0625 - wave_right / 4.25, wave_right / 1.0625 + wave_left / 4.25])
+        elif "mid_side" == cc:
+            return torch.stack([wave_left + wave_right / 2, wave_left - wave_right / 2])
+        elif "stereo_n" == cc:
+            return torch.stack([wave_left - wave_right * 0.25, wave_right - wave_left * 0.25])
+    else:
+        if mp.param["reverse"]:
+            return torch.stack([torch.flip(wave_left, [0]), torch.flip(wave_right, [0])])
+        elif mp.param["mid_side"]:
+            return torch.stack([wave_left + wave_right / 2, wave_left - wave_right / 2])
+        elif mp.param["mid_side_b2"]:
+            return torch.stack([wave_right / 1.25 + 0.4 * wave_left, wave_left / 1.25 - 0.4 * wave_right])
+
+    return torch.stack([wave_left, wave_right])
+
+
+def combine_spectrograms(specs, mp, is_v51_model=False):
+    l = min([specs[i].shape[2] for i in specs])
+    device = next(iter(specs.values())).device
+    spec_c = torch.zeros((2, mp.param["bins"] + 1, l), dtype=torch.complex64, device=device)
+    offset = 0
+    bands_n = len(mp.param["band"])
+
+    for d in range(1, bands_n + 1):
+        h = mp.param["band"][d]["crop_stop"] - mp.param["band"][d]["crop_start"]
+        spec_c[:, offset : offset + h, :l] = specs[d][:, mp.param["band"][d]["crop_start"] : mp.param["band"][d]["crop_stop"], :l]
+        offset += h
+
+    if offset > mp.param["bins"]:
+        raise ValueError("Too much bins")
+
+    # lowpass fiter
+
+    if mp.param["pre_filter_start"] > 0:
+        if is_v51_model:
+            spec_c *= get_lp_filter_mask(spec_c.shape[1], mp.param["pre_filter_start"], mp.param["pre_filter_stop"], device)
+        else:
+            if bands_n == 1:
+                spec_c = fft_lp_filter(spec_c, mp.param["pre_filter_start"], mp.param["pre_filter_stop"])
+            else:
+                gains = []
+                gp = 1
+                for b in range(mp.param["pre_filter_start"] + 1, mp.param["pre_filter_stop"]):
+                    g = math.pow(10, -(b - mp.param["pre_filter_start"]) * (3.5 - gp) / 20.0)
+                    gp = g
+                    gains.append(g)
+                if gains:
+                    start = mp.param["pre_filter_start"] + 1
+                    spec_c[:, start : start + len(gains), :] *= torch.tensor(gains, device=device)[:, None]
+
+    return spec_c
+
+
+def _resample(wave, orig_sr, target_sr):
+    """librosa resampling on the CPU, as in spec_utils, torch has no equivalent of its resamplers."""
+    wave_np = librosa.resample(wave.cpu().numpy(), orig_sr=orig_sr, target_sr=target_sr, res_type=wav_resolution)
+    return torch.from_numpy(wave_np).to(wave.device)
+
+
+def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None, is_v51_model=False):
+    bands_n = len(mp.param["band"])
+    offset = 0
+
+    for d in range(1, bands_n + 1):
+        bp = mp.param["band"][d]
+        spec_s = torch.zeros((2, bp["n_fft"] // 2 + 1, spec_m.shape[2]), dtype=spec_m.dtype, device=spec_m.device)
+        h = bp["crop_stop"] - bp["crop_start"]
+        spec_s[:, bp["crop_start"] : bp["crop_stop"], :] = spec_m[:, offset : offset + h, :]
+
+        offset += h
+        if d == bands_n:  # higher
+            if extra_bins_h:  # if --high_end_process bypass
+                max_bin = bp["n_fft"] // 2
+                spec_s[:, max_bin - extra_bins_h : max_bin, :] = extra_bins[:, :extra_bins_h, :]
+            if bp["hpf_start"] > 0:
+                if is_v51_model:
+                    spec_s *= get_hp_filter_mask(spec_s.shape[1], bp["hpf_start"], bp["hpf_stop"] - 1, spec_s.device)
+                else:
+                    spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
+            if bands_n == 1:
+                wave = spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model)
+            else:
+                wave = wave + spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model)
+        else:
+            sr = mp.param["band"][d + 1]["sr"]
+            if d == 1:  # lower
+                if is_v51_model:
+                    spec_s *= get_lp_filter_mask(spec_s.shape[1], bp["lpf_start"], bp["lpf_stop"], spec_s.device)
+                else:
+                    spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
+
+                wave = _resample(spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model), bp["sr"], sr)
+            else:  # mid
+                if is_v51_model:
+                    spec_s *= get_hp_filter_mask(spec_s.shape[1], bp["hpf_start"], bp["hpf_stop"] - 1, spec_s.device)
+                    spec_s *= get_lp_filter_mask(spec_s.shape[1], bp["lpf_start"], bp["lpf_stop"], spec_s.device)
+                else:
+                    spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
+                    spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
+
+                wave2 = wave + spectrogram_to_wave(spec_s, bp["hl"], mp, d, is_v51_model)
+                wave = _resample(wave2, bp["sr"], sr)
+
+    return wave
+
+
+def get_lp_filter_mask(n_bins, bin_start, bin_stop, device=None):
+    return torch.cat([torch.ones(bin_start - 1, device=device), torch.linspace(1, 0, bin_stop - bin_start + 1, device=device), torch.zeros(n_bins - bin_stop, device=device)])[:, None]
+
+
+def get_hp_filter_mask(n_bins, bin_start, bin_stop, device=None):
+    return torch.cat([torch.zeros(bin_stop + 1, device=device), torch.linspace(0, 1, 1 + bin_start - bin_stop, device=device), torch.ones(n_bins - bin_start - 2, device=device)])[:, None]
+
+
+def fft_lp_filter(spec, bin_start, bin_stop):
+    gains = []
+    g = 1.0
+    for b in range(bin_start, bin_stop):
+        g -= 1 / (bin_stop - bin_start)
+        gains.append(g)
+    if gains:
+        spec[:, bin_start:bin_stop, :] *= torch.tensor(gains, device=spec.device)[:, None]
+
+    spec[:, bin_stop:, :] *= 0
+
+    return spec
+
+
+def fft_hp_filter(spec, bin_start, bin_stop):
+    gains = []
+    g = 1.0
+    for b in range(bin_start, bin_stop, -1):
+        g -= 1 / (bin_start - bin_stop)
+        gains.append(g)
+    if gains:
+        # gains[0] is for bin_start, going down to bin_stop + 1
+        spec[:, bin_stop + 1 : bin_start + 1, :] *= torch.tensor(gains[::-1], device=spec.device)[:, None]
+
+    spec[:, 0 : bin_stop + 1, :] *= 0
+
+    return spec
+
+
+def mirroring(a, spec_m, input_high_end, mp):
+    mirror = torch.flip(torch.abs(spec_m[:, mp.param["pre_filter_start"] - 10 - input_high_end.shape[1] : mp.param["pre_filter_start"] - 10, :]), [1])
+
+    if "mirroring" == a:
+        mirror = mirror * torch.exp(1.0j * torch.angle(input_high_end))
+
+        return torch.where(torch.abs(input_high_end) <= torch.abs(mirror), input_high_end, mirror)
+
+    if "mirroring2" == a:
+        mi = mirror * (input_high_end * 1.7)
+
+        return torch.where(torch.abs(input_high_end) <= torch.abs(mi), input_high_end, mi)
+
+
+def merge_artifacts(y_mask, thres=0.01, min_range=64, fade_size=32):
+    mask = y_mask
+
+    try:
+        if min_range < fade_size * 2:
+            raise ValueError("min_range must be >= fade_size * 2")
+
+        # The runs above the threshold are found on the CPU, they are a single value per frame
+        idx = torch.where(y_mask.amin(dim=(0, 1)) > thres)[0].cpu().numpy()
+        start_idx = np.insert(idx[np.where(np.diff(idx) != 1)[0] + 1], 0, idx[0])
+        end_idx = np.append(idx[np.where(np.diff(idx) != 1)[0]], idx[-1])
+        artifact_idx = np.where(end_idx - start_idx > min_range)[0]
+        weight = torch.zeros_like(y_mask)
+        if len(artifact_idx) > 0:
+            start_idx = start_idx[artifact_idx]
+            end_idx = end_idx[artifact_idx]
+            old_e = None
+            fade_in = torch.linspace(0, 1, fade_size, dtype=y_mask.dtype, device=y_mask.device)
+            fade_out = torch.linspace(1, 0, fade_size, dtype=y_mask.dtype, device=y_mask.device)
+            for s, e in zip(start_idx.tolist(), end_idx.tolist()):
+                if old_e is not None and s - old_e < fade_size:
+                    s = old_e - fade_size * 2
+
+                if s != 0:
+                    weight[:, :, s : s + fade_size] = fade_in
+                else:
+                    s -= fade_size
+
+                if e != y_mask.shape[2]:
+                    weight[:, :, e - fade_size : e] = fade_out
+                else:
+                    e += fade_size
+
+                weight[:, :, s + fade_size : e - fade_size] = 1
+                old_e = e
+
+        v_mask = 1 - y_mask
+        y_mask += weight * v_mask
+
+        mask = y_mask
+    except Exception as e:
+        error_name = f"{type(e).__name__}"
+        traceback_text = "".join(traceback.format_tb(e.__traceback__))
+        message = f'{error_name}: "{e}"\n{traceback_text}"'
+        print("Post Process Failed: ", message)
+
+    return mask
@@ -2,6 +2,8 @@
 
 import os
 import math
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import librosa
@@ -14,13 +16,20 @@ import audioread
 
 from models.vocal_remover.common_separator import CommonSeparator
 from models.vocal_remover.uvr_lib_v5 import spec_utils
+from models.vocal_remover.uvr_lib_v5 import spec_utils_torch
 from models.vocal_remover.uvr_lib_v5.vr_network import nets
 from models.vocal_remover.uvr_lib_v5.vr_network import nets_new
 from models.vocal_remover.uvr_lib_v5.vr_network.model_param_init import ModelParameters
+from model_cache import ModelCache, model_cache, module_nbytes, file_signature
+from utils import quantize_model, prefetch_batches
+from result_cache import ResultCache, file_hash
 
 vr_params_json_dir = "configs/vr_modelparams"
 unofficial_vr_params_dir = "config_unofficial/vr_modelparams"
 
+# Input spectrograms of the last files, shared by the VR models run on them (see VRSeparator.loading_mix)
+input_spec_cache = ModelCache(int(float(os.environ.get("MSST_SPEC_CACHE_MB", 1024)) * 1024 * 1024))
+
 class VRSeparator(CommonSeparator):
     """
     VRSeparator is responsible for separating audio sources using VR models.
@@ -55,6 +64,7 @@ class VRSeparator(CommonSeparator):
         except:
             vr_params_json_filepath = os.path.join(unofficial_vr_params_dir, vr_params_json_filename)
             self.model_params = ModelParameters(vr_params_json_filepath)
+        self.model_params_path = vr_params_json_filepath
 
         self.logger.debug(f"Model params: {self.model_params.param}")
 
@@ -100,18 +110,34 @@ class VRSeparator(CommonSeparator):
         # - Values beyond 5 might muddy the sound for non-vocal models.
         self.aggression = float(int(arch_config.get("aggression", 5)) / 100)
 
+        # Post-training dynamic int8 quantization of the Linear and LSTM layers (utils.quantize_model), CPU only
+        self.quantize = arch_config.get("quantize", False)
+        # Checked here rather than when loading the model, the result cache key of separate() depends on it
+        if self.quantize and str(self.torch_device) != "cpu":
+            self.logger.warning(f"int8 quantization is only available on CPU, running {self.torch_device} without it")
+            self.quantize = False
+
+        # Backend of the spectrogram pre- and post-processing: "numpy" (spec_utils, librosa on the CPU) or "torch"
+        # (spec_utils_torch, on the separator's device)
+        self.spec_backend = arch_config.get("spec_backend", "numpy")
+
         self.aggressiveness = {"value": self.aggression, "split_bin": self.model_params.param["band"][1]["crop_stop"], "aggr_correction": self.model_params.param.get("aggr_correction")}
 
         self.model_samplerate = self.model_params.param["sr"]
 
         self.logger.debug(f"VR arch params: enable_tta={self.enable_tta}, enable_post_process={self.enable_post_process}, post_process_threshold={self.post_process_threshold}")
         self.logger.debug(f"VR arch params: batch_size={self.batch_size}, window_size={self.window_size}")
-        self.logger.debug(f"VR arch params: high_end_process={self.high_end_process}, aggression={self.aggression}")
+        self.logger.debug(f"VR arch params: high_end_process={self.high_end_process}, aggression={self.aggression}, quantize={self.quantize}")
         self.logger.debug(f"VR arch params: is_vr_51_model={self.is_vr_51_model}, model_samplerate={self.model_samplerate}, model_capacity={self.model_capacity}")
 
         self.model_run = lambda *args, **kwargs: self.logger.error("Model run method is not initialised yet.")
+        self.model_run_key = None
+
+        # Waveforms computed by process_stem for the current file, stored in the result cache
+        self.computed_sources = {}
 
-        # This should go away once we refactor to remove soundfile.write and replace with pydub like we did for the MDX rewrite
+        # Subtype of the in-memory WAV that array inputs are converted to before loading, outputs are written by
+        # audio_io.write_audio at output_bit_depth
         self.wav_subtype = "PCM_16"
 
         self.logger.debug("VR Separator initialisation complete")
@@ -135,48 +161,42 @@ class VRSeparator(CommonSeparator):
 
         self.logger.debug(f"Starting separation for input audio file {self.audio_file_path}...")
 
-        nn_arch_sizes = [31191, 33966, 56817, 123821, 123812, 129605, 218409, 537238, 537227]  # default
-        vr_5_1_models = [56817, 218409]
-        model_size = math.ceil(os.stat(self.model_path).st_size / 1024)
-        nn_arch_size = min(nn_arch_sizes, key=lambda x: abs(x - model_size))
-        self.logger.debug(f"Model size determined: {model_size}, NN architecture size: {nn_arch_size}")
+        # Note: logic similar to the following should probably be added to the other architectures
+        # Check if output_single_stem is set to a value that would result in no output files
+        if self.output_single_stem and (self.output_single_stem.lower() != self.primary_stem_name.lower() and self.output_single_stem.lower() != self.secondary_stem_name.lower()):
+            # If so, reset output_single_stem to None to save both stems
+            self.output_single_stem = None
+            self.logger.warning(f"The output_single_stem setting '{self.output_single_stem}' does not match any of the output files: '{self.primary_stem_name}' and '{self.secondary_stem_name}'. For this model '{self.model_name}', the output_single_stem setting will be ignored and all output files will be saved.")
 
-        if nn_arch_size in vr_5_1_models or self.is_vr_51_model:
-            self.logger.debug("Using CascadedNet for VR 5.1 model...")
-            self.model_run = nets_new.CascadedNet(self.model_params.param["bins"] * 2, nn_arch_size, nout=self.model_capacity[0], nout_lstm=self.model_capacity[1])
-            self.is_vr_51_model = True
+        # Stems are cached as waveforms, process_stem skips the spectrogram conversion for them
+        self.computed_sources = {}
+        cache_key = self.result_cache_key() if self.result_cache is not None else None
+        cached = self.result_cache.get(cache_key, self.required_stems()) if cache_key is not None else None
+        if cached is not None:
+            # The cached arrays are read-only memory maps, write_audio normalizes the stems in place
+            self.primary_source = np.array(cached[self.primary_stem_name]) if self.primary_stem_name in cached else None
+            self.secondary_source = np.array(cached[self.secondary_stem_name]) if self.secondary_stem_name in cached else None
+            y_spec, v_spec = None, None
         else:
-            self.logger.debug("Determining model capacity...")
-            self.model_run = nets.determine_model_capacity(self.model_params.param["bins"] * 2, nn_arch_size)
-
-        self.model_run.load_state_dict(torch.load(self.model_path, map_location=self.torch_device_cpu))
-        self.model_run.to(self.torch_device)
-        self.logger.debug("Model loaded and moved to device.")
+            self.load_model_run()
 
-        y_spec, v_spec = self.inference_vr(self.loading_mix(), self.torch_device, self.aggressiveness)
-        self.logger.debug("Inference completed.")
+            y_spec, v_spec = self.inference_vr(self.loading_mix(), self.torch_device, self.aggressiveness)
+            self.logger.debug("Inference completed.")
 
-        # Sanitize y_spec and v_spec to replace NaN and infinite values
-        y_spec = np.nan_to_num(y_spec, nan=0.0, posinf=0.0, neginf=0.0)
-        v_spec = np.nan_to_num(v_spec, nan=0.0, posinf=0.0, neginf=0.0)
+            # Sanitize y_spec and v_spec to replace NaN and infinite values
+            y_spec = np.nan_to_num(y_spec, nan=0.0, posinf=0.0, neginf=0.0)
+            v_spec = np.nan_to_num(v_spec, nan=0.0, posinf=0.0, neginf=0.0)
 
-        self.logger.debug("Sanitization completed. Replaced NaN and infinite values in y_spec and v_spec.")
+            self.logger.debug("Sanitization completed. Replaced NaN and infinite values in y_spec and v_spec.")
 
-        # After inference_vr call
-        self.logger.debug(f"Inference VR completed. y_spec shape: {y_spec.shape}, v_spec shape: {v_spec.shape}")
-        self.logger.debug(f"y_spec stats - min: {np.min(y_spec)}, max: {np.max(y_spec)}, isnan: {np.isnan(y_spec).any()}, isinf: {np.isinf(y_spec).any()}")
-        self.logger.debug(f"v_spec stats - min: {np.min(v_spec)}, max: {np.max(v_spec)}, isnan: {np.isnan(v_spec).any()}, isinf: {np.isinf(v_spec).any()}")
+            # After inference_vr call
+            self.logger.debug(f"Inference VR completed. y_spec shape: {y_spec.shape}, v_spec shape: {v_spec.shape}")
+            self.logger.debug(f"y_spec stats - min: {np.min(y_spec)}, max: {np.max(y_spec)}, isnan: {np.isnan(y_spec).any()}, isinf: {np.isinf(y_spec).any()}")
+            self.logger.debug(f"v_spec stats - min: {np.min(v_spec)}, max: {np.max(v_spec)}, isnan: {np.isnan(v_spec).any()}, isinf: {np.isinf(v_spec).any()}")
 
         output_files = []
         self.logger.debug("Processing output files...")
 
-        # Note: logic similar to the following should probably be added to the other architectures
-        # Check if output_single_stem is set to a value that would result in no output files
-        if self.output_single_stem and (self.output_single_stem.lower() != self.primary_stem_name.lower() and self.output_single_stem.lower() != self.secondary_stem_name.lower()):
-            # If so, reset output_single_stem to None to save both stems
-            self.output_single_stem = None
-            self.logger.warning(f"The output_single_stem setting '{self.output_single_stem}' does not match any of the output files: '{self.primary_stem_name}' and '{self.secondary_stem_name}'. For this model '{self.model_name}', the output_single_stem setting will be ignored and all output files will be saved.")
-
         if not self.output_single_stem or self.output_single_stem.lower() == self.primary_stem_name.lower():
             output_files.append(self.process_stem(self.primary_stem_name, self.primary_source, y_spec))
 
@@ -189,29 +209,186 @@ class VRSeparator(CommonSeparator):
         if self.save_another_stem and self.output_single_stem.lower() == self.primary_stem_name.lower():
             output_files.append(self.process_stem(self.secondary_stem_name, self.secondary_source, v_spec, another=True))
 
+        if cache_key is not None and self.computed_sources:
+            self.result_cache.put(cache_key, self.computed_sources)
+
         return output_files
 
+    def separate_array(self, mix, name):
+        """
+        Separates an in-memory mix without writing any file, used by inference_flow.py to hand stems from one
+        step of a flow to the next.
+
+        Args:
+            mix (np.ndarray): The mix at 44100 Hz, shaped (samples, channels).
+            name (str): Base name of the outputs, as the file name would be for separate().
+
+        Returns:
+            dict: The waveforms, shaped (samples, channels), of the stems separate() would write.
+        """
+        self.primary_source = None
+        self.secondary_source = None
+
+        self.audio_file_path = mix
+        self.audio_file_base = name
+
+        self.load_model_run()
+
+        y_spec, v_spec = self.inference_vr(self.loading_mix(), self.torch_device, self.aggressiveness)
+        y_spec = np.nan_to_num(y_spec, nan=0.0, posinf=0.0, neginf=0.0)
+        v_spec = np.nan_to_num(v_spec, nan=0.0, posinf=0.0, neginf=0.0)
+
+        sources = {}
+        for stem_name in self.required_stems():
+            sources[stem_name] = self.spec_to_source(y_spec if stem_name == self.primary_stem_name else v_spec)
+        return sources
+
+    def required_stems(self):
+        """Names of the stems separate() writes with the current output_single_stem / save_another_stem settings."""
+        if not self.output_single_stem or self.save_another_stem:
+            return [self.primary_stem_name, self.secondary_stem_name]
+        if self.output_single_stem.lower() == self.primary_stem_name.lower():
+            return [self.primary_stem_name]
+        return [self.secondary_stem_name]
+
+    def result_cache_key(self):
+        params = {
+            "model_data": self.model_data,
+            "window_size": self.window_size,
+            "aggression": self.aggression,
+            "enable_tta": self.enable_tta,
+            "enable_post_process": self.enable_post_process,
+            "post_process_threshold": self.post_process_threshold,
+            "high_end_process": self.high_end_process,
+            "quantize": self.quantize,
+            "spec_backend": self.spec_backend,
+        }
+        return self.result_cache.key("vr", file_hash(self.audio_file_path), file_hash(self.model_path), params)
+
+    def load_model_run(self):
+        """
+        Builds the network and loads the weights, or takes them from the process wide model cache.
+        The network only depends on the model file and its params, so it is shared between files and separator instances.
+        """
+        nn_arch_sizes = [31191, 33966, 56817, 123821, 123812, 129605, 218409, 537238, 537227]  # default
+        vr_5_1_models = [56817, 218409]
+        model_size = math.ceil(os.stat(self.model_path).st_size / 1024)
+        nn_arch_size = min(nn_arch_sizes, key=lambda x: abs(x - model_size))
+        self.logger.debug(f"Model size determined: {model_size}, NN architecture size: {nn_arch_size}")
+
+        if nn_arch_size in vr_5_1_models:
+            self.is_vr_51_model = True
+
+        key = ("vr", file_signature(self.model_path), nn_arch_size, self.is_vr_51_model, self.model_capacity, self.model_params.param["bins"], str(self.torch_device), self.quantize)
+        # Kept by the instance for the next files of a folder, even if the cache evicts it meanwhile
+        if key == self.model_run_key:
+            return
+        model_run = model_cache.get(key)
+        if model_run is not None:
+            self.model_run = model_run
+            self.model_run_key = key
+            self.logger.debug("Using cached model.")
+            return
+
+        if self.is_vr_51_model:
+            self.logger.debug("Using CascadedNet for VR 5.1 model...")
+            self.model_run = nets_new.CascadedNet(self.model_params.param["bins"] * 2, nn_arch_size, nout=self.model_capacity[0], nout_lstm=self.model_capacity[1])
+        else:
+            self.logger.debug("Determining model capacity...")
+            self.model_run = nets.determine_model_capacity(self.model_params.param["bins"] * 2, nn_arch_size)
+
+        self.model_run.load_state_dict(torch.load(self.model_path, map_location=self.torch_device_cpu))
+        self.model_run.to(self.torch_device)
+        if self.quantize:
+            self.logger.debug("Quantizing Linear and LSTM layers to int8...")
+            self.model_run = quantize_model(self.model_run)
+        model_cache.put(key, self.model_run, module_nbytes(self.model_run))
+        self.model_run_key = key
+        self.logger.debug("Model loaded and moved to device.")
+
     def process_stem(self, stem_name, stem_source, spec, another=False):
         self.logger.debug(f"Processing {stem_name} stem")
         if not isinstance(stem_source, np.ndarray):
-            self.logger.debug(f"Preparing to convert spectrogram to waveform. Spec shape: {spec.shape}")
-            stem_source = self.spec_to_wav(spec).T
-            self.logger.debug(f"Converting {stem_name} spectrogram to waveform.")
-            if self.model_samplerate != 44100:
-                stem_source = librosa.resample(stem_source.T, orig_sr=self.model_samplerate, target_sr=44100).T
-                self.logger.debug(f"Resampling {stem_name} to 44100Hz.")
+            stem_source = self.spec_to_source(spec)
+            # Cached before write_audio normalizes stem_source in place
+            self.computed_sources[stem_name] = stem_source.copy()
         
         stem_output_path = os.path.join(f"{self.audio_file_base}_{stem_name}.{self.output_format.lower()}")
         self.logger.debug(f"Saving {stem_name} stem to {stem_output_path}...")
         self.final_process(stem_output_path, stem_source, stem_name, another)
         return stem_output_path
 
+    def spec_to_source(self, spec):
+        """Converts a separated spectrogram to a (samples, channels) waveform at 44100 Hz."""
+        self.logger.debug(f"Preparing to convert spectrogram to waveform. Spec shape: {spec.shape}")
+        stem_source = self.spec_to_wav(spec).T
+        if self.model_samplerate != 44100:
+            stem_source = librosa.resample(stem_source.T, orig_sr=self.model_samplerate, target_sr=44100).T
+            self.logger.debug("Resampling to 44100Hz.")
+        return stem_source
+
+    def input_spec_key(self):
+        """
+        Key of the input spectrogram of the current file in input_spec_cache and the spectrogram cache. The spectrogram
+        only depends on the audio and the model params file, so VR models sharing a params file (e.g. 4band_v3)
+        share it.
+        """
+        if isinstance(self.audio_file_path, np.ndarray):
+            audio = hashlib.sha1(np.ascontiguousarray(self.audio_file_path)).hexdigest()
+        else:
+            audio = file_hash(self.audio_file_path)
+        return ("vr_input", audio, file_hash(self.model_params_path), self.is_vr_51_model, self.torch_device_mps is not None, self.spec_backend)
+
+    def input_high_end_height(self):
+        bp = self.model_params.param["band"][len(self.model_params.param["band"])]
+        return (bp["n_fft"] // 2 - bp["crop_stop"]) + (self.model_params.param["pre_filter_stop"] - self.model_params.param["pre_filter_start"])
+
     def loading_mix(self):
+        """
+        Input spectrogram of the current file. It is taken from input_spec_cache when another model with the same
+        params already computed it in this process, or from the spectrogram cache on disk (memory mapped, no
+        decoding and no STFT) when it is enabled and an earlier job computed it.
+        """
+        key = self.input_spec_key()
+        cached = input_spec_cache.get(key)
+        disk_key = ResultCache.key(*key) if self.spec_cache is not None else None
+        if cached is None and disk_key is not None:
+            arrays = self.spec_cache.get(disk_key, ["X_spec", "input_high_end"])
+            if arrays is not None:
+                cached = arrays["X_spec"], self.input_high_end_height(), arrays["input_high_end"]
+                input_spec_cache.put(key, cached, arrays["X_spec"].nbytes + arrays["input_high_end"].nbytes)
+        if cached is None:
+            cached = self.compute_input_spec()
+            # Shared with the other models, inference_vr only reads it
+            for array in cached:
+                if isinstance(array, np.ndarray):
+                    array.flags.writeable = False
+            input_spec_cache.put(key, cached, sum(array.nbytes for array in cached if isinstance(array, np.ndarray)))
+            if disk_key is not None:
+                self.spec_cache.put(disk_key, {"X_spec": cached[0], "input_high_end": cached[2]}, dtype=np.complex64)
+        else:
+            self.logger.debug("Using cached input spectrogram.")
+
+        X_spec, input_high_end_h, input_high_end = cached
+        if self.high_end_process:
+            self.input_high_end_h, self.input_high_end = input_high_end_h, input_high_end
+        return X_spec
+
+    def compute_input_spec(self):
+        """
+        Builds the multi-band input spectrogram. Each band is resampled from the band above it, which stays sequential,
+        but the STFT of a band runs on a thread pool while the next band is resampled.
+
+        Returns:
+            tuple: The combined spectrogram, and the high-end height and slice used by high_end_process.
+        """
         X_wave, X_spec_s = {}, {}
 
         bands_n = len(self.model_params.param["band"])
 
-        audio_file = spec_utils.write_array_to_mem(self.audio_file_path, subtype=self.wav_subtype)
+        # Arrays (separate_array) are resampled directly instead of going through an in-memory WAV file
+        is_array = isinstance(self.audio_file_path, np.ndarray)
+        audio_file = self.audio_file_path if is_array else spec_utils.write_array_to_mem(self.audio_file_path, subtype=self.wav_subtype)
         is_mp3 = audio_file.endswith(".mp3") if isinstance(audio_file, str) else False
 
         self.logger.debug(f"loading_mix iteraring through {bands_n} bands")
@@ -221,81 +398,85 @@ class VRSeparator(CommonSeparator):
         else:
             process_bands_n = tqdm(range(bands_n, 0, -1), leave=False)
 
-        for d in process_bands_n:
-            bp = self.model_params.param["band"][d]
+        with ThreadPoolExecutor(max_workers=bands_n) as executor:
+            for d in process_bands_n:
+                bp = self.model_params.param["band"][d]
+
+                wav_resolution = bp["res_type"]
 
-            wav_resolution = bp["res_type"]
+                if self.torch_device_mps is not None:
+                    wav_resolution = "polyphase"
 
-            if self.torch_device_mps is not None:
-                wav_resolution = "polyphase"
+                if d == bands_n:  # high-end band
+                    if is_array:
+                        X_wave[d] = librosa.resample(np.asarray(audio_file.T, dtype=np.float32), orig_sr=44100, target_sr=bp["sr"], res_type=wav_resolution)
+                    else:
+                        X_wave[d], _ = librosa.load(audio_file, sr=bp["sr"], mono=False, dtype=np.float32, res_type=wav_resolution)
 
-            if d == bands_n:  # high-end band
-                X_wave[d], _ = librosa.load(audio_file, sr=bp["sr"], mono=False, dtype=np.float32, res_type=wav_resolution)
-                X_spec_s[d] = spec_utils.wave_to_spectrogram(X_wave[d], bp["hl"], bp["n_fft"], self.model_params, band=d, is_v51_model=self.is_vr_51_model)
+                    if not np.any(X_wave[d]) and is_mp3:
+                        X_wave[d] = rerun_mp3(audio_file, bp["sr"])
 
-                if not np.any(X_wave[d]) and is_mp3:
-                    X_wave[d] = rerun_mp3(audio_file, bp["sr"])
+                    if X_wave[d].ndim == 1:
+                        X_wave[d] = np.asarray([X_wave[d], X_wave[d]])
+                else:  # lower bands
+                    X_wave[d] = librosa.resample(X_wave[d + 1], orig_sr=self.model_params.param["band"][d + 1]["sr"], target_sr=bp["sr"], res_type=wav_resolution)
 
-                if X_wave[d].ndim == 1:
-                    X_wave[d] = np.asarray([X_wave[d], X_wave[d]])
-            else:  # lower bands
-                X_wave[d] = librosa.resample(X_wave[d + 1], orig_sr=self.model_params.param["band"][d + 1]["sr"], target_sr=bp["sr"], res_type=wav_resolution)
-                X_spec_s[d] = spec_utils.wave_to_spectrogram(X_wave[d], bp["hl"], bp["n_fft"], self.model_params, band=d, is_v51_model=self.is_vr_51_model)
+                X_spec_s[d] = executor.submit(self.wave_to_spectrogram, X_wave[d], bp, d)
 
-            if d == bands_n and self.high_end_process:
-                self.input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (self.model_params.param["pre_filter_stop"] - self.model_params.param["pre_filter_start"])
-                self.input_high_end = X_spec_s[d][:, bp["n_fft"] // 2 - self.input_high_end_h : bp["n_fft"] // 2, :]
+            X_spec_s = {d: future.result() for d, future in X_spec_s.items()}
 
-        X_spec = spec_utils.combine_spectrograms(X_spec_s, self.model_params, is_v51_model=self.is_vr_51_model)
+        bp = self.model_params.param["band"][bands_n]
+        input_high_end_h = self.input_high_end_height()
+        input_high_end = X_spec_s[bands_n][:, bp["n_fft"] // 2 - input_high_end_h : bp["n_fft"] // 2, :]
+
+        if self.spec_backend == "torch":
+            X_spec = spec_utils_torch.combine_spectrograms(X_spec_s, self.model_params, is_v51_model=self.is_vr_51_model).cpu().numpy()
+            input_high_end = input_high_end.cpu().numpy()
+        else:
+            X_spec = spec_utils.combine_spectrograms(X_spec_s, self.model_params, is_v51_model=self.is_vr_51_model)
+            input_high_end = input_high_end.copy()
 
         del X_wave, X_spec_s, audio_file
 
-        return X_spec
+        return X_spec, input_high_end_h, input_high_end
 
     def inference_vr(self, X_spec, device, aggressiveness):
         def _execute(X_mag_pad, roi_size):
-            X_dataset = []
             patches = (X_mag_pad.shape[2] - 2 * self.model_run.offset) // roi_size
+            if patches <= 0:
+                raise ValueError(f"Window size error: h1_shape[3] must be greater than h2_shape[3]")
 
-            self.logger.debug(f"inference_vr appending to X_dataset for each of {patches} patches")
+            # (patches, channels, bins, window_size) strided view of the windows, only the current batch is copied
+            windows = np.lib.stride_tricks.sliding_window_view(X_mag_pad, self.window_size, axis=2)[:, :, ::roi_size][:, :, :patches]
+            windows = windows.transpose(2, 0, 1, 3)
 
-            if self.log_level == logging.DEBUG:
-                process_patchse = tqdm(range(patches))
-            else:
-                process_patchse = range(patches)
-
-            for i in process_patchse:
-                start = i * roi_size
-                X_mag_window = X_mag_pad[:, :, start : start + self.window_size]
-                X_dataset.append(X_mag_window)
+            def batches():
+                for i in range(0, patches, self.batch_size):
+                    yield i, torch.from_numpy(np.ascontiguousarray(windows[i : i + self.batch_size])), i + self.batch_size >= patches
 
-            total_iterations = patches // self.batch_size if not self.enable_tta else (patches // self.batch_size) * 2
-            self.logger.debug(f"inference_vr iterating through {total_iterations} batches, batch_size = {self.batch_size}")
+            total_iterations = -(-patches // self.batch_size)
+            self.logger.debug(f"inference_vr iterating through {total_iterations} batches of {patches} patches, batch_size = {self.batch_size}")
 
-            X_dataset = np.asarray(X_dataset)
             self.model_run.eval()
             with torch.no_grad():
-                mask = []
+                mask = None
 
+                # Batches are uploaded one ahead through pinned memory on CUDA, overlapping the model call
                 if self.log_level == logging.DEBUG:
-                    process_batches = tqdm(range(0, patches, self.batch_size))
+                    process_batches = tqdm(prefetch_batches(batches(), device), total=total_iterations)
                 else:
-                    process_batches = tqdm(range(0, patches, self.batch_size), leave=False, desc="Processing batches")
-
-                for i in process_batches:
+                    process_batches = tqdm(prefetch_batches(batches(), device), total=total_iterations, leave=False, desc="Processing batches")
 
-                    X_batch = X_dataset[i : i + self.batch_size]
-                    X_batch = torch.from_numpy(X_batch).to(device)
+                for i, X_batch, _ in process_batches:
                     pred = self.model_run.predict_mask(X_batch)
                     if not pred.size()[3] > 0:
                         raise ValueError(f"Window size error: h1_shape[3] must be greater than h2_shape[3]")
-                    pred = pred.detach().cpu().numpy()
-                    pred = np.concatenate(pred, axis=2)
-                    mask.append(pred)
-                if len(mask) == 0:
-                    raise ValueError(f"Window size error: h1_shape[3] must be greater than h2_shape[3]")
-
-                mask = np.concatenate(mask, axis=2)
+                    pred = pred.cpu().numpy()
+                    n, channels, bins, width = pred.shape
+                    if mask is None:
+                        mask = np.empty((channels, bins, patches * width), dtype=pred.dtype)
+                    # The windows of the batch side by side along time, as np.concatenate(pred, axis=2)
+                    mask[:, :, i * width : (i + n) * width] = pred.transpose(1, 2, 0, 3).reshape(channels, bins, n * width)
             return mask
 
         def postprocess(mask, X_mag, X_phase):
@@ -307,7 +488,10 @@ class VRSeparator(CommonSeparator):
             mask = spec_utils.adjust_aggr(mask, is_non_accom_stem, aggressiveness)
 
             if self.enable_post_process:
-                mask = spec_utils.merge_artifacts(mask, thres=self.post_process_threshold)
+                if self.spec_backend == "torch":
+                    mask = spec_utils_torch.merge_artifacts(torch.from_numpy(mask).to(self.spec_device()), thres=self.post_process_threshold).cpu().numpy()
+                else:
+                    mask = spec_utils.merge_artifacts(mask, thres=self.post_process_threshold)
 
             y_spec = mask * X_mag * np.exp(1.0j * X_phase)
             v_spec = (1 - mask) * X_mag * np.exp(1.0j * X_phase)
@@ -336,7 +520,28 @@ class VRSeparator(CommonSeparator):
 
         return y_spec, v_spec
 
+    def spec_device(self):
+        """Device of the torch spec backend, the separator's device except on MPS, which lacks complex FFT support."""
+        return self.torch_device_cpu if self.torch_device_mps is not None else self.torch_device
+
+    def wave_to_spectrogram(self, wave, bp, band):
+        if self.spec_backend == "torch":
+            wave = torch.from_numpy(np.ascontiguousarray(wave)).to(self.spec_device())
+            return spec_utils_torch.wave_to_spectrogram(wave, bp["hl"], bp["n_fft"], self.model_params, band=band, is_v51_model=self.is_vr_51_model)
+        return spec_utils.wave_to_spectrogram(wave, bp["hl"], bp["n_fft"], self.model_params, band=band, is_v51_model=self.is_vr_51_model)
+
     def spec_to_wav(self, spec):
+        if self.spec_backend == "torch":
+            device = self.spec_device()
+            spec = torch.from_numpy(np.ascontiguousarray(spec)).to(device)
+            if self.high_end_process and isinstance(self.input_high_end, np.ndarray) and self.input_high_end_h:
+                input_high_end = torch.from_numpy(np.array(self.input_high_end)).to(device)
+                input_high_end_ = spec_utils_torch.mirroring("mirroring", spec, input_high_end, self.model_params)
+                wav = spec_utils_torch.cmb_spectrogram_to_wave(spec, self.model_params, self.input_high_end_h, input_high_end_, is_v51_model=self.is_vr_51_model)
+            else:
+                wav = spec_utils_torch.cmb_spectrogram_to_wave(spec, self.model_params, is_v51_model=self.is_vr_51_model)
+            return wav.cpu().numpy()
+
         if self.high_end_process and isinstance(self.input_high_end, np.ndarray) and self.input_high_end_h:
             input_high_end_ = spec_utils.mirroring("mirroring", spec, self.input_high_end, self.model_params)
             wav = spec_utils.cmb_spectrogram_to_wave(spec, self.model_params, self.input_high_end_h, input_high_end_, is_v51_model=self.is_vr_51_model)
@@ -3,7 +3,6 @@ __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
 import argparse
 import time
-import librosa
 from tqdm import tqdm
 import sys
 import os
@@ -12,9 +11,16 @@ import torch
 import numpy as np
 import soundfile as sf
 import torch.nn as nn
+from collections import deque
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
-from utils import demix, get_model_from_config
+from utils import demix_tracks, demix_stream, get_model_from_config, load_config, config_fingerprint, compile_model, quantize_model, PRECISIONS
+from model_cache import model_cache, module_nbytes, file_signature
+from model_export import load_exported_model, exported_format
+from audio_io import load_audio, DEFAULT_AUDIO_CACHE_SIZE_MB, DEFAULT_AUDIO_CACHE_AGE_DAYS
+from result_cache import ResultCache, file_hash, DEFAULT_SIZE_MB, DEFAULT_AGE_DAYS
 import logging
 import warnings
 
@@ -26,12 +32,25 @@ logger = logging.getLogger(__name__)
 
 def run_folder(model, args, config, device):
     start_time = time.time()
-    model.eval()
     all_mixtures_path = glob.glob(args.input_folder + '/*.*')
     logger.info('Total files found: {}'.format(len(all_mixtures_path)))
     
     if not os.path.isdir(args.store_dir):
         os.mkdir(args.store_dir)
+
+    progress_bar = tqdm(total=len(all_mixtures_path), desc="Total progress")
+    separate_files(model, args, config, device, all_mixtures_path, progress_bar)
+    progress_bar.close()
+
+    logger.info("Elapsed time: {:.2f} sec".format(time.time() - start_time))
+    logger.info('Results are saved to: {}'.format(args.store_dir))
+
+def separate_files(model, args, config, device, all_mixtures_path, progress_bar):
+    """
+    Separates the files of all_mixtures_path, which can be any iterable of paths, and writes the results.
+    progress_bar needs update() and set_postfix(), it is updated once per file.
+    """
+    model.eval()
     extra_store_dir = args.extra_store_dir
     if not os.path.isdir(extra_store_dir):
         extra_store_dir = args.store_dir
@@ -40,88 +59,350 @@ def run_folder(model, args, config, device):
     if config.training.target_instrument is not None:
         instruments = [config.training.target_instrument]
     
-    all_mixtures_path = tqdm(all_mixtures_path, desc="Total progress")
-    for path in all_mixtures_path:
-        all_mixtures_path.set_postfix({'track': os.path.basename(path)})
+    result_cache = get_result_cache(args)
+    stem_names = list(instruments)
+    extract_instrumental = get_extract_instrumental(args.extract_instrumental, config, instruments)
+    if extract_instrumental is not None:
+        stem_names.append(extract_instrumental)
+
+    def load(path):
+        cache_key = None
+        if result_cache is not None:
+            cache_key = result_cache_key(args, config, path)
+            stems = result_cache.get(cache_key, stem_names)
+            if stems is not None:
+                return path, {'path': path, 'sr': 44100, 'stems': stems}
+        if args.streaming:
+            # Streamed files are read by separate_stream itself, there is nothing to prefetch
+            return path, {'path': path, 'cache_key': cache_key}
+        track = load_track(path, config, cache_dir=args.audio_cache_dir, cache_size=args.audio_cache_size, cache_age=args.audio_cache_age)
+        if track is not None:
+            track['cache_key'] = cache_key
+        return path, track
+
+    def load_tracks():
+        for path, track in prefetch_map(load, all_mixtures_path, 0 if args.streaming else args.io_workers):
+            progress_bar.set_postfix({'track': os.path.basename(path)})
+            if track is not None and 'stems' in track:
+                write_stems(args, track, track['stems'], instruments, extra_store_dir)
+                progress_bar.update(1)
+                continue
+            if args.streaming:
+                if separate_stream(model, args, config, device, path, instruments, extra_store_dir):
+                    progress_bar.update(1)
+                    continue
+                cache_key = track['cache_key']
+                track = load_track(path, config, cache_dir=args.audio_cache_dir, cache_size=args.audio_cache_size, cache_age=args.audio_cache_age)
+                if track is not None:
+                    track['cache_key'] = cache_key
+            if track is None:
+                progress_bar.update(1)
+                continue
+            yield track, track['mix']
+
+    # Chunks of consecutive tracks share batches, see demix_tracks. Results are written in the background
+    # while the next tracks are separated, at most io_workers tracks are kept waiting.
+    encoder = ThreadPoolExecutor(max_workers=args.io_workers) if args.io_workers > 0 else None
+    pending = deque()
+    try:
+        for track, waveforms in demix_tracks(config, model, load_tracks(), device, pbar=True, model_type=args.model_type, use_tta=args.use_tta):
+            if encoder is None:
+                save_track(args, config, track, waveforms, instruments, extra_store_dir, result_cache)
+                progress_bar.update(1)
+                continue
+            pending.append(encoder.submit(save_track, args, config, track, waveforms, instruments, extra_store_dir, result_cache))
+            while len(pending) > args.io_workers or (pending and pending[0].done()):
+                pending.popleft().result()
+                progress_bar.update(1)
+        while pending:
+            pending.popleft().result()
+            progress_bar.update(1)
+    finally:
+        if encoder is not None:
+            encoder.shutdown()
+
+class QueueProgress:
+    """Stands in for the progress bar in worker processes, progress is sent to the main process."""
+
+    def __init__(self, done_queue):
+        self.done_queue = done_queue
+
+    def update(self, n=1):
+        self.done_queue.put(n)
+
+    def set_postfix(self, *args, **kwargs):
+        pass
+
+def set_cpu_threads(threads=None, interop_threads=None):
+    """torch.set_num_threads / set_num_interop_threads, None leaves the torch default."""
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
         try:
-            mix, sr = librosa.load(path, sr = 44100, mono = False)
-        except Exception as e:
-            logger.warning('Cannot read track: {}'.format(path))
-            logger.warning('Error message: {}'.format(str(e)))
-            continue
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only possible before the first parallel work of the process, e.g. not in a reused server process
+            logger.warning('Cannot change the number of inter-op threads in this process, keeping {}'.format(torch.get_num_interop_threads()))
+    logger.info('CPU threads: {} intra-op, {} inter-op'.format(torch.get_num_threads(), torch.get_num_interop_threads()))
 
-        if len(mix.shape) == 1:
-            mix = np.stack([mix, mix], axis=0)
+def run_folder_worker(queue, done_queue, args, device, threads=None):
+    """Worker process of run_folder_multi_process, separates the files it takes from queue until it gets None."""
+    if device == 'cpu':
+        set_cpu_threads(threads, args.cpu_interop_threads)
+    torch.backends.cudnn.benchmark = True
+    model, config = load_model_from_args(args, device)
+    separate_files(model, args, config, device, iter(queue.get, None), QueueProgress(done_queue))
+    done_queue.put(None)
 
-        mix_orig = mix.copy()
-        if 'normalize' in config.inference:
-            if config.inference['normalize'] is True:
-                mono = mix.mean(0)
-                mean = mono.mean()
-                std = mono.std()
-                mix = (mix - mean) / std
+def run_folder_multi_process(args, devices, threads=None):
+    """
+    Same as run_folder with one worker process per entry of devices, each with its own copy of the model, taking
+    whole files from a shared queue (as valid_multi_gpu in valid.py does).
 
-        if args.use_tta:
-            track_proc_list = [mix.copy(), mix[::-1].copy(), -1. * mix.copy()]
-        else:
-            track_proc_list = [mix.copy()]
-
-        full_result = []
-        for mix in track_proc_list:
-            waveforms = demix(config, model, mix, device, pbar=True, model_type=args.model_type)
-            full_result.append(waveforms)
-
-        waveforms = full_result[0]
-        for i in range(1, len(full_result)):
-            d = full_result[i]
-            for el in d:
-                if i == 2:
-                    waveforms[el] += -1.0 * d[el]
-                elif i == 1:
-                    waveforms[el] += d[el][::-1].copy()
-                else:
-                    waveforms[el] += d[el]
-        for el in waveforms:
-            waveforms[el] = waveforms[el] / len(full_result)
+    With several GPUs this replaces nn.DataParallel, which splits every chunk batch across the GPUs and gathers
+    the results on the first one: here the GPUs work independently and throughput grows with their number.
+    On CPU (devices is ['cpu'] * --cpu_workers) it shards the files between processes using `threads` threads
+    each, small chunk batches do not keep many cores busy in a single process.
+    """
+    start_time = time.time()
+    all_mixtures_path = glob.glob(args.input_folder + '/*.*')
+    logger.info('Total files found: {}'.format(len(all_mixtures_path)))
+    logger.info('Workers: {}'.format(', '.join(devices)))
 
-        for instr in instruments:
-            estimates = waveforms[instr].T
-            if 'normalize' in config.inference:
-                if config.inference['normalize'] is True:
-                    estimates = estimates * std + mean
-            file_name, _ = os.path.splitext(os.path.basename(path))
-            save_separated_files(args, sr, file_name, instr, estimates, extra_store_dir)
-
-        if args.extract_instrumental and config.training.target_instrument is not None:
-            if 'vocals' in instruments:
-                extract_instrumental = 'instrumental'
+    if not os.path.isdir(args.store_dir):
+        os.mkdir(args.store_dir)
+
+    # spawn: CUDA cannot be used in forked children, and this also runs inside inference_server.py
+    context = torch.multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    done_queue = context.Queue()
+    processes = []
+    for device in devices:
+        p = context.Process(target=run_folder_worker, args=(queue, done_queue, args, device, threads))
+        p.start()
+        processes.append(p)
+    for path in all_mixtures_path:
+        queue.put(path)
+    for _ in processes:
+        queue.put(None)  # sentinel value to signal workers to exit
+
+    progress_bar = tqdm(total=len(all_mixtures_path), desc="Total progress")
+    finished = 0
+    try:
+        while finished < len(processes):
+            try:
+                message = done_queue.get(timeout=1)
+            except Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError('A worker process failed, see the log above')
+                continue
+            if message is None:
+                finished += 1
             else:
-                extract_instrumental = 'other'
-            waveforms[extract_instrumental] = mix_orig - waveforms[config.training.target_instrument]
-            estimates = waveforms[extract_instrumental].T
-            if 'normalize' in config.inference:
-                if config.inference['normalize'] is True:
-                    estimates = estimates * std + mean
-            file_name, _ = os.path.splitext(os.path.basename(path))
-            save_separated_files(args, sr, file_name, extract_instrumental, estimates, extra_store_dir, isExtra=True)
+                progress_bar.update(message)
+    finally:
+        for p in processes:
+            if p.is_alive() and finished < len(processes):
+                p.terminate()
+            p.join()
+    progress_bar.close()
 
     logger.info("Elapsed time: {:.2f} sec".format(time.time() - start_time))
     logger.info('Results are saved to: {}'.format(args.store_dir))
 
+def prefetch_map(function, items, workers):
+    """
+    Like map(function, items), with up to `workers` items computed ahead in a thread pool.
+    Decoding and resampling release the GIL, so this overlaps them with inference.
+    """
+    if workers <= 0:
+        yield from map(function, items)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def load_track(path, config, sr=44100, cache_dir=None, cache_size=DEFAULT_AUDIO_CACHE_SIZE_MB, cache_age=DEFAULT_AUDIO_CACHE_AGE_DAYS):
+    try:
+        mix, sr = load_audio(path, sr = sr, cache_dir = cache_dir, cache_size = cache_size, cache_age = cache_age)
+    except Exception as e:
+        logger.warning('Cannot read track: {}'.format(path))
+        logger.warning('Error message: {}'.format(str(e)))
+        return None
+
+    return prepare_track(path, mix, sr, config)
+
+def prepare_track(path, mix, sr, config):
+    """Track dict for demix_tracks from a (channels, samples) or mono mix, normalized if the config asks for it."""
+    if len(mix.shape) == 1:
+        mix = np.stack([mix, mix], axis=0)
+
+    track = {'path': path, 'sr': sr, 'mix_orig': mix.copy()}
+    if 'normalize' in config.inference:
+        if config.inference['normalize'] is True:
+            mono = mix.mean(0)
+            track['mean'] = mono.mean()
+            track['std'] = mono.std()
+            mix = (mix - track['mean']) / track['std']
+    track['mix'] = mix
+    return track
+
+def get_extract_instrumental(extract_instrumental, config, instruments):
+    """Name of the stem extracted by inverting the target instrument, None if there is none or it is not asked for."""
+    if extract_instrumental and config.training.target_instrument is not None:
+        return 'instrumental' if 'vocals' in instruments else 'other'
+    return None
+
+def get_result_cache(args):
+    if not args.result_cache_dir:
+        return None
+    return ResultCache(args.result_cache_dir, int(args.result_cache_size * 1024 * 1024), args.result_cache_age * 86400)
+
+def result_cache_key(args, config, path):
+    # chunk_size and the rest of the model definition are part of config_fingerprint
+    params = {
+        'model_type': args.model_type,
+        'config': config_fingerprint(config),
+        'checkpoint': file_hash(args.start_check_point) if args.start_check_point != '' else None,
+        'exported_model': file_hash(args.exported_model) if args.exported_model else None,
+        'exported_format': exported_format(args.exported_model) if args.exported_model else None,
+        'num_overlap': config.inference.num_overlap,
+        'normalize': 'normalize' in config.inference and config.inference['normalize'] is True,
+        'use_tta': args.use_tta,
+        'precision': config.inference['precision'] if 'precision' in config.inference else 'auto',
+        'quantize': 'quantize' in config.inference and config.inference['quantize'] is True,
+    }
+    return ResultCache.key('msst', file_hash(path), params)
+
+def get_stems(config, track, waveforms, instruments, extract_instrumental=None):
+    """
+    Output stems of a track as (samples, channels) arrays. extract_instrumental is the name of the stem obtained
+    by inverting the target instrument (see get_extract_instrumental), None to skip it.
+    """
+    stems = {}
+    for instr in instruments:
+        estimates = waveforms[instr].T
+        if 'normalize' in config.inference:
+            if config.inference['normalize'] is True:
+                estimates = estimates * track['std'] + track['mean']
+        stems[instr] = estimates
+
+    if extract_instrumental is not None:
+        waveforms[extract_instrumental] = track['mix_orig'] - waveforms[config.training.target_instrument]
+        estimates = waveforms[extract_instrumental].T
+        if 'normalize' in config.inference:
+            if config.inference['normalize'] is True:
+                estimates = estimates * track['std'] + track['mean']
+        stems[extract_instrumental] = estimates
+    return stems
+
+def write_stems(args, track, stems, instruments, extra_store_dir):
+    file_name, _ = os.path.splitext(os.path.basename(track['path']))
+    for instr, estimates in stems.items():
+        save_separated_files(args, track['sr'], file_name, instr, estimates, extra_store_dir, isExtra=instr not in instruments)
+
+def save_track(args, config, track, waveforms, instruments, extra_store_dir, result_cache=None):
+    stems = get_stems(config, track, waveforms, instruments, get_extract_instrumental(args.extract_instrumental, config, instruments))
+    if result_cache is not None and track.get('cache_key') is not None:
+        result_cache.put(track['cache_key'], stems)
+    write_stems(args, track, stems, instruments, extra_store_dir)
+
+def separate_stream(model, args, config, device, path, instruments, extra_store_dir, sr=44100, block_seconds=30):
+    """
+    Streaming mode (--streaming): the file is read block by block with soundfile and the separated blocks are
+    appended to the output files as they come out of demix_stream, so memory use does not depend on the track length.
+    Returns False if the file cannot be streamed (unreadable by soundfile, or not at the model sample rate),
+    it is then processed the normal way.
+    """
+    try:
+        info = sf.info(path)
+    except Exception:
+        logger.info('Cannot stream {}, processing it in memory'.format(path))
+        return False
+    if info.samplerate != sr:
+        logger.info('{} is not at {} Hz, processing it in memory'.format(path, sr))
+        return False
+
+    def read_blocks(f, blocksize):
+        for block in f.blocks(blocksize=blocksize, dtype='float32', always_2d=True):
+            block = block.T
+            if block.shape[0] == 1:
+                block = np.concatenate([block, block], axis=0)
+            yield block
+
+    normalize = 'normalize' in config.inference and config.inference['normalize'] is True
+    mean, std = 0.0, 1.0
+    if normalize:
+        # Statistics of the mono mix, computed in a first pass over the file
+        total, total_sq, count = 0.0, 0.0, 0
+        with sf.SoundFile(path) as f:
+            for block in read_blocks(f, sr * block_seconds):
+                mono = block.mean(0).astype(np.float64)
+                total += mono.sum()
+                total_sq += np.square(mono).sum()
+                count += mono.shape[0]
+        mean = total / count
+        std = np.sqrt(max(total_sq / count - mean ** 2, 0.0))
+
+    def normalized_blocks(f):
+        for block in read_blocks(f, sr * block_seconds):
+            yield (block - mean) / std
+
+    extract_instrumental = get_extract_instrumental(args.extract_instrumental, config, instruments)
+
+    file_name, _ = os.path.splitext(os.path.basename(path))
+    channels = max(info.channels, 2)
+    outputs = {}
+    if args.output_format.lower() not in ['flac', 'mp3'] and info.frames * channels * 4 >= 2 ** 32:
+        # Plain WAV is limited to 4 GB
+        open_kwargs = {'format': 'RF64'}
+    else:
+        open_kwargs = {}
+    try:
+        for instr in instruments:
+            output_file, kwargs = get_output_file(args.output_format, args.store_dir, file_name, instr)
+            outputs[instr] = sf.SoundFile(output_file, 'w', samplerate=sr, channels=channels, **kwargs, **open_kwargs)
+        if extract_instrumental is not None:
+            output_file, kwargs = get_output_file(args.output_format, extra_store_dir, file_name, extract_instrumental)
+            outputs[extract_instrumental] = sf.SoundFile(output_file, 'w', samplerate=sr, channels=channels, **kwargs, **open_kwargs)
+
+        with sf.SoundFile(path) as f, sf.SoundFile(path) as f_orig:
+            for waveforms in demix_stream(config, model, normalized_blocks(f), info.frames, device, pbar=True, model_type=args.model_type, use_tta=args.use_tta):
+                for instr in instruments:
+                    outputs[instr].write(waveforms[instr].T * std + mean)
+                if extract_instrumental is not None:
+                    # The original mix is read in step with the separated output
+                    length = waveforms[config.training.target_instrument].shape[-1]
+                    mix_orig = f_orig.read(length, dtype='float32', always_2d=True)
+                    if mix_orig.shape[1] == 1:
+                        mix_orig = np.concatenate([mix_orig, mix_orig], axis=1)
+                    outputs[extract_instrumental].write((mix_orig - waveforms[config.training.target_instrument].T) * std + mean)
+    finally:
+        for output in outputs.values():
+            output.close()
+    return True
+
+def get_output_file(output_format, store_dir, file_name, instr):
+    """Returns the output path for a stem and the soundfile arguments for output_format."""
+    if output_format.lower() == 'flac':
+        return os.path.join(store_dir, f"{file_name}_{instr}.flac"), {'subtype': 'PCM_24'}
+    elif output_format.lower() == 'mp3':
+        return os.path.join(store_dir, f"{file_name}_{instr}.mp3"), {'format': 'MP3'}
+    else:
+        return os.path.join(store_dir, f"{file_name}_{instr}.wav"), {'subtype': 'FLOAT'}
+
 def save_separated_files(args, sr, file_name, instr, estimates, extra_store_dir, isExtra=False):
     if isExtra:
         store_dir = extra_store_dir
     else:
         store_dir = args.store_dir
-    if args.output_format.lower() == 'flac':
-        output_file = os.path.join(store_dir, f"{file_name}_{instr}.flac")
-        sf.write(output_file, estimates, sr, subtype='PCM_24')
-    elif args.output_format.lower() == 'mp3':
-        output_file = os.path.join(store_dir, f"{file_name}_{instr}.mp3")
-        sf.write(output_file, estimates, sr, format='mp3')
-    else:
-        output_file = os.path.join(store_dir, f"{file_name}_{instr}.wav")
-        sf.write(output_file, estimates, sr, subtype='FLOAT')
+    output_file, kwargs = get_output_file(args.output_format, store_dir, file_name, instr)
+    sf.write(output_file, estimates, sr, **kwargs)
 
 def proc_folder(args):
     parser = argparse.ArgumentParser(formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
@@ -136,41 +417,131 @@ def proc_folder(args):
     parser.add_argument("--extra_store_dir", default = "", type = str, help = "path to store extracted instrumental. If not provided, store_dir will be used")
     parser.add_argument("--force_cpu", action = 'store_true', help = "Force the use of CPU even if CUDA is available")
     parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality.")
+    parser.add_argument("--precision", type = str, default = None, choices = PRECISIONS, help = "inference precision, overrides inference.precision of the config. auto: fp16 on CUDA, fp32 elsewhere")
+    parser.add_argument("--compile", action='store_true', help="Run the model with torch.compile (same as inference.compile in the config). Slower start, faster chunk inference; compiled kernels are cached on disk and reused by later runs")
+    parser.add_argument("--quantize", action='store_true', help="CPU only: quantize the Linear and LSTM layers of the model to int8 (same as inference.quantize in the config). Faster on CPU at a small quality cost, tools/benchmark/precision_report.py measures it. Quantized models run in fp32, --precision is ignored")
+    parser.add_argument("--exported_model", type = str, default = None, help = "run a model exported with model_export.py (ONNX with ONNX Runtime, or TorchScript) instead of the checkpoint. --config_path must be the config it was exported with")
+    parser.add_argument("--compile_cache_dir", type = str, default = None, help = "folder for the compiled kernel cache (TORCHINDUCTOR_CACHE_DIR). If not provided, the torch default is used")
+    parser.add_argument("--audio_cache_dir", type = str, default = None, help = "cache decoded audio of compressed inputs (mp3, flac, ...) in this folder, re-running a file skips decoding")
+    parser.add_argument("--audio_cache_size", type = float, default = DEFAULT_AUDIO_CACHE_SIZE_MB, help = "maximum size of the decoded audio cache in MB, least recently used files are removed first")
+    parser.add_argument("--audio_cache_age", type = float, default = DEFAULT_AUDIO_CACHE_AGE_DAYS, help = "decoded audio unused for more days than this is removed from the cache")
+    parser.add_argument("--result_cache_dir", type = str, default = None, help = "cache separation results in this folder, re-running the same audio with the same model and settings reuses them")
+    parser.add_argument("--result_cache_size", type = float, default = DEFAULT_SIZE_MB, help = "maximum size of the result cache in MB, least recently used results are removed first")
+    parser.add_argument("--result_cache_age", type = float, default = DEFAULT_AGE_DAYS, help = "results unused for more days than this are removed from the cache")
+    parser.add_argument("--io_workers", type = int, default = 2, help = "number of threads decoding the next tracks and writing results while the model runs, 0 to do it in the inference loop")
+    parser.add_argument("--cpu_workers", type = int, default = 1, help = "on CPU, number of worker processes the files are shared between, each with its own copy of the model")
+    parser.add_argument("--cpu_threads", type = int, default = None, help = "on CPU, intra-op threads per process. If not provided, the cores are divided between the --cpu_workers processes (torch default for a single process). tools/benchmark/cpu_benchmark.py finds the best split")
+    parser.add_argument("--cpu_interop_threads", type = int, default = None, help = "on CPU, inter-op threads per process. If not provided, the torch default is used")
+    parser.add_argument("--data_parallel", action='store_true', help="With several --device_ids, split each batch across the GPUs with nn.DataParallel instead of running one worker process per GPU")
+    parser.add_argument("--streaming", action='store_true', help="Read and write files block by block, memory use does not grow with the track length. For very long inputs, only for files soundfile can read at 44100 Hz")
 
     if args is None:
         args = parser.parse_args()
     else:
         args = parser.parse_args(args)
 
+    if args.compile_cache_dir:
+        # Read by Inductor when it first needs the cache, also inherited by worker processes
+        os.makedirs(args.compile_cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(args.compile_cache_dir)
+
+    multi_gpu = type(args.device_ids) == list and len(args.device_ids) > 1 and not args.force_cpu and torch.cuda.is_available()
+    if multi_gpu and not args.data_parallel:
+        run_folder_multi_process(args, ['cuda:{}'.format(device_id) for device_id in args.device_ids])
+        return
+
+    device = get_device(args.force_cpu, args.device_ids)
+    if device == "cpu" and args.cpu_workers > 1:
+        threads = args.cpu_threads if args.cpu_threads else max(1, (os.cpu_count() or 1) // args.cpu_workers)
+        run_folder_multi_process(args, ['cpu'] * args.cpu_workers, threads)
+        return
+    logger.info(f"Using device: {device}")
+    if device == "cpu":
+        set_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
+    torch.backends.cudnn.benchmark = True
+
+    model, config = load_model_from_args(args, device)
+    logger.info("Instruments: {}".format(config.training.instruments))
+    
+    if multi_gpu and not args.exported_model:
+        model = nn.DataParallel(model, device_ids = args.device_ids)
+
+    run_folder(model, args, config, device)
+
+def get_device(force_cpu, device_ids):
     device = "cpu"
-    if args.force_cpu:
+    if force_cpu:
         device = "cpu"
     elif torch.cuda.is_available():
         device = "cuda"
-        device = f'cuda:{args.device_ids[0]}' if type(args.device_ids) == list else f'cuda:{args.device_ids}'
+        device = f'cuda:{device_ids[0]}' if type(device_ids) == list else f'cuda:{device_ids}'
     elif torch.backends.mps.is_available():
         device = "mps"
+    return device
 
-    logger.info(f"Using device: {device}")
-    torch.backends.cudnn.benchmark = True
+def load_model(model_type, config_path, start_check_point, device, compile=None, quantize=None):
+    """
+    Builds the model, loads the checkpoint and moves it to device. Loaded models are kept in model_cache,
+    so in a long-lived process (inference_server.py) repeated jobs with the same model skip all of that.
+    The config is always read again, edits to its inference section take effect without reloading the model.
+    With compile (default: inference.compile of the config) the model is wrapped in torch.compile, see
+    utils.compile_model. The compiled model is what gets cached, so its compiled graphs are reused by later jobs.
+    With quantize (default: inference.quantize of the config) the Linear and LSTM layers are quantized to int8,
+    see utils.quantize_model. Only on CPU, ignored with a warning on other devices.
+    """
+    config = load_config(model_type, config_path)
+    if compile is None:
+        compile = 'compile' in config.inference and config.inference['compile'] is True
+    # Tells demix to pad the last batch to the full batch size
+    config.inference['compile'] = compile
+    compile_mode = config.inference['compile_mode'] if 'compile_mode' in config.inference else None
+    if quantize is None:
+        quantize = 'quantize' in config.inference and config.inference['quantize'] is True
+    if quantize and str(device) != 'cpu':
+        logger.warning('int8 quantization is only available on CPU, running {} without it'.format(device))
+        quantize = False
+    config.inference['quantize'] = quantize
+    if quantize:
+        # The quantized layers run in fp32 around their int8 weights, autocast would only add casts
+        config.inference['precision'] = 'fp32'
+    checkpoint = file_signature(start_check_point) if start_check_point != '' else None
+    key = ('msst', model_type, config_fingerprint(config), checkpoint, str(device), compile_mode if compile else False, quantize)
+    model = model_cache.get(key)
+    if model is not None:
+        logger.info('Using cached model: {}'.format(start_check_point))
+        return model, config
 
-    model, config = get_model_from_config(args.model_type, args.config_path)
-    if args.start_check_point != '':
-        logger.info('Start from checkpoint: {}'.format(args.start_check_point))
-        if args.model_type == 'htdemucs':
-            state_dict = torch.load(args.start_check_point, map_location = device, weights_only=False)
+    model, _ = get_model_from_config(model_type, config_path)
+    if start_check_point != '':
+        logger.info('Start from checkpoint: {}'.format(start_check_point))
+        if model_type == 'htdemucs':
+            state_dict = torch.load(start_check_point, map_location = device, weights_only=False)
             if 'state' in state_dict:
                 state_dict = state_dict['state']
         else:
-            state_dict = torch.load(args.start_check_point, map_location = device, weights_only=True)
+            state_dict = torch.load(start_check_point, map_location = device, weights_only=True)
         model.load_state_dict(state_dict)
-    logger.info("Instruments: {}".format(config.training.instruments))
-    
-    if type(args.device_ids) == list and len(args.device_ids) > 1 and not args.force_cpu:
-        model = nn.DataParallel(model, device_ids = args.device_ids)
     model = model.to(device)
+    if quantize:
+        logger.info('Quantizing Linear and LSTM layers to int8')
+        model = quantize_model(model)
+    if compile:
+        logger.info('Compiling model with torch.compile, the first batches take longer')
+        model = compile_model(model, compile_mode)
+    model_cache.put(key, model, module_nbytes(model))
+    return model, config
 
-    run_folder(model, args, config, device)
+def load_model_from_args(args, device):
+    """load_model with the --compile and --precision options, or load_exported_model with --exported_model."""
+    if args.exported_model:
+        return load_exported_model(args.model_type, args.config_path, args.exported_model, device)
+    model, config = load_model(args.model_type, args.config_path, args.start_check_point, device, args.compile or None, args.quantize or None)
+    if args.precision is not None:
+        if config.inference['quantize']:
+            logger.warning('--precision {} is ignored for int8 quantized models, they run in fp32'.format(args.precision))
+        else:
+            config.inference['precision'] = args.precision
+    return model, config
 
 if __name__ == "__main__":
     proc_folder(None)
@@ -0,0 +1,131 @@
+"""
+Content-addressed disk cache of separation results.
+
+Re-running the same song through the same model (a preset tweak, a failed later step, another output format)
+used to redo the whole separation. Results are stored under a key made from the hash of the input file, the
+hash of the model checkpoint and the inference parameters that change the output, so a hit returns the stems
+without decoding or running the model. Renamed or copied inputs still hit, edited checkpoints miss.
+
+Layout: <cache_dir>/<key>/meta.json + one .npy per stem. Entries older than max_age or beyond max_bytes
+(least recently used first) are evicted after every write.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from cache_utils import file_signature
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE_MB = 20480
+DEFAULT_AGE_DAYS = 30
+
+_hash_lock = threading.Lock()
+_file_hashes = {}
+
+
+def file_hash(path):
+    """sha1 of the file content, memoized by (path, size, mtime) for the lifetime of the process."""
+    signature = file_signature(path)
+    with _hash_lock:
+        if signature in _file_hashes:
+            return _file_hashes[signature]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    with _hash_lock:
+        _file_hashes[signature] = digest.hexdigest()
+    return _file_hashes[signature]
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_SIZE_MB * 1024 * 1024, max_age=DEFAULT_AGE_DAYS * 86400):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Cache key from JSON serialisable parts, e.g. file_hash(audio), file_hash(checkpoint), params dict."""
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _stem_file(name):
+        return hashlib.sha1(name.encode('utf-8')).hexdigest()[:16] + '.npy'
+
+    def get(self, key, stems):
+        """
+        Returns {stem: array} for the requested stem names, or None unless all of them are cached.
+        Arrays are memory mapped, they are only read when used.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_file = os.path.join(entry_dir, 'meta.json')
+        try:
+            with open(meta_file, encoding='utf-8') as f:
+                meta = json.load(f)
+            if not all(stem in meta['stems'] for stem in stems):
+                return None
+            result = {stem: np.load(os.path.join(entry_dir, meta['stems'][stem]), mmap_mode='r') for stem in stems}
+            os.utime(meta_file)
+        except (OSError, ValueError, KeyError):
+            return None
+        logger.info('Using cached separation result {}'.format(key))
+        return result
+
+    def put(self, key, stems, dtype=np.float32):
+        """Stores {stem: array} as dtype (complex64 for spectrograms). Stems already cached under this key are kept."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_file = os.path.join(entry_dir, 'meta.json')
+        with self.lock:
+            os.makedirs(entry_dir, exist_ok=True)
+            try:
+                with open(meta_file, encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                meta = {'stems': {}}
+            for stem, array in stems.items():
+                file_name = self._stem_file(stem)
+                tmp_file = os.path.join(entry_dir, file_name + '.tmp')
+                with open(tmp_file, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(array, dtype=dtype))
+                os.replace(tmp_file, os.path.join(entry_dir, file_name))
+                meta['stems'][stem] = file_name
+            tmp_file = meta_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_file, meta_file)
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if not os.path.isdir(entry_dir):
+                continue
+            try:
+                last_used = os.stat(os.path.join(entry_dir, 'meta.json')).st_mtime
+            except OSError:
+                # Still being written
+                last_used = os.stat(entry_dir).st_mtime
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+            entries.append((last_used, size, entry_dir))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for last_used, size, entry_dir in entries:
+            if now - last_used <= self.max_age and total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logger.debug('Evicted cached separation result {}'.format(entry_dir))
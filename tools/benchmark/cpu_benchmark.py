@@ -0,0 +1,89 @@
+"""
+Finds the best split of the CPU cores between worker processes and threads for msst_inference.py on CPU
+(--cpu_workers / --cpu_threads).
+
+For every split, that many processes separate the same test signal at the same time, each with its own model
+and thread count, and the total throughput is reported. Weights are left random unless a checkpoint is given,
+the timing does not depend on them. Example:
+
+    python tools/benchmark/cpu_benchmark.py --model_type mdx23c --config_path configs/config_musdb18_mdx23c.yaml --splits 1x16 2x8 4x4
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils import demix
+from msst_inference import load_model
+
+
+def worker(model_type, config_path, start_check_point, threads, interop_threads, duration, barrier, results):
+    torch.set_num_threads(threads)
+    if interop_threads:
+        torch.set_num_interop_threads(interop_threads)
+    model, config = load_model(model_type, config_path, start_check_point, 'cpu')
+    model.eval()
+    sample_rate = config.training.samplerate if model_type == 'htdemucs' else 44100
+    mix = np.random.RandomState(0).uniform(-0.5, 0.5, (2, int(duration * sample_rate))).astype(np.float32)
+    # warm up
+    demix(config, model, mix[:, :sample_rate * 5], 'cpu', model_type=model_type)
+    barrier.wait()
+    start_time = time.perf_counter()
+    demix(config, model, mix, 'cpu', model_type=model_type)
+    results.put(time.perf_counter() - start_time)
+
+
+def benchmark(args, processes, threads):
+    """Audio seconds separated per second by `processes` processes with `threads` threads each."""
+    context = torch.multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(args.model_type, args.config_path, args.start_check_point, threads, args.interop_threads, args.duration, barrier, results)) for _ in range(processes)]
+    for p in workers:
+        p.start()
+    elapsed = [results.get() for _ in workers]
+    for p in workers:
+        p.join()
+    return processes * args.duration / max(elapsed)
+
+
+def default_splits(cores):
+    splits = []
+    processes = 1
+    while processes <= cores:
+        splits.append((processes, cores // processes))
+        processes *= 2
+    return splits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark process/thread splits for CPU inference.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--model_type", type=str, required=True, help="model type to benchmark")
+    parser.add_argument("--config_path", type=str, required=True, help="config file of the model")
+    parser.add_argument("--start_check_point", type=str, default='', help="checkpoint of the model. If not provided, random weights are used")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="number of cores to split (default: all of them)")
+    parser.add_argument("--splits", nargs='+', default=None, help="splits to try as PROCESSESxTHREADS, e.g. 4x8. If not provided, powers of two processes sharing --cores are tried")
+    parser.add_argument("--interop_threads", type=int, default=None, help="inter-op threads per process. If not provided, the torch default is used")
+    parser.add_argument("--duration", type=float, default=30, help="length of the test signal in seconds")
+    args = parser.parse_args()
+
+    if args.splits:
+        try:
+            splits = [tuple(int(value) for value in split.lower().split('x')) for split in args.splits]
+        except ValueError:
+            parser.error("--splits entries must look like 4x8")
+    else:
+        splits = default_splits(args.cores)
+
+    print("{:>10} {:>10} {:>16}".format("processes", "threads", "throughput (x RT)"))
+    results = {}
+    for processes, threads in splits:
+        results[(processes, threads)] = benchmark(args, processes, threads)
+        print("{:>10} {:>10} {:>16.2f}".format(processes, threads, results[(processes, threads)]))
+    processes, threads = max(results, key=results.get)
+    print("Best: --force_cpu --cpu_workers {} --cpu_threads {}".format(processes, threads))
@@ -0,0 +1,66 @@
+"""
+Measures demix throughput with and without the pipelined chunk prefetch (inference.prefetch).
+
+Weights are left random unless a checkpoint is given, the timing does not depend on them. Example:
+
+    python tools/benchmark/demix_benchmark.py --model_types mdx23c htdemucs --config_paths configs/config_musdb18_mdx23c.yaml configs/config_musdb18_htdemucs.yaml
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils import demix
+from msst_inference import load_model
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def benchmark(model_type, config_path, start_check_point, device, duration, repeats):
+    model, config = load_model(model_type, config_path, start_check_point, device)
+    model.eval()
+    sample_rate = config.training.samplerate if model_type == 'htdemucs' else 44100
+    mix = np.random.RandomState(0).uniform(-0.5, 0.5, (2, int(duration * sample_rate))).astype(np.float32)
+
+    results = {}
+    for prefetch in (False, True):
+        config.inference['prefetch'] = prefetch
+        # warm up (cudnn autotuning, allocator)
+        demix(config, model, mix[:, :sample_rate * 10], device, model_type=model_type)
+        timings = []
+        for _ in range(repeats):
+            synchronize(device)
+            start_time = time.perf_counter()
+            demix(config, model, mix, device, model_type=model_type)
+            synchronize(device)
+            timings.append(time.perf_counter() - start_time)
+        results[prefetch] = duration / min(timings)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the demix chunk prefetch.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--model_types", nargs='+', required=True, help="model types to benchmark")
+    parser.add_argument("--config_paths", nargs='+', required=True, help="config file for each model type")
+    parser.add_argument("--start_check_points", nargs='+', default=None, help="checkpoint for each model type. If not provided, random weights are used")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="inference device")
+    parser.add_argument("--duration", type=float, default=60, help="length of the test signal in seconds")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per setting, the fastest one is reported")
+    args = parser.parse_args()
+    if len(args.config_paths) != len(args.model_types):
+        parser.error("--config_paths needs one entry per model type")
+    checkpoints = args.start_check_points if args.start_check_points else [''] * len(args.model_types)
+
+    torch.backends.cudnn.benchmark = True
+    print("{:<20} {:>14} {:>14} {:>8}".format("model_type", "sync (x RT)", "prefetch (x RT)", "gain"))
+    for model_type, config_path, checkpoint in zip(args.model_types, args.config_paths, checkpoints):
+        results = benchmark(model_type, config_path, checkpoint, args.device, args.duration, args.repeats)
+        print("{:<20} {:>14.2f} {:>14.2f} {:>7.1f}%".format(model_type, results[False], results[True], (results[True] / results[False] - 1) * 100))
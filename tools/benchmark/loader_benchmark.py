@@ -0,0 +1,64 @@
+"""
+Compares audio_io.load_audio with the librosa.load path msst_inference.py used before, on WAV, FLAC and MP3
+inputs at 44100 Hz and 48000 Hz (the latter needs resampling). MP3 needs libsndfile >= 1.1.
+
+    python tools/benchmark/loader_benchmark.py --duration 240
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import soundfile as sf
+import librosa
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from audio_io import load_audio
+
+
+def best_time(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark audio loading.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--duration", type=float, default=120, help="length of the test files in seconds")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per case, the fastest one is reported")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(work_dir, 'cache')
+    try:
+        print("{:<12} {:>12} {:>12} {:>12} {:>10}".format("file", "librosa (s)", "load_audio", "cached", "max diff"))
+        for file_sr in (44100, 48000):
+            t = np.arange(int(args.duration * file_sr)) / file_sr
+            audio = np.stack([0.5 * np.sin(2 * np.pi * 440 * t), 0.1 * np.random.RandomState(0).randn(t.shape[0])], axis=1).astype(np.float32)
+            for extension, kwargs in (('wav', {'subtype': 'FLOAT'}), ('flac', {'subtype': 'PCM_24'}), ('mp3', {'format': 'MP3'})):
+                path = os.path.join(work_dir, 'test_{}.{}'.format(file_sr, extension))
+                try:
+                    sf.write(path, audio, file_sr, **kwargs)
+                except Exception as e:
+                    print("{:<12} skipped: {}".format(extension, e))
+                    continue
+
+                reference = librosa.load(path, sr=44100, mono=False)[0]
+                result = load_audio(path, sr=44100)[0]
+                length = min(reference.shape[-1], result.shape[-1])
+                diff = np.abs(reference[..., :length] - result[..., :length]).max()
+
+                librosa_time = best_time(lambda: librosa.load(path, sr=44100, mono=False), args.repeats)
+                load_time = best_time(lambda: load_audio(path, sr=44100), args.repeats)
+                load_audio(path, sr=44100, cache_dir=cache_dir)
+                cached_time = best_time(lambda: load_audio(path, sr=44100, cache_dir=cache_dir), args.repeats)
+                print("{:<12} {:>12.3f} {:>12.3f} {:>12.3f} {:>10.2e}".format('{} {}'.format(extension, file_sr), librosa_time, load_time, cached_time, diff))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
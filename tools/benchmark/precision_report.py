@@ -0,0 +1,83 @@
+"""
+Accuracy/speed report of the inference precisions (inference.precision) of a model, to pick the fastest one
+that does not cost separation quality.
+
+Every precision is run through valid.py on a validation set (folders with mixture.wav and one file per stem),
+the SDR and the time are compared with fp32. The fastest precision within --tolerance dB of the fp32 SDR is
+recommended, set it as inference.precision in the model config. On CPU, int8 (dynamic quantization, see
+utils.quantize_model) is compared as well, set inference.quantize: true or use --quantize if it is recommended.
+Example:
+
+    python tools/benchmark/precision_report.py --model_type bs_roformer --config_path configs/vocal_models/model_bs_roformer_ep_317_sdr_12.9755.yaml --start_check_point pretrain/vocal_models/model_bs_roformer_ep_317_sdr_12.9755.ckpt --valid_path musdb18hq/valid
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils import inference_precision
+from msst_inference import load_model
+from valid import valid
+
+
+def run(model_type, config_path, start_check_point, device, precision, args):
+    if precision == 'int8':
+        model, config = load_model(model_type, config_path, start_check_point, device, quantize=True)
+        effective = 'int8' if config.inference['quantize'] else 'fp32'
+    else:
+        model, config = load_model(model_type, config_path, start_check_point, device, quantize=False)
+        config.inference['precision'] = precision
+        effective = inference_precision(config, device, model_type)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+    start_time = time.perf_counter()
+    sdr_avg = valid(model, args, config, device, verbose=False)
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+    return effective, float(sdr_avg), time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare inference precisions of a model on a validation set.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--model_type", type=str, required=True, help="model type")
+    parser.add_argument("--config_path", type=str, required=True, help="config file of the model")
+    parser.add_argument("--start_check_point", type=str, required=True, help="checkpoint of the model")
+    parser.add_argument("--valid_path", type=str, required=True, help="validation set, as for valid.py")
+    parser.add_argument("--extension", type=str, default='wav', help="extension of the validation files")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="inference device")
+    parser.add_argument("--precisions", nargs='+', default=None, help="precisions to compare, fp32 is always included. If not provided: fp16 and bf16, and int8 on CPU")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="largest SDR loss in dB, compared to fp32, for a precision to be recommended")
+    parser.add_argument("--use_tta", action='store_true', help="validate with test time augmentation")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    torch.backends.cudnn.benchmark = True
+    # The attributes valid.py reads from its own command line
+    args.store_dir = ""
+    if args.precisions is None:
+        args.precisions = ['fp16', 'bf16'] + (['int8'] if args.device == 'cpu' else [])
+    precisions = ['fp32'] + [precision for precision in args.precisions if precision != 'fp32']
+
+    results = {}
+    for precision in precisions:
+        effective, sdr_avg, elapsed = run(args.model_type, args.config_path, args.start_check_point, args.device, precision, args)
+        if effective != precision:
+            print("{} is not available on {}, skipped".format(precision, args.device))
+            continue
+        results[precision] = (sdr_avg, elapsed)
+
+    sdr_ref, time_ref = results['fp32']
+    print("{:<10} {:>10} {:>10} {:>10} {:>8}".format("precision", "SDR", "delta", "time (s)", "speedup"))
+    for precision, (sdr_avg, elapsed) in results.items():
+        print("{:<10} {:>10.4f} {:>+10.4f} {:>10.2f} {:>7.2f}x".format(precision, sdr_avg, sdr_avg - sdr_ref, elapsed, time_ref / elapsed))
+    safe = [precision for precision, (sdr_avg, _) in results.items() if sdr_avg >= sdr_ref - args.tolerance]
+    best = min(safe, key=lambda precision: results[precision][1])
+    if best == 'int8':
+        print("Recommended: inference.quantize: true")
+    else:
+        print("Recommended: inference.precision: {}".format(best))
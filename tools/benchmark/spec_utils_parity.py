@@ -0,0 +1,136 @@
+"""
+Checks that the torch spec backend of the VR separator (spec_utils_torch, --vr_spec_backend torch) gives the same
+results as the NumPy one (spec_utils), and compares their speed.
+
+For every model params file, a test signal goes through wave_to_spectrogram, combine_spectrograms, mirroring,
+cmb_spectrogram_to_wave and merge_artifacts with both backends. The largest difference relative to the peak of
+the NumPy output is reported, the script exits with an error when it is above --tolerance. Example:
+
+    python tools/benchmark/spec_utils_parity.py --params configs_backup/vr_modelparams/4band_v3.json --device cuda
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+import librosa
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from models.vocal_remover.uvr_lib_v5 import spec_utils
+from models.vocal_remover.uvr_lib_v5 import spec_utils_torch
+from models.vocal_remover.uvr_lib_v5.vr_network.model_param_init import ModelParameters
+
+
+def relative_error(expected, actual):
+    expected = np.asarray(expected)
+    actual = actual.cpu().numpy() if isinstance(actual, torch.Tensor) else np.asarray(actual)
+    length = min(expected.shape[-1], actual.shape[-1])
+    return float(np.max(np.abs(expected[..., :length] - actual[..., :length])) / max(np.max(np.abs(expected)), 1e-8))
+
+
+def timed(function, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    if isinstance(result, torch.Tensor) and result.is_cuda:
+        torch.cuda.synchronize(result.device)
+    return result, time.perf_counter() - start_time
+
+
+def band_waves(wave, mp):
+    """Input of every band, resampled as VRSeparator.compute_input_spec does."""
+    bands_n = len(mp.param["band"])
+    waves = {}
+    for d in range(bands_n, 0, -1):
+        bp = mp.param["band"][d]
+        if d == bands_n:
+            waves[d] = librosa.resample(wave, orig_sr=44100, target_sr=bp["sr"], res_type=bp["res_type"])
+        else:
+            waves[d] = librosa.resample(waves[d + 1], orig_sr=mp.param["band"][d + 1]["sr"], target_sr=bp["sr"], res_type=bp["res_type"])
+    return waves
+
+
+def check(params_path, wave, device, is_v51_model):
+    mp = ModelParameters(params_path)
+    bands_n = len(mp.param["band"])
+    waves = band_waves(wave, mp)
+    errors, numpy_time, torch_time = {}, 0.0, 0.0
+
+    specs_np, specs_t = {}, {}
+    for d in range(1, bands_n + 1):
+        bp = mp.param["band"][d]
+        specs_np[d], elapsed_np = timed(spec_utils.wave_to_spectrogram, waves[d], bp["hl"], bp["n_fft"], mp, band=d, is_v51_model=is_v51_model)
+        specs_t[d], elapsed_t = timed(spec_utils_torch.wave_to_spectrogram, torch.from_numpy(waves[d]).to(device), bp["hl"], bp["n_fft"], mp, band=d, is_v51_model=is_v51_model)
+        errors["wave_to_spectrogram"] = max(errors.get("wave_to_spectrogram", 0.0), relative_error(specs_np[d], specs_t[d]))
+        numpy_time += elapsed_np
+        torch_time += elapsed_t
+
+    spec_np, elapsed_np = timed(spec_utils.combine_spectrograms, specs_np, mp, is_v51_model=is_v51_model)
+    spec_t, elapsed_t = timed(spec_utils_torch.combine_spectrograms, specs_t, mp, is_v51_model=is_v51_model)
+    errors["combine_spectrograms"] = relative_error(spec_np, spec_t)
+    numpy_time += elapsed_np
+    torch_time += elapsed_t
+
+    bp = mp.param["band"][bands_n]
+    high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (mp.param["pre_filter_stop"] - mp.param["pre_filter_start"])
+    high_end_np = specs_np[bands_n][:, bp["n_fft"] // 2 - high_end_h : bp["n_fft"] // 2, :]
+    high_end_t = specs_t[bands_n][:, bp["n_fft"] // 2 - high_end_h : bp["n_fft"] // 2, :]
+    mirror_np, elapsed_np = timed(spec_utils.mirroring, "mirroring", spec_np, high_end_np, mp)
+    mirror_t, elapsed_t = timed(spec_utils_torch.mirroring, "mirroring", spec_t, high_end_t, mp)
+    errors["mirroring"] = relative_error(mirror_np, mirror_t)
+    numpy_time += elapsed_np
+    torch_time += elapsed_t
+
+    wave_np, elapsed_np = timed(spec_utils.cmb_spectrogram_to_wave, spec_np, mp, high_end_h, mirror_np, is_v51_model=is_v51_model)
+    wave_t, elapsed_t = timed(spec_utils_torch.cmb_spectrogram_to_wave, spec_t, mp, high_end_h, mirror_t, is_v51_model=is_v51_model)
+    errors["cmb_spectrogram_to_wave"] = relative_error(wave_np, wave_t)
+    numpy_time += elapsed_np
+    torch_time += elapsed_t
+
+    mask = np.abs(spec_np) / max(np.abs(spec_np).max(), 1e-8)
+    mask_np, elapsed_np = timed(spec_utils.merge_artifacts, mask.copy(), thres=0.2)
+    mask_t, elapsed_t = timed(spec_utils_torch.merge_artifacts, torch.from_numpy(mask.copy()).to(device), thres=0.2)
+    errors["merge_artifacts"] = relative_error(mask_np, mask_t)
+    numpy_time += elapsed_np
+    torch_time += elapsed_t
+
+    return errors, numpy_time, torch_time
+
+
+if __name__ == "__main__":
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description="Compare the numpy and torch spec backends of the VR separator.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
+    parser.add_argument("--params", nargs='+', default=None, help="model params files to check. If not provided, all of configs_backup/vr_modelparams")
+    parser.add_argument("--audio", type=str, default=None, help="audio file to use. If not provided, a random test signal is used")
+    parser.add_argument("--duration", type=float, default=20, help="length of the test signal in seconds")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="device of the torch backend")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="largest accepted difference, relative to the peak of the numpy output")
+    args = parser.parse_args()
+
+    params = args.params or sorted(glob.glob(os.path.join(root, "configs_backup", "vr_modelparams", "*.json")))
+    if args.audio:
+        wave, _ = librosa.load(args.audio, sr=44100, mono=False, dtype=np.float32, duration=args.duration)
+        if wave.ndim == 1:
+            wave = np.asarray([wave, wave])
+    else:
+        wave = np.random.RandomState(0).uniform(-0.5, 0.5, (2, int(args.duration * 44100))).astype(np.float32)
+
+    failed = False
+    print("{:<32} {:<24} {:>12} {:>10} {:>10}".format("params", "function", "max error", "numpy (s)", "torch (s)"))
+    for params_path in params:
+        # VR 5.1 models read the same params with the convert_channels variants
+        for is_v51_model in (False, True):
+            errors, numpy_time, torch_time = check(params_path, wave, args.device, is_v51_model)
+            name = os.path.basename(params_path) + (" (v5.1)" if is_v51_model else "")
+            for i, (function, error) in enumerate(errors.items()):
+                times = ("{:>10.3f} {:>10.3f}".format(numpy_time, torch_time)) if i == 0 else ""
+                print("{:<32} {:<24} {:>12.2e} {}".format(name if i == 0 else "", function, error, times))
+                failed = failed or error > args.tolerance
+
+    if failed:
+        print("Some results differ by more than {}".format(args.tolerance))
+        sys.exit(1)
+    print("All results match within {}".format(args.tolerance))
@@ -1,6 +1,13 @@
 # coding: utf-8
 __author__ = 'Roman Solovyev (ZFTurbo): https://github.com/ZFTurbo/'
 
+import json
+import hashlib
+import logging
+import itertools
+import contextlib
+from functools import lru_cache
+from types import SimpleNamespace
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,13 +18,32 @@ from tqdm import tqdm
 from numpy.typing import NDArray
 from typing import Dict
 
+logger = logging.getLogger(__name__)
 
-def get_model_from_config(model_type, config_path):
+def load_config(model_type, config_path):
     with open(config_path) as f:
         if model_type == 'htdemucs':
             config = OmegaConf.load(config_path)
         else:
             config = ConfigDict(yaml.load(f, Loader=yaml.FullLoader))
+    return config
+
+
+def config_fingerprint(config, ignore=('inference',)):
+    """
+    Digest of the config sections that define the network. The inference section (batch_size, num_overlap, ...)
+    is ignored by default, so tweaking it does not invalidate cached models.
+    """
+    if isinstance(config, ConfigDict):
+        config = config.to_dict()
+    else:
+        config = OmegaConf.to_container(config, resolve=True)
+    config = {k: v for k, v in config.items() if k not in ignore}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_model_from_config(model_type, config_path):
+    config = load_config(model_type, config_path)
 
     if model_type == 'mdx23c':
         from models.mdx23c_tfc_tdf_v3 import TFC_TDF_net
@@ -78,139 +104,311 @@ def _getWindowingArray(window_size, fade_size):
     window[:fade_size] *= fadein
     return window
 
-def demix_track(config, model, mix, device, pbar=False):
-    C = config.audio.chunk_size
-    N = config.inference.num_overlap
-    fade_size = C // 10
-    step = int(C // N)
-    border = C - step
-    batch_size = config.inference.batch_size
-
-    length_init = mix.shape[-1]
-
-    # Do pad from the beginning and end to account floating window results better
-    if length_init > 2 * border and (border > 0):
-        mix = nn.functional.pad(mix, (border, border), mode='reflect')
-
-    # windowingArray crossfades at segment boundaries to mitigate clicking artifacts
-    windowingArray = _getWindowingArray(C, fade_size)
-
-    with torch.cuda.amp.autocast():
-        with torch.inference_mode():
-            if config.training.target_instrument is not None:
-                req_shape = (1, ) + tuple(mix.shape)
-            else:
-                req_shape = (len(config.training.instruments),) + tuple(mix.shape)
-
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
+@lru_cache(maxsize=2)
+def _window_weights(chunk_size, step, fade_size, length):
+    """
+    Sum of the weighting windows at every sample of a mix of `length` samples, i.e. what the overlap-add has to be
+    divided by. It depends only on these parameters, so it is computed once as a 1-D vector and cached (the TTA
+    passes of a track share it). The first chunk has no fade-in and the last one no fade-out, as in demix_track.
+    """
+    window = _getWindowingArray(chunk_size, fade_size) if fade_size > 0 else torch.ones(chunk_size)
+    weights = torch.zeros(length + chunk_size)
+    starts = range(0, length, step)
+    for start in starts:
+        weights[start:start + chunk_size] += window
+    if fade_size > 0:
+        weights[:fade_size] += 1 - window[:fade_size]
+        weights[starts[-1] + chunk_size - fade_size:starts[-1] + chunk_size] += 1 - window[-fade_size:]
+    return weights[:length]
+
+def _fold_chunks(x, step):
+    """
+    Overlap-adds chunks taken every `step` samples: (B, ..., C) -> (..., (B - 1) * step + C).
+    Each chunk is cut into ceil(C / step) segments of `step` samples. Segment k of all chunks lands on contiguous,
+    non-overlapping output samples, so the whole batch is summed on its device with ceil(C / step) vectorized adds.
+    """
+    batch_size, chunk_size = x.shape[0], x.shape[-1]
+    segments = -(-chunk_size // step)
+    x = nn.functional.pad(x, (0, segments * step - chunk_size))
+    x = x.reshape(x.shape[:-1] + (segments, step)).movedim(0, -2)
+    lead_shape = x.shape[:-3]
+    out = torch.zeros(lead_shape + ((batch_size + segments - 1) * step,), dtype=x.dtype, device=x.device)
+    for k in range(segments):
+        out[..., k * step:(k + batch_size) * step] += x[..., k, :, :].reshape(lead_shape + (batch_size * step,))
+    return out[..., :(batch_size - 1) * step + chunk_size]
+
+def _accumulation_device(req_shape, device, config, live_bytes=0):
+    """
+    Device for the result accumulator. It stays on the inference device, so batches are added without a host sync,
+    unless inference.accumulate_on_device is false or, together with the live_bytes of accumulators already on
+    the device, it would take more than half of the free device memory (the rest is left for the model).
+    Otherwise each folded batch is copied to a CPU accumulator.
+    """
+    device = torch.device(device)
+    if 'accumulate_on_device' in config.inference and not config.inference['accumulate_on_device']:
+        return torch.device('cpu')
+    if device.type == 'cuda':
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        required_memory = int(np.prod(req_shape)) * 4
+        # The live accumulators are already taken from the free memory
+        if required_memory + live_bytes > (free_memory + live_bytes) // 2:
+            logger.info('Track is too long to accumulate on {} ({:.0f} MB needed), using CPU accumulation'.format(device, required_memory / 2 ** 20))
+            return torch.device('cpu')
+    return device
+
+PRECISIONS = ('auto', 'fp32', 'fp16', 'bf16')
+_precision_warnings = set()
+
+def inference_precision(config, device, model_type=None):
+    """
+    Precision the model runs in on device, from inference.precision in the config:
+    auto (default) is fp16 autocast on CUDA (for htdemucs only with training.use_amp) and fp32 elsewhere,
+    fp32 / fp16 / bf16 ask for that type. fp16 needs CUDA, bf16 a CUDA GPU supporting it or the CPU.
+    Where the requested type is not available fp32 is used, with a warning.
+    """
+    precision = config.inference['precision'] if 'precision' in config.inference else 'auto'
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown inference.precision: {}, use one of {}'.format(precision, ', '.join(PRECISIONS)))
+    device_type = torch.device(device).type
+    if precision == 'auto':
+        if device_type != 'cuda' or (model_type == 'htdemucs' and not config.training.use_amp):
+            return 'fp32'
+        return 'fp16'
+    if precision == 'fp16':
+        supported = device_type == 'cuda'
+    elif precision == 'bf16':
+        supported = device_type == 'cpu' or (device_type == 'cuda' and torch.cuda.is_bf16_supported())
+    else:
+        supported = True
+    if not supported:
+        if (precision, device_type) not in _precision_warnings:
+            _precision_warnings.add((precision, device_type))
+            logger.warning('{} inference is not supported on {}, using fp32'.format(precision, device))
+        return 'fp32'
+    return precision
+
+def _autocast(precision, device):
+    """Autocast context for a precision returned by inference_precision."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=torch.float16 if precision == 'fp16' else torch.bfloat16)
+
+def _pad_chunk(part, chunk_size, reflect_tail=False):
+    length = part.shape[-1]
+    if length < chunk_size:
+        if reflect_tail and length > chunk_size // 2 + 1:
+            part = nn.functional.pad(input=part, pad=(0, chunk_size - length), mode='reflect')
+        else:
+            part = nn.functional.pad(input=part, pad=(0, chunk_size - length, 0, 0), mode='constant', value=0)
+    return part
+
+def _chunk_batches(mix, chunk_size, step, batch_size, reflect_tail=False):
+    """
+    Cuts mix (channels, samples) into chunks every `step` samples and yields (start, batch, last) on the CPU,
+    batch having shape (B, channels, chunk_size). The last chunk is zero padded, or reflect padded if
+    reflect_tail is set and it is longer than half a chunk.
+    """
+    i = 0
+    start = 0
+    batch_data = []
+    while i < mix.shape[1]:
+        batch_data.append(_pad_chunk(mix[:, i:i + chunk_size], chunk_size, reflect_tail))
+        i += step
+
+        if len(batch_data) >= batch_size or i >= mix.shape[1]:
+            yield start, torch.stack(batch_data, dim=0), i >= mix.shape[1]
             batch_data = []
-            batch_locations = []
-            progress_bar = tqdm(total=mix.shape[1], desc="Processing audio chunks", leave=False) if pbar else None
-
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    if length > C // 2 + 1:
-                        part = nn.functional.pad(input=part, pad=(0, C - length), mode='reflect')
-                    else:
-                        part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
-
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
-                    x = model(arr)
-
-                    window = windowingArray
-                    if i - step == 0:  # First audio chunk, no fadein
-                        window[:fade_size] = 1
-                    elif i >= mix.shape[1]:  # Last audio chunk, no fadeout
-                        window[-fade_size:] = 1
-
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu() * window[..., :l]
-                        counter[..., start:start+l] += window[..., :l]
-
-                    batch_data = []
-                    batch_locations = []
-
-                if progress_bar:
-                    progress_bar.update(step)
-
-            if progress_bar:
-                progress_bar.close()
-
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
-
-            if length_init > 2 * border and (border > 0):
-                # Remove pad
-                estimated_sources = estimated_sources[..., border:-border]
-
-    if config.training.target_instrument is None:
-        return {k: v for k, v in zip(config.training.instruments, estimated_sources)}
+            start = i
+
+def _stream_chunk_batches(blocks, length, pad, chunk_size, step, batch_size, reflect_tail=False):
+    """
+    Same as _chunk_batches for a mix that arrives as consecutive blocks (channels, samples), `length` samples in
+    total. The mix is reflect padded by `pad` samples on both sides, like demix_track does. Chunks are cut as soon
+    as their input has arrived and only the input from the next chunk on is kept.
+    """
+    total = length + 2 * pad
+    buffer = None
+    buffer_start = 0  # position of buffer[:, 0] in the padded mix
+    padded = pad == 0
+    i = 0
+    start = 0
+    batch_data = []
+    for block in itertools.chain(blocks, [None]):
+        ended = block is None
+        if not ended:
+            block = torch.as_tensor(block, dtype=torch.float32)
+            buffer = block if buffer is None else torch.cat([buffer, block], dim=-1)
+            if not padded:
+                if buffer.shape[-1] <= pad:
+                    continue
+                buffer = nn.functional.pad(buffer, (pad, 0), mode='reflect')
+                padded = True
+        elif buffer is None:
+            return
+        elif pad > 0:
+            buffer = nn.functional.pad(buffer, (0, pad), mode='reflect')
+
+        # Until the input has ended, keep the last pad + 1 samples back for the reflect padding of the end
+        available = buffer_start + buffer.shape[-1] - (0 if ended else pad + 1)
+        while i < total and (ended or i + chunk_size <= available):
+            batch_data.append(_pad_chunk(buffer[:, i - buffer_start:i - buffer_start + chunk_size], chunk_size, reflect_tail))
+            i += step
+
+            if len(batch_data) >= batch_size or i >= total:
+                yield start, torch.stack(batch_data, dim=0), i >= total
+                batch_data = []
+                start = i
+        buffer = buffer[:, i - buffer_start:]
+        buffer_start = i
+
+def prefetch_batches(batches, device, enabled=True):
+    """
+    Moves the batches from _chunk_batches (or any (start, tensor, last) tuples, see VRSeparator.inference_vr) to
+    device, one batch ahead of the consumer. On CUDA each batch is staged in pinned memory and uploaded on a side
+    stream, so the copy of the next batch overlaps the model call on the current one.
+    """
+    device = torch.device(device)
+    if not enabled or device.type != 'cuda':
+        for start, arr, last in batches:
+            yield start, arr.to(device), last
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+    compute_stream = torch.cuda.current_stream(device)
+
+    def upload(start, arr, last):
+        arr = arr.pin_memory()
+        with torch.cuda.stream(copy_stream):
+            arr = arr.to(device, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record(copy_stream)
+        return start, arr, last, ready
+
+    pending = None
+    for batch in batches:
+        uploaded = upload(*batch)
+        if pending is not None:
+            start, arr, last, ready = pending
+            compute_stream.wait_event(ready)
+            arr.record_stream(compute_stream)
+            yield start, arr, last
+        pending = uploaded
+    if pending is not None:
+        start, arr, last, ready = pending
+        compute_stream.wait_event(ready)
+        arr.record_stream(compute_stream)
+        yield start, arr, last
+
+def _tta_forward(model, arr):
+    """
+    Test time augmentation in a single model call: the chunks, their channel-swapped and their polarity-inverted
+    copies go through the model as one batch. The augmentations are undone on the outputs, which are averaged.
+    """
+    batch_size = arr.shape[0]
+    x = model(torch.cat([arr, arr.flip(-2), -arr], dim=0))
+    return (x[:batch_size] + x[batch_size:2 * batch_size].flip(-2) - x[2 * batch_size:]) / 3
+
+def _forward(model, arr, use_tta=False, fixed_batch_size=None):
+    """
+    Model call for a batch of chunks. With fixed_batch_size (compiled models, see compile_model) a smaller batch,
+    the last one, is padded with silent chunks, so the model always sees the same input shape and is not
+    recompiled. The outputs of the padding are dropped.
+    """
+    rows = arr.shape[0]
+    if fixed_batch_size is not None and rows < fixed_batch_size:
+        arr = torch.cat([arr, arr.new_zeros((fixed_batch_size - rows,) + tuple(arr.shape[1:]))], dim=0)
+    x = _tta_forward(model, arr) if use_tta else model(arr)
+    return x[:rows]
+
+def _fixed_batch_size(config, batch_size):
+    """Batch size every batch is padded to, None unless the model is compiled (inference.compile)."""
+    if 'compile' in config.inference and config.inference['compile'] is True:
+        return batch_size
+    return None
+
+def compile_model(model, mode=None):
+    """
+    Wraps a model in torch.compile for inference. The demix functions pad the last batch when inference.compile is
+    set, so all batches have one shape and the model is compiled once, for static shapes. mode is passed to
+    torch.compile, e.g. "reduce-overhead" to also capture CUDA graphs. Compiled kernels are kept in the Inductor
+    FX graph cache on disk (TORCHINDUCTOR_CACHE_DIR) and reused by later processes, which removes most of the
+    warm-up. Parts dynamo cannot compile fall back to eager execution.
+    """
+    import torch._dynamo
+    import torch._inductor.config
+    torch._dynamo.config.suppress_errors = True
+    if hasattr(torch._inductor.config, 'fx_graph_cache'):
+        torch._inductor.config.fx_graph_cache = True
+    return torch.compile(model, mode=mode, dynamic=False)
+
+def quantize_model(model):
+    """
+    Post-training dynamic int8 quantization for CPU inference: the weights of the nn.Linear and nn.LSTM layers
+    (roformer attention, feed-forward and mask estimators, the LSTMs of the VR CascadedNet) are stored as int8 and
+    their activations quantized on the fly. Other layers keep running in fp32. Only for CPU, quantized kernels do
+    not exist on CUDA. tools/benchmark/precision_report.py reports the SDR cost of int8 for a model.
+    """
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+def _overlap_add(result, x, window, start, step):
+    """
+    Adds the model output for a batch of consecutive chunks (the first one starting at `start`) to the accumulator.
+    window has shape (B, C), one weighting window per chunk.
+    """
+    batch_size, chunk_size = x.shape[0], x.shape[-1]
+    weighted = x.float() * window.view((batch_size,) + (1,) * (x.dim() - 2) + (chunk_size,))
+    weighted = _fold_chunks(weighted, step)
+    length = weighted.shape[-1]
+    result[..., start:start + length] += weighted.to(result.device)
+
+def _demix_setup(config, device, model_type=None, use_tta=False):
+    """
+    Parameters shared by the demix functions: chunk size C, fade size, step, border (reflect padding of the mix),
+    instruments, batch size, prefetch, precision, fixed batch size and the windowing array on device.
+    htdemucs chunks are not faded nor padded.
+    """
+    if model_type == 'htdemucs':
+        C = config.training.samplerate * config.training.segment
+        fade_size = 0
+        instruments = list(config.training.instruments)
     else:
-        return {k: v for k, v in zip([config.training.target_instrument], estimated_sources)}
-
-def demix_track_demucs(config, model, mix, device, pbar=False):
-    S = len(config.training.instruments)
-    C = config.training.samplerate * config.training.segment
-    N = config.inference.num_overlap
+        C = config.audio.chunk_size
+        fade_size = C // 10
+        if config.training.target_instrument is not None:
+            instruments = [config.training.target_instrument]
+        else:
+            instruments = list(config.training.instruments)
+    step = int(C // config.inference.num_overlap)
+    border = C - step if model_type != 'htdemucs' else 0
     batch_size = config.inference.batch_size
-    step = C // N
-    # print(S, C, N, step, mix.shape, mix.device)
-
-    with torch.cuda.amp.autocast(enabled=config.training.use_amp):
-        with torch.inference_mode():
-            req_shape = (S, ) + tuple(mix.shape)
-            result = torch.zeros(req_shape, dtype=torch.float32)
-            counter = torch.zeros(req_shape, dtype=torch.float32)
-            i = 0
-            batch_data = []
-            batch_locations = []
-            progress_bar = tqdm(total=mix.shape[1], desc="Processing audio chunks", leave=False) if pbar else None
-
-            while i < mix.shape[1]:
-                # print(i, i + C, mix.shape[1])
-                part = mix[:, i:i + C].to(device)
-                length = part.shape[-1]
-                if length < C:
-                    part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode='constant', value=0)
-                batch_data.append(part)
-                batch_locations.append((i, length))
-                i += step
-
-                if len(batch_data) >= batch_size or (i >= mix.shape[1]):
-                    arr = torch.stack(batch_data, dim=0)
-                    x = model(arr)
-                    for j in range(len(batch_locations)):
-                        start, l = batch_locations[j]
-                        result[..., start:start+l] += x[j][..., :l].cpu()
-                        counter[..., start:start+l] += 1.
-                    batch_data = []
-                    batch_locations = []
-
-                if progress_bar:
-                    progress_bar.update(step)
-
-            if progress_bar:
-                progress_bar.close()
-
-            estimated_sources = result / counter
-            estimated_sources = estimated_sources.cpu().numpy()
-            np.nan_to_num(estimated_sources, copy=False, nan=0.0)
-
-    if S > 1:
-        return {k: v for k, v in zip(config.training.instruments, estimated_sources)}
+    if use_tta:
+        # Every chunk goes through the model three times
+        batch_size = max(1, batch_size // 3)
+    if fade_size > 0:
+        # windowingArray crossfades at segment boundaries to mitigate clicking artifacts
+        windowingArray = _getWindowingArray(C, fade_size).to(device)
     else:
-        return estimated_sources
+        windowingArray = torch.ones(C, device=device)
+    return SimpleNamespace(
+        C=C,
+        fade_size=fade_size,
+        step=step,
+        border=border,
+        instruments=instruments,
+        batch_size=batch_size,
+        prefetch=config.inference['prefetch'] if 'prefetch' in config.inference else True,
+        precision=inference_precision(config, device, model_type),
+        fixed_batch_size=_fixed_batch_size(config, batch_size),
+        windowingArray=windowingArray,
+    )
+
+def demix_track(config, model, mix, device, pbar=False, use_tta=False):
+    for _, waveforms in demix_tracks(config, model, [(None, mix)], device, pbar=pbar, use_tta=use_tta):
+        return waveforms
+
+def demix_track_demucs(config, model, mix, device, pbar=False, use_tta=False):
+    for _, waveforms in demix_tracks(config, model, [(None, mix)], device, pbar=pbar, model_type='htdemucs', use_tta=use_tta):
+        return waveforms
 
 
 def sdr(references, estimates):
@@ -222,9 +420,175 @@ def sdr(references, estimates):
     den += delta
     return 10 * np.log10(num / den)
 
-def demix(config, model, mix: NDArray, device, pbar=False, model_type: str = None) -> Dict[str, NDArray]:
+def demix_stream(config, model, blocks, length, device, pbar=False, model_type: str = None, use_tta=False):
+    """
+    Streaming version of demix for tracks too long to hold in memory.
+
+    blocks yields consecutive pieces of the mix as arrays (channels, samples) and length is the total number of
+    samples. Chunks are separated as soon as their input has arrived and only the overlap-sized tail of the
+    accumulator is kept. Yields dicts {instrument: (channels, samples)} of consecutive output samples, which add
+    up to the same result as demix.
+    """
+    setup = _demix_setup(config, device, model_type, use_tta)
+    C, fade_size, step, instruments, windowingArray = setup.C, setup.fade_size, setup.step, setup.instruments, setup.windowingArray
+    pad = setup.border if length > 2 * setup.border and setup.border > 0 else 0
+    total = length + 2 * pad
+
+    result = None
+    weights = None
+    result_start = 0  # position of result[..., 0] in the padded mix
+    progress_bar = tqdm(total=total, desc="Processing audio chunks", leave=False) if pbar else None
+
+    # The autocast/inference contexts are entered per batch, so they are not active in the caller between yields
+    batches = _stream_chunk_batches(blocks, length, pad, C, step, setup.batch_size, reflect_tail=model_type != 'htdemucs')
+    for batch_start, arr, last in prefetch_batches(batches, device, enabled=setup.prefetch):
+        with _autocast(setup.precision, device):
+            with torch.inference_mode():
+                x = _forward(model, arr, use_tta, setup.fixed_batch_size)
+
+                window = windowingArray.repeat(arr.shape[0], 1)
+                if fade_size > 0:
+                    if batch_start == 0:  # First audio chunk, no fadein
+                        window[0, :fade_size] = 1
+                    if last:  # Last audio chunk, no fadeout
+                        window[-1, -fade_size:] = 1
+
+                batch_end = batch_start + (arr.shape[0] - 1) * step + C - result_start
+                if result is None:
+                    result = torch.zeros((len(instruments),) + tuple(arr.shape[1:-1]) + (batch_end,), dtype=torch.float32, device=device)
+                    weights = torch.zeros(batch_end, dtype=torch.float32, device=device)
+                elif batch_end > result.shape[-1]:
+                    grow = batch_end - result.shape[-1]
+                    result = nn.functional.pad(result, (0, grow))
+                    weights = nn.functional.pad(weights, (0, grow))
+                _overlap_add(result, x, window, batch_start - result_start, step)
+                window = _fold_chunks(window, step)
+                weights[batch_start - result_start:batch_start - result_start + window.shape[-1]] += window
+
+                # No later chunk reaches before the start of the next one, these samples are final
+                done = min(batch_start + arr.shape[0] * step, total) - result_start
+                low = max(pad - result_start, 0)
+                high = min(pad + length - result_start, done)
+                estimated_sources = None
+                if high > low:
+                    estimated_sources = (result[..., low:high] / weights[low:high]).cpu().numpy()
+                    np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+                result = result[..., done:]
+                weights = weights[done:]
+                result_start += done
+
+        if progress_bar:
+            progress_bar.update(arr.shape[0] * step)
+        if estimated_sources is not None:
+            yield {k: v for k, v in zip(instruments, estimated_sources)}
+
+    if progress_bar:
+        progress_bar.close()
+
+def _pooled_chunk_batches(tracks, chunk_size, step, batch_size, reflect_tail=False):
+    """
+    Packs the chunks of consecutive tracks into full batches. tracks yields track dicts holding the padded mix.
+    Yields (chunks, batch, last) like _chunk_batches, with chunks listing (track, start, last) for every row of
+    the batch and last always False.
+    """
+    chunks = []
+    batch_data = []
+    for track in tracks:
+        for start, arr, last in _chunk_batches(track['mix'], chunk_size, step, 1, reflect_tail):
+            chunks.append((track, start, last))
+            batch_data.append(arr[0])
+            if len(batch_data) >= batch_size:
+                yield chunks, torch.stack(batch_data, dim=0), False
+                chunks = []
+                batch_data = []
+    if batch_data:
+        yield chunks, torch.stack(batch_data, dim=0), False
+
+def demix_tracks(config, model, mixes, device, pbar=False, model_type: str = None, use_tta=False):
+    """
+    Separates several tracks with their chunks pooled into the same batches, so short tracks do not leave
+    batches half empty. mixes yields (key, mix) pairs; (key, waveforms) is yielded for every track as soon as
+    its last chunk is done, in input order, with waveforms the same as demix would return. With pbar the
+    chunks are counted in a progress bar, which grows as tracks come in.
+    """
+    setup = _demix_setup(config, device, model_type, use_tta)
+    C, fade_size, step, instruments, windowingArray = setup.C, setup.fade_size, setup.step, setup.instruments, setup.windowingArray
+    progress_bar = tqdm(total=0, desc="Processing audio chunks", leave=False) if pbar else None
+    # Size of the accumulators on the device of the tracks not finished yet, several are live with pooled batches
+    live_bytes = [0]
+
+    def tracks():
+        for key, mix in mixes:
+            mix = torch.as_tensor(mix, dtype=torch.float32)
+            length_init = mix.shape[-1]
+            # Do pad from the beginning and end to account floating window results better
+            pad = setup.border if length_init > 2 * setup.border and setup.border > 0 else 0
+            if pad > 0:
+                mix = nn.functional.pad(mix, (pad, pad), mode='reflect')
+            # The accumulator is one chunk longer than the mix, so the padded tail of the last chunks
+            # can be added without masking and cropped at the end
+            req_shape = (len(instruments),) + tuple(mix.shape[:-1]) + (mix.shape[-1] + C,)
+            result = torch.zeros(req_shape, dtype=torch.float32, device=_accumulation_device(req_shape, device, config, live_bytes[0]))
+            if result.device.type != 'cpu':
+                live_bytes[0] += result.numel() * result.element_size()
+            if progress_bar:
+                progress_bar.total += mix.shape[-1]
+                progress_bar.refresh()
+            yield {'key': key, 'mix': mix, 'pad': pad, 'result': result}
+
+    def finish(track):
+        result, length = track['result'], track['mix'].shape[-1]
+        weights = _window_weights(C, step, fade_size, length).to(result.device)
+        # In place, a second accumulator sized tensor would not fit in the memory budgeted for it
+        estimated_sources = result[..., :length].div_(weights).cpu().numpy()
+        if result.device.type != 'cpu':
+            live_bytes[0] -= result.numel() * result.element_size()
+        track['result'] = None
+        np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+        if track['pad'] > 0:
+            estimated_sources = estimated_sources[..., track['pad']:-track['pad']]
+        if model_type == 'htdemucs' and len(instruments) == 1:
+            return estimated_sources
+        return {k: v for k, v in zip(instruments, estimated_sources)}
+
+    batches = _pooled_chunk_batches(tracks(), C, step, setup.batch_size, reflect_tail=model_type != 'htdemucs')
+    try:
+        for chunks, arr, _ in prefetch_batches(batches, device, enabled=setup.prefetch):
+            with _autocast(setup.precision, device):
+                with torch.inference_mode():
+                    x = _forward(model, arr, use_tta, setup.fixed_batch_size)
+
+                    window = windowingArray.repeat(arr.shape[0], 1)
+                    if fade_size > 0:
+                        for j, (track, start, last) in enumerate(chunks):
+                            if start == 0:  # First audio chunk, no fadein
+                                window[j, :fade_size] = 1
+                            if last:  # Last audio chunk, no fadeout
+                                window[j, -fade_size:] = 1
+
+                    # Overlap-add each run of consecutive chunks of the same track at once
+                    finished = []
+                    first = 0
+                    for j in range(1, len(chunks) + 1):
+                        if j < len(chunks) and chunks[j][0] is chunks[first][0]:
+                            continue
+                        track, start, _ = chunks[first]
+                        _overlap_add(track['result'], x[first:j], window[first:j], start, step)
+                        if chunks[j - 1][2]:
+                            finished.append((track['key'], finish(track)))
+                        first = j
+
+            if progress_bar:
+                progress_bar.update(arr.shape[0] * step)
+            for key, waveforms in finished:
+                yield key, waveforms
+    finally:
+        if progress_bar:
+            progress_bar.close()
+
+def demix(config, model, mix: NDArray, device, pbar=False, model_type: str = None, use_tta=False) -> Dict[str, NDArray]:
     mix = torch.tensor(mix, dtype=torch.float32)
     if model_type == 'htdemucs':
-        return demix_track_demucs(config, model, mix, device, pbar=pbar)
+        return demix_track_demucs(config, model, mix, device, pbar=pbar, use_tta=use_tta)
     else:
-        return demix_track(config, model, mix, device, pbar=pbar)
+        return demix_track(config, model, mix, device, pbar=pbar, use_tta=use_tta)
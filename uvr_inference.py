@@ -5,14 +5,18 @@ import logging
 import time
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
-from models.vocal_remover.separator import Separator
+from models.vocal_remover.separator import Separator, DEFAULT_SPEC_CACHE_SIZE_MB
+from result_cache import DEFAULT_SIZE_MB, DEFAULT_AGE_DAYS
+from audio_io import BIT_DEPTHS
 
 def inference(parser, args):
     logger = logging.getLogger(__name__)
     log_handler = logging.StreamHandler()
     log_formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d [%(levelname)s] %(module)s - %(message)s", datefmt="%H:%M:%S")
     log_handler.setFormatter(log_formatter)
-    logger.addHandler(log_handler)
+    # Avoid stacking handlers when called repeatedly from a long-lived process (see inference_server.py)
+    if not logger.hasHandlers():
+        logger.addHandler(log_handler)
 
     log_level = logging.DEBUG if args.debug else logging.INFO
     logger.setLevel(log_level)
@@ -31,6 +35,7 @@ def inference(parser, args):
         output_dir=args.output_dir,
         extra_output_dir=args.extra_output_dir,
         output_format=args.output_format,
+        output_bit_depth=args.output_bit_depth,
         normalization_threshold=args.normalization,
         output_single_stem=args.single_stem,
         invert_using_spec=args.invert_spect,
@@ -44,14 +49,21 @@ def inference(parser, args):
             "enable_post_process": args.vr_enable_post_process,
             "post_process_threshold": args.vr_post_process_threshold,
             "high_end_process": args.vr_high_end_process,
+            "quantize": args.vr_quantize,
+            "spec_backend": args.vr_spec_backend,
         },
+        result_cache_dir=args.result_cache_dir,
+        result_cache_size=args.result_cache_size,
+        result_cache_age=args.result_cache_age,
+        spec_cache_dir=args.spec_cache_dir,
+        spec_cache_size=args.spec_cache_size,
     )
     separator.load_model(model_filename=args.model_filename)
     output_files = separator.separate(args.audio_file)
     logger.info(f"Separator finished in {time.time() - start_time:.2f} seconds.")
     logger.info(f"Results are saved to: {output_files}")
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser(description="Separate audio file into different stems.", formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=60))
 
     parser.add_argument("audio_file", nargs="?", help="The audio file path to separate, in any common format. You can input file path or file folder path", default=argparse.SUPPRESS)
@@ -59,16 +71,28 @@ if __name__ == "__main__":
 
     model_filename_help = "model to use for separation (default: %(default)s). Example: -m 2_HP-UVR.pth"
     output_format_help = "output format for separated files, any common format (default: %(default)s). Example: --output_format=MP3"
+    output_bit_depth_help = "sample format of WAV and FLAC outputs: 16, 24 or 32f (32 bit float, FLAC is written at 24 bit) (default: %(default)s). Example: --output_bit_depth=32f"
     output_dir_help = "directory to write output files (default: <current dir>). Example: --output_dir=/app/separated"
     model_file_dir_help = "model files directory (default: %(default)s). Example: --model_file_dir=/app/models"
     extra_output_dir_help = "extra output directory for saving another stem. If not provided, output_dir will be used. Example: --extra_output_dir=/app/extra_output"
+    result_cache_dir_help = "cache separation results in this directory, re-running the same audio with the same model and settings reuses them (default: disabled). Example: --result_cache_dir=cache/separation_results"
+    result_cache_size_help = "maximum size of the result cache in MB, least recently used results are removed first (default: %(default)s)"
+    result_cache_age_help = "results unused for more days than this are removed from the cache (default: %(default)s)"
+    spec_cache_dir_help = "cache the input spectrograms of VR models in this directory, later runs on the same audio with models sharing the model params skip decoding and STFT (default: disabled). Example: --spec_cache_dir=cache/vr_spectrograms"
+    spec_cache_size_help = "maximum size of the spectrogram cache in MB, with the age limit of the result cache (default: %(default)s)"
 
     io_params = parser.add_argument_group("Separation I/O Params")
     io_params.add_argument("-m", "--model_filename", default="1_HP-UVR.pth", help=model_filename_help)
     io_params.add_argument("--output_format", default="FLAC", help=output_format_help)
+    io_params.add_argument("--output_bit_depth", default="16", choices=list(BIT_DEPTHS), help=output_bit_depth_help)
     io_params.add_argument("--output_dir", default=None, help=output_dir_help)
     io_params.add_argument("--model_file_dir", default="pretrain/VR_Models", help=model_file_dir_help)
     io_params.add_argument("--extra_output_dir", default=None, help=extra_output_dir_help)
+    io_params.add_argument("--result_cache_dir", default=None, help=result_cache_dir_help)
+    io_params.add_argument("--result_cache_size", type=float, default=DEFAULT_SIZE_MB, help=result_cache_size_help)
+    io_params.add_argument("--result_cache_age", type=float, default=DEFAULT_AGE_DAYS, help=result_cache_age_help)
+    io_params.add_argument("--spec_cache_dir", default=None, help=spec_cache_dir_help)
+    io_params.add_argument("--spec_cache_size", type=float, default=DEFAULT_SPEC_CACHE_SIZE_MB, help=spec_cache_size_help)
 
     invert_spect_help = "invert secondary stem using spectogram (default: %(default)s). Example: --invert_spect"
     normalization_help = "max peak amplitude to normalize input and output audio to (default: %(default)s). Example: --normalization=0.7"
@@ -89,6 +113,8 @@ if __name__ == "__main__":
     vr_high_end_process_help = "mirror the missing frequency range of the output (default: %(default)s). Example: --vr_high_end_process"
     vr_enable_post_process_help = "identify leftover artifacts within vocal output; may improve separation for some songs (default: %(default)s). Example: --vr_enable_post_process"
     vr_post_process_threshold_help = "threshold for post_process feature: 0.1-0.3 (default: %(default)s). Example: --vr_post_process_threshold=0.1"
+    vr_spec_backend_help = "where the spectrograms are computed and converted back to audio: numpy (librosa on the CPU) or torch (on the inference device) (default: %(default)s). Example: --vr_spec_backend=torch"
+    vr_quantize_help = "CPU only: quantize the Linear and LSTM layers of the model to int8, faster at a small quality cost (default: %(default)s). Example: --vr_quantize"
 
     vr_params = parser.add_argument_group("VR Architecture Parameters")
     vr_params.add_argument("--vr_batch_size", type=int, default=4, help=vr_batch_size_help)
@@ -98,6 +124,12 @@ if __name__ == "__main__":
     vr_params.add_argument("--vr_high_end_process", action="store_true", help=vr_high_end_process_help)
     vr_params.add_argument("--vr_enable_post_process", action="store_true", help=vr_enable_post_process_help)
     vr_params.add_argument("--vr_post_process_threshold", type=float, default=0.2, help=vr_post_process_threshold_help)
+    vr_params.add_argument("--vr_quantize", action="store_true", help=vr_quantize_help)
+    vr_params.add_argument("--vr_spec_backend", default="numpy", choices=["numpy", "torch"], help=vr_spec_backend_help)
+
+    return parser
 
+if __name__ == "__main__":
+    parser = get_parser()
     args = parser.parse_args()
     inference(parser, args)
\ No newline at end of file
@@ -20,7 +20,7 @@ warnings.filterwarnings("ignore")
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
 
-from utils import demix, sdr, get_model_from_config
+from utils import demix, sdr, get_model_from_config, PRECISIONS
 
 import logging
 log_format = "%(asctime)s.%(msecs)03d [%(levelname)s] %(module)s - %(message)s"
@@ -74,30 +74,8 @@ def proc_list_of_files(
                 std = mono.std()
                 mix = (mix - mean) / std
 
-        if args.use_tta:
-            # orig, channel inverse, polarity inverse
-            track_proc_list = [mix.copy(), mix[::-1].copy(), -1. * mix.copy()]
-        else:
-            track_proc_list = [mix.copy()]
-
-        full_result = []
-        for mix in track_proc_list:
-            waveforms = demix(config, model, mix, device, model_type=args.model_type)
-            full_result.append(waveforms)
-
-        # Average all values in single dict
-        waveforms = full_result[0]
-        for i in range(1, len(full_result)):
-            d = full_result[i]
-            for el in d:
-                if i == 2:
-                    waveforms[el] += -1.0 * d[el]
-                elif i == 1:
-                    waveforms[el] += d[el][::-1].copy()
-                else:
-                    waveforms[el] += d[el]
-        for el in waveforms:
-            waveforms[el] = waveforms[el] / len(full_result)
+        # With use_tta the original, channel inverse and polarity inverse are averaged within one pass
+        waveforms = demix(config, model, mix, device, model_type=args.model_type, use_tta=args.use_tta)
 
         pbar_dict = {}
         for instr in instruments:
@@ -278,6 +256,7 @@ def check_validation(args):
     parser.add_argument("--pin_memory", action='store_true', help="dataloader pin_memory")
     parser.add_argument("--extension", type=str, default='wav', help="Choose extension for validation")
     parser.add_argument("--use_tta", action='store_true', help="Flag adds test time augmentation during inference (polarity and channel inverse). While this triples the runtime, it reduces noise and slightly improves prediction quality.")
+    parser.add_argument("--precision", type=str, default=None, choices=PRECISIONS, help="inference precision, overrides inference.precision of the config")
     if args is None:
         args = parser.parse_args()
     else:
@@ -287,6 +266,8 @@ def check_validation(args):
     torch.multiprocessing.set_start_method('spawn')
 
     model, config = get_model_from_config(args.model_type, args.config_path)
+    if args.precision is not None:
+        config.inference['precision'] = args.precision
     if args.start_check_point != '':
         logger.info('Start from checkpoint: {}'.format(args.start_check_point))
         state_dict = torch.load(args.start_check_point)
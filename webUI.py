@@ -26,6 +26,7 @@ from tkinter import filedialog
 from pydub import AudioSegment
 from torch import cuda, backends
 from multiprocessing import cpu_count
+from inference_server import SeparationClient
 
 PACKAGE_VERSION = "1.6.1"
 WEBUI_CONFIG = "data/webui_config.json"
@@ -37,6 +38,7 @@ LANGUAGE = "data/language.json"
 BACKUP = "backup"
 MODEL_FOLDER = "pretrain"
 TEMP_PATH = "tmpdir"
+RESULT_CACHE_PATH = "cache/separation_results"
 UNOFFICIAL_MODEL = "config_unofficial"
 VR_MODELPARAMS = "configs/vr_modelparams"
 MODEL_TYPE = ['bs_roformer', 'mel_band_roformer', 'segm_models', 'htdemucs', 'mdx23c', 'swin_upernet', 'bandit', 'bandit_v2', 'scnet', 'scnet_unofficial', 'torchseg']
@@ -47,6 +49,8 @@ PYTHON = "./workenv/python.exe" if os.path.isfile("./workenv/python.exe") else s
 warnings.filterwarnings("ignore")
 stop_all_threads = False
 stop_infer_flow = False
+separation_client = None
+separation_lock = threading.Lock()
 
 def setup_webui():
     def copy_folders():
@@ -92,6 +96,8 @@ def setup_webui():
     print(i18n("[INFO] 设备信息: ") + str(get_device()))
 
 def webui_restart():
+    if separation_client is not None:
+        separation_client.terminate()
     os.execl(PYTHON, PYTHON, *sys.argv)
 
 def i18n(key):
@@ -490,10 +496,53 @@ def run_command(command):
         print(e)
         raise gr.Error(i18n("发生错误! 请前往终端查看详细信息"))
 
+def use_separation_server():
+    config = load_configs(WEBUI_CONFIG)
+    return config["settings"].get("persistent_server", True)
+
+def result_cache_options():
+    config = load_configs(WEBUI_CONFIG)
+    if config["settings"].get("result_cache", True):
+        return ["--result_cache_dir", RESULT_CACHE_PATH]
+    return []
+
+def get_separation_client():
+    global separation_client
+    if separation_client is None:
+        separation_client = SeparationClient(python=PYTHON)
+    return separation_client
+
+def run_server_job(task, args):
+    global stop_all_threads
+    # The server handles one job at a time over a single connection, jobs from other tabs wait here
+    with separation_lock:
+        stop_all_threads = False
+        print_command(f"{task} " + " ".join(f"\"{arg}\"" if " " in str(arg) else str(arg) for arg in args), title="Use separation server")
+        try:
+            finished = get_separation_client().run(task, args, should_stop=lambda: stop_all_threads)
+            if not finished:
+                stop_all_threads = False
+        except Exception as e:
+            print(e)
+            raise gr.Error(i18n("发生错误! 请前往终端查看详细信息"))
+
+def run_server_job_thread(task, args, name):
+    errors = []
+    def target():
+        try:
+            run_server_job(task, args)
+        except gr.Error as e:
+            errors.append(e)
+    job = threading.Thread(target=target, name=name)
+    job.start()
+    job.join()
+    if errors:
+        raise errors[0]
+
 def stop_all_thread():
     global stop_all_threads, stop_infer_flow
     for thread in threading.enumerate():
-        if thread.name in ["msst_inference", "vr_inference", "msst_training", "msst_valid"]:
+        if thread.name in ["msst_inference", "vr_inference", "inference_flow", "msst_training", "msst_valid"]:
             stop_all_threads = True
             stop_infer_flow = True
             gr.Info(i18n("已停止进程"))
@@ -534,8 +583,17 @@ def run_inference(selected_model, input_folder, store_dir, extract_instrumental,
     extract_instrumental_option = "--extract_instrumental" if extract_instrumental else ""
     force_cpu_option = "--force_cpu" if force_cpu else ""
     use_tta_option = "--use_tta" if use_tta else ""
+    if use_separation_server():
+        args = ["--model_type", model_type, "--config_path", config_path, "--start_check_point", start_check_point, "--input_folder", input_folder, "--store_dir", store_dir, "--device_ids", *gpu_ids.split(), "--output_format", output_format]
+        args += [option for option in [extract_instrumental_option, force_cpu_option, use_tta_option] if option]
+        if extra_store_dir:
+            args += ["--extra_store_dir", extra_store_dir]
+        args += result_cache_options()
+        run_server_job_thread("msst", args, name="msst_inference")
+        return
     extra_store_dir = f"--extra_store_dir \"{extra_store_dir}\"" if extra_store_dir else ""
-    command = f"{PYTHON} msst_inference.py --model_type {model_type} --config_path \"{config_path}\" --start_check_point \"{start_check_point}\" --input_folder \"{input_folder}\" --store_dir \"{store_dir}\" --device_ids {gpu_ids} --output_format {output_format} {extract_instrumental_option} {force_cpu_option} {use_tta_option} {extra_store_dir}"
+    result_cache = " ".join(f"\"{option}\"" for option in result_cache_options())
+    command = f"{PYTHON} msst_inference.py --model_type {model_type} --config_path \"{config_path}\" --start_check_point \"{start_check_point}\" --input_folder \"{input_folder}\" --store_dir \"{store_dir}\" --device_ids {gpu_ids} --output_format {output_format} {extract_instrumental_option} {force_cpu_option} {use_tta_option} {extra_store_dir} {result_cache}"
     msst_inference = threading.Thread(target=run_command, args=(command,), name="msst_inference")
     msst_inference.start()
     msst_inference.join()
@@ -598,9 +656,23 @@ def vr_inference(vr_select_model, vr_window_size, vr_aggression, vr_output_forma
     vr_enable_tta = "--vr_enable_tta" if vr_enable_tta else ""
     vr_high_end_process = "--vr_high_end_process" if vr_high_end_process else ""
     vr_enable_post_process = "--vr_enable_post_process" if vr_enable_post_process else ""
+    if use_separation_server():
+        args = [audio_file, "--model_filename", model_filename, "--output_format", output_format, "--output_dir", output_dir, "--model_file_dir", model_file_dir, "--normalization", normalization]
+        args += [option for option in [debug_mode, invert_spect, use_cpu, vr_enable_tta, vr_high_end_process, vr_enable_post_process] if option]
+        if vr_primary_stem_only != vr_secondary_stem_only:
+            args += ["--single_stem", primary_stem if vr_primary_stem_only else secondary_stem]
+        args += ["--vr_batch_size", vr_batch_size, "--vr_window_size", vr_window_size, "--vr_aggression", vr_aggression, "--vr_post_process_threshold", vr_post_process_threshold]
+        if save_another_stem:
+            args.append("--save_another_stem")
+        if extra_output_dir:
+            args += ["--extra_output_dir", extra_output_dir]
+        args += result_cache_options()
+        run_server_job_thread("vr", args, name="vr_inference")
+        return
     save_another_stem = "--save_another_stem" if save_another_stem else ""
     extra_output_dir = f"--extra_output_dir \"{extra_output_dir}\"" if extra_output_dir else ""
-    command = f"{PYTHON} uvr_inference.py \"{audio_file}\" {debug_mode} --model_filename \"{model_filename}\" --output_format {output_format} --output_dir \"{output_dir}\" --model_file_dir \"{model_file_dir}\" {invert_spect} --normalization {normalization} {single_stem} {use_cpu} --vr_batch_size {vr_batch_size} --vr_window_size {vr_window_size} --vr_aggression {vr_aggression} {vr_enable_tta} {vr_high_end_process} {vr_enable_post_process} --vr_post_process_threshold {vr_post_process_threshold} {save_another_stem} {extra_output_dir}"
+    result_cache = " ".join(f"\"{option}\"" for option in result_cache_options())
+    command = f"{PYTHON} uvr_inference.py \"{audio_file}\" {debug_mode} --model_filename \"{model_filename}\" --output_format {output_format} --output_dir \"{output_dir}\" --model_file_dir \"{model_file_dir}\" {invert_spect} --normalization {normalization} {single_stem} {use_cpu} --vr_batch_size {vr_batch_size} --vr_window_size {vr_window_size} --vr_aggression {vr_aggression} {vr_enable_tta} {vr_high_end_process} {vr_enable_post_process} --vr_post_process_threshold {vr_post_process_threshold} {save_another_stem} {extra_output_dir} {result_cache}"
     vr_inference = threading.Thread(target=run_command, args=(command,), name="vr_inference")
     vr_inference.start()
     vr_inference.join()
@@ -689,6 +761,64 @@ def run_single_inference_flow(input_audio, store_dir, preset_name, force_cpu, ou
     msg = run_inference_flow(input_folder, store_dir, preset_name, force_cpu, output_format_flow, isSingle=True)
     return msg
 
+def get_flow_spec(model_list, input_folder, store_dir, force_cpu, output_format_flow, config):
+    steps = []
+    for step in model_list.keys():
+        model_name = model_list[step]["model_name"]
+        secondary_output = model_list[step].get("secondary_output", "False") == "True"
+        if model_list[step]["model_type"] == "ensemble":
+            # For ensemble steps model_name is the ensemble mode, e.g. avg_wave
+            steps.append({
+                "type": "ensemble",
+                "ensemble_mode": model_name,
+                "stem": model_list[step]["stem"],
+            })
+            if "weights" in model_list[step]:
+                steps[-1]["weights"] = [float(weight) for weight in model_list[step]["weights"]]
+        elif model_list[step]["model_type"] == "UVR_VR_Models":
+            _, _, _, model_file_dir = get_vr_model(model_name)
+            steps.append({
+                "type": "vr",
+                "model_filename": model_name,
+                "model_file_dir": model_file_dir,
+                "stem": model_list[step]["stem"],
+                "secondary_output": secondary_output,
+                "normalization": float(config['inference']['vr_normalization']),
+                "invert_spect": config['inference']['vr_invert_spect'],
+                "debug": config['inference']['vr_debug_mode'],
+                "vr_params": {
+                    "batch_size": int(config['inference']['vr_batch_size']),
+                    "window_size": int(config['inference']['vr_window_size']),
+                    "aggression": int(config['inference']['vr_aggression']),
+                    "enable_tta": config['inference']['vr_enable_tta'],
+                    "enable_post_process": config['inference']['vr_enable_post_process'],
+                    "post_process_threshold": float(config['inference']['vr_post_process_threshold']),
+                    "high_end_process": config['inference']['vr_high_end_process'],
+                },
+            })
+        else:
+            start_check_point, config_path, model_type, _ = get_msst_model(model_name)
+            gpu_id = config['inference']['gpu_id'] if not force_cpu else "0"
+            steps.append({
+                "type": "msst",
+                "model_type": model_type,
+                "config_path": config_path,
+                "start_check_point": start_check_point,
+                "device_ids": [int(gpu) for gpu in gpu_id.split()],
+                "use_tta": config['inference']['use_tta'],
+                "secondary_output": secondary_output,
+            })
+        steps[-1]["name"] = step
+        # Optional keys of graph presets, see inference_flow.py
+        for key in ["inputs", "device_ids", "save"]:
+            if key in model_list[step]:
+                steps[-1][key] = model_list[step][key]
+    return {"input_folder": input_folder, "store_dir": store_dir, "output_format": output_format_flow, "force_cpu": force_cpu, "steps": steps}
+
+def is_graph_preset(model_list):
+    """Presets with branches or ensembles can only run with inference_flow.py."""
+    return any("inputs" in model_list[step] or model_list[step]["model_type"] == "ensemble" for step in model_list.keys())
+
 def run_inference_flow(input_folder, store_dir, preset_name, force_cpu, output_format_flow, isSingle=False):
     global stop_infer_flow
     stop_infer_flow = False
@@ -710,8 +840,25 @@ def run_inference_flow(input_folder, store_dir, preset_name, force_cpu, output_f
     tmp_store_dir = f"{TEMP_PATH}/inferflow_step1_output"
     for step in model_list.keys():
         model_name = model_list[step]["model_name"]
+        if model_list[step]["model_type"] == "ensemble":
+            continue
         if model_name not in load_msst_model() and model_name not in load_vr_model():
             return i18n("模型") + model_name + i18n("不存在")
+    if use_separation_server() or is_graph_preset(model_list):
+        # The whole flow runs as one job, intermediate stems stay in memory (see inference_flow.py)
+        os.makedirs(TEMP_PATH, exist_ok=True)
+        flow_path = os.path.join(TEMP_PATH, "inference_flow.json")
+        save_configs(get_flow_spec(model_list, input_folder, store_dir, force_cpu, output_format_flow, config), flow_path)
+        if use_separation_server():
+            run_server_job_thread("flow", ["--flow", flow_path], name="inference_flow")
+        else:
+            inference_flow = threading.Thread(target=run_command, args=(f"{PYTHON} inference_flow.py --flow \"{flow_path}\"",), name="inference_flow")
+            inference_flow.start()
+            inference_flow.join()
+        shutil.rmtree(TEMP_PATH)
+        elapsed_time = time.time() - start_time
+        rich.console.Console().rule(f"[yellow]Finished runing {preset_name}! Costs {elapsed_time:.2f}s", style="yellow")
+        return i18n("处理完成! 分离完成的音频文件已保存在") + store_dir
     i = 0
     console = rich.console.Console()
     for step in model_list.keys():
@@ -897,6 +1044,10 @@ def ensemble(files, ensemble_mode, weights, output_path):
         files_argument = " ".join(files)
         os.makedirs(output_path, exist_ok=True)
         output_path = os.path.join(output_path, f"ensemble_{ensemble_mode}.wav")
+        if use_separation_server():
+            args = ["--files", *files, "--type", ensemble_mode, "--weights", *weights.split(), "--output", output_path]
+            run_server_job("ensemble", args)
+            return i18n("处理完成, 文件已保存为: ") + output_path
         command = f"{PYTHON} ensemble.py --files {files_argument} --type {ensemble_mode} --weights {weights} --output {output_path}"
         print_command(command)
         try: